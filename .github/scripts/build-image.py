@@ -5,6 +5,7 @@ import sys
 from pathlib import Path
 
 import build
+from functions import enter_build_namespace
 
 
 def print_header(message: str) -> None:
@@ -24,6 +25,7 @@ def process_args():
 
 
 if __name__ == "__main__":
+    enter_build_namespace()  # nothing is left mounted if the build fails
     args = process_args()
     build_args = argparse.Namespace()
     build_args.verbose = True
@@ -31,8 +33,26 @@ if __name__ == "__main__":
     build_args.local_path = None
     build_args.dev_build = False
     build_args.download_progress = True
+    build_args.progress_json = False
     build_args.no_shrink = False
     build_args.image_size = [10]
+    build_args.no_cache = True  # runners are ephemeral -> a persistent cache would only use up build space
+    build_args.cache_dir = "/var/cache/depthboot"
+    build_args.cache_size = 20
+    build_args.stream_rootfs = True  # saves build space on the runners
+    build_args.package_proxy = False  # would need a cache shared between runners to be useful
+    build_args.package_proxy_size = 10
+    build_args.package_cache = False
+    build_args.package_cache_size = 10
+    build_args.stage_cache = False
+    build_args.stage_cache_age = 7
+    build_args.no_mirror_ranking = False
+    build_args.no_prefetch = False
+    build_args.unsafe_io = True  # a failed build is discarded anyway
+    build_args.work_dir = "/mnt/depthboot"
+    build_args.build_in_image = False  # only used for USB/SD-cards
+    build_args.exact_size = False
+    build_args.exact_size_headroom = 200
     testing_dict = {
         "distro_name": args.distro_name,
         "distro_version": args.distro_version,
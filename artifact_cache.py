@@ -0,0 +1,269 @@
+# Persistent, content-addressed cache for downloaded build artifacts (kernel, rootfs archives)
+# Layout of the cache dir:
+#   index.json       -> maps the requested url to the resolved asset, its validators and the sha256 of the blob
+#   blobs/<sha256>   -> the actual files, stored once per content
+#   staging/         -> in-progress downloads
+#   locks/           -> per-url lock files, so that multiple builds sharing the cache don't download the same file twice
+import fcntl
+import hashlib
+import json
+import os
+import time
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit, urlunsplit
+from urllib.request import Request, urlopen
+
+from functions import *
+
+cache_dir = ""  # empty -> cache disabled
+max_cache_size = 20 * 1073741824  # bytes
+
+
+def configure(new_cache_dir: str, max_size_gb: int) -> None:
+    global cache_dir, max_cache_size
+    cache_dir = get_full_path(new_cache_dir)
+    max_cache_size = max_size_gb * 1073741824
+    for sub_dir in ["blobs", "staging", "locks"]:
+        mkdir(f"{cache_dir}/{sub_dir}", create_parents=True)
+    os.chmod(cache_dir, 0o700)  # cached artifacts are written into the image as root -> keep other users out
+
+
+def is_enabled() -> bool:
+    return cache_dir != ""
+
+
+# Download url to dest through the cache. Returns the sha256 of the file, empty if the cache is disabled.
+# On a cache hit only a conditional HEAD request is sent to the server.
+def fetch(url: str, dest: str) -> str:
+    path, file_hash = _fetch(url, dest)
+    if path != dest:
+        _deliver(path, dest)
+    return file_hash
+
+
+# Like fetch, but a cached file is not copied to dest. Returns the path of the file: its blob in the cache, or dest
+# if it can't be cached. For large files that are only read, e.g. the rootfs archives.
+def fetch_path(url: str, dest: str) -> str:
+    return _fetch(url, dest)[0]
+
+
+# Returns the path of the downloaded file and its sha256
+def _fetch(url: str, dest: str) -> tuple[str, str]:
+    if not is_enabled():
+        download_file(url, dest)
+        return dest, ""  # hashing would read the whole file again
+
+    with _lock(_url_lock_path(url)):
+        cached_hash, validators = _lookup(url)
+        if cached_hash:
+            return _blob_path(cached_hash), cached_hash
+
+        staging_file = f"{cache_dir}/staging/{_url_key(url)}.part"
+        download_file(url, staging_file)
+        file_hash = sha256_file(staging_file)
+        if not commit_blob(url, staging_file, validators, file_hash):
+            rmfile(dest)
+            bash(f"mv {staging_file} {dest}")  # dest might be on a different filesystem
+            return dest, file_hash
+    return _blob_path(file_hash), file_hash
+
+
+# Download an archive and extract it to dest. urls are the parts of the archive, usually only one.
+# Cached parts are read from the cache, the others are streamed into tar and written to the cache at the same time.
+# Returns the sha256 of each part.
+def fetch_and_extract(urls: list, dest: str, compression: str, strip_dir: str = "") -> list:
+    if not is_enabled():
+        return [result[0] for result in stream_extract(urls, dest, compression, strip_dir=strip_dir)]
+
+    # always lock in the same order to avoid deadlocks between builds
+    with contextlib.ExitStack() as locks:
+        for url in sorted(set(urls)):
+            locks.enter_context(_lock(_url_lock_path(url)))
+        cached_hashes = [_lookup(url)[0] for url in urls]
+        sources = [_blob_path(cached_hash) if cached_hash else url for url, cached_hash in zip(urls, cached_hashes)]
+        tee_paths = ["" if cached_hash else f"{cache_dir}/staging/{_url_key(url)}.stream" for url, cached_hash in
+                     zip(urls, cached_hashes)]
+
+        results = stream_extract(sources, dest, compression, tee_paths, strip_dir)
+        for url, tee_path, (file_hash, validators) in zip(urls, tee_paths, results):
+            if tee_path and not commit_blob(url, tee_path, validators, file_hash):
+                rmfile(tee_path)
+    return [cached_hash or result[0] for cached_hash, result in zip(cached_hashes, results)]
+
+
+# Move a fully downloaded file into the blob store and record it in the index.
+# Returns False if the file can't be cached, in which case it is left in place.
+def commit_blob(url: str, staged_file: str, validators: dict, file_hash: str) -> bool:
+    if validators["etag"] is None and validators["last_modified"] is None:
+        # without validators the file can't be revalidated later -> caching it would only waste space
+        if verbose:
+            print(f"Server sent no ETag/Last-Modified for {url}, not caching")
+        return False
+    size = os.stat(staged_file).st_size
+    os.replace(staged_file, _blob_path(file_hash))
+    _store_entry(url, validators, file_hash, size)
+    evict(keep=file_hash)
+    return True
+
+
+# Remove least recently used blobs until the cache fits into max_cache_size
+def evict(keep: str = "") -> None:
+    with _lock(f"{cache_dir}/locks/index.lock"):
+        index = _load_index_file()
+        blob_sizes = {entry["sha256"]: entry["size"] for entry in index.values()}
+        total_size = sum(blob_sizes.values())
+        for url, entry in sorted(index.items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= max_cache_size:
+                break
+            if entry["sha256"] == keep:
+                continue
+            # skip entries another build is currently working with
+            try:
+                with _lock(_url_lock_path(url), blocking=False):
+                    del index[url]
+                    if not any(other["sha256"] == entry["sha256"] for other in index.values()):
+                        rmfile(_blob_path(entry["sha256"]))
+                        total_size -= blob_sizes[entry["sha256"]]
+                        if verbose:
+                            print(f"Evicted {url} from artifact cache")
+            except BlockingIOError:
+                continue
+        _write_index_file(index)
+
+
+# Returns the hash of the cached copy of url if it's up to date, empty if the url isn't cached
+def cached_hash(url: str) -> str:
+    if not is_enabled():
+        return ""
+    with _lock(_url_lock_path(url)):
+        return _lookup(url)[0]
+
+
+def sha256_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(4194304):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+# Returns the hash of the cached file if the cached copy is still up to date, and the current validators of the url.
+# Must be called with the url lock held.
+def _lookup(url: str) -> tuple[str, dict]:
+    entry = _read_index().get(url)
+    try:
+        status, validators = _revalidate(url, entry)
+    except URLError:
+        if entry is None or not path_exists(_blob_path(entry["sha256"])):
+            raise
+        print_warning(f"Couldn't reach server, using possibly outdated cached copy of {url}")
+        status, validators = 304, entry
+
+    if status == 304:
+        print_status("Cached copy is up to date, skipping download")
+        _touch_entry(url, entry)
+        return entry["sha256"], validators
+
+    # the same asset might already be cached under a different url, e.g. "latest" and a specific release
+    alias = _find_alias(validators)
+    if alias is not None:
+        print_status("Found identical file in cache, skipping download")
+        _store_entry(url, validators, alias["sha256"], alias["size"])
+        return alias["sha256"], validators
+    return "", validators
+
+
+# Send a conditional HEAD request. Returns the http status and the current validators of the resolved asset
+def _revalidate(url: str, entry: dict | None) -> tuple[int, dict]:
+    headers = {}
+    if entry is not None and path_exists(_blob_path(entry["sha256"])):
+        if entry["etag"] is not None:
+            headers["If-None-Match"] = entry["etag"]
+        if entry["last_modified"] is not None:
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        with urlopen(Request(url, headers=headers, method="HEAD")) as response:
+            return response.status, {
+                # strip signed query parameters from redirects, e.g. GitHub release assets
+                "asset": urlunsplit(urlsplit(response.url)._replace(query="", fragment="")),
+                "etag": response.headers["ETag"],
+                "last_modified": response.headers["Last-Modified"]
+            }
+    except HTTPError as e:
+        if e.code == 304 and headers:
+            return 304, entry
+        raise
+
+
+def _find_alias(validators: dict) -> dict | None:
+    if validators["etag"] is None:
+        return None
+    for entry in _read_index().values():
+        if (entry["asset"], entry["etag"]) == (validators["asset"], validators["etag"]) and \
+                path_exists(_blob_path(entry["sha256"])):
+            return entry
+    return None
+
+
+# Hardlink the blob to dest if possible, copy it otherwise
+def _deliver(blob: str, dest: str) -> None:
+    rmfile(dest)
+    try:
+        os.link(blob, dest)
+    except OSError:  # different filesystem
+        bash(f"cp {blob} {dest}")
+
+
+def _store_entry(url: str, validators: dict, file_hash: str, size: int) -> None:
+    with _lock(f"{cache_dir}/locks/index.lock"):
+        index = _load_index_file()
+        index[url] = {"asset": validators["asset"], "etag": validators["etag"],
+                      "last_modified": validators["last_modified"], "sha256": file_hash, "size": size,
+                      "last_used": time.time()}
+        _write_index_file(index)
+
+
+def _touch_entry(url: str, entry: dict) -> None:
+    _store_entry(url, entry, entry["sha256"], entry["size"])
+
+
+def _read_index() -> dict:
+    with _lock(f"{cache_dir}/locks/index.lock"):
+        return _load_index_file()
+
+
+# Only call these two with the index lock held
+def _load_index_file() -> dict:
+    try:
+        with open(f"{cache_dir}/index.json", "r") as file:
+            return json.load(file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_index_file(index: dict) -> None:
+    with open(f"{cache_dir}/index.json.tmp", "w") as file:
+        json.dump(index, file, indent=2)
+    os.replace(f"{cache_dir}/index.json.tmp", f"{cache_dir}/index.json")
+
+
+def _blob_path(file_hash: str) -> str:
+    return f"{cache_dir}/blobs/{file_hash}"
+
+
+def _url_key(url: str) -> str:
+    return hashlib.sha1(url.encode()).hexdigest()
+
+
+def _url_lock_path(url: str) -> str:
+    return f"{cache_dir}/locks/{_url_key(url)}.lock"
+
+
+@contextlib.contextmanager
+def _lock(path: str, blocking: bool = True):
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
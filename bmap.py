@@ -0,0 +1,239 @@
+# Block maps of the image: which blocks actually contain data. Only these blocks have to be written when flashing the
+# image, the rest is free space of the rootfs or was never written (sparse file).
+# The format is the one of bmaptool (bmap version 2.0) -> the image can be flashed with bmaptool as well:
+#   <bmap version="2.0">
+#       <ImageSize>, <BlockSize>, <BlocksCount>, <MappedBlocksCount>, <ChecksumType>, <BmapFileChecksum>
+#       <BlockMap> <Range chksum="sha256 of the range"> first-last </Range> ... </BlockMap>
+#   </bmap>
+# BmapFileChecksum is the sha256 of the bmap file with the checksum itself replaced by zeros.
+import hashlib
+import xml.etree.ElementTree as ElementTree
+
+import progress
+from functions import *
+
+block_size = 4096
+chunk_size = 8388608  # 8mb, bytes per read/write while hashing and flashing
+
+
+# Write the block map of image_path to bmap_path. free_ranges are (start, end) byte ranges of the image that are unused,
+# even if they contain data, see ext4_free_ranges.
+def generate(image_path: str, bmap_path: str, free_ranges: list = None) -> None:
+    print_status("Generating block map of the image")
+    image_size = os.path.getsize(image_path)
+    ranges = _subtract(_data_ranges(image_path, image_size), free_ranges or [])
+    block_ranges = []  # (first block, last block, sha256)
+    with open(image_path, "rb") as image, progress.start_task("Hashing image", sum(end - start for start, end in
+                                                                                  ranges)) as task:
+        for start, end in ranges:
+            first_block = start // block_size
+            last_block = (end - 1) // block_size
+            digest = hashlib.sha256()
+            for data in _read_range(image, first_block * block_size, min((last_block + 1) * block_size, image_size)):
+                digest.update(data)
+                task.advance(len(data))
+            block_ranges.append((first_block, last_block, digest.hexdigest()))
+
+    blocks_count = (image_size + block_size - 1) // block_size
+    mapped_blocks = sum(last - first + 1 for first, last, _ in block_ranges)
+    lines = ['<?xml version="1.0" ?>',
+             '<bmap version="2.0">',
+             f"    <ImageSize> {image_size} </ImageSize>",
+             f"    <BlockSize> {block_size} </BlockSize>",
+             f"    <BlocksCount> {blocks_count} </BlocksCount>",
+             f"    <MappedBlocksCount> {mapped_blocks} </MappedBlocksCount>",
+             "    <ChecksumType> sha256 </ChecksumType>",
+             f"    <BmapFileChecksum> {'0' * 64} </BmapFileChecksum>",
+             "    <BlockMap>"]
+    for first, last, digest in block_ranges:
+        lines.append(f'        <Range chksum="{digest}"> {first}-{last} </Range>' if first != last else
+                     f'        <Range chksum="{digest}"> {first} </Range>')
+    lines += ["    </BlockMap>", "</bmap>", ""]
+    bmap = "\n".join(lines)
+    bmap = bmap.replace("0" * 64, hashlib.sha256(bmap.encode()).hexdigest(), 1)
+    with open(bmap_path, "w") as file:
+        file.write(bmap)
+    print_status(f"Block map: {mapped_blocks * block_size // 1048576}mb of {image_size // 1048576}mb are mapped")
+
+
+# Returns the free blocks of an unmounted ext4 filesystem as (start, end) byte ranges, offset is the position of the
+# filesystem in the image
+def ext4_free_ranges(device: str, offset: int) -> list:
+    output = bash(f"dumpe2fs {device} 2>/dev/null")
+    fs_block_size = int(re.search(r"^Block size:\s+(\d+)", output, re.MULTILINE).group(1))
+    free_ranges = []
+    for line in output.split("\n"):
+        line = line.strip()
+        if not line.startswith("Free blocks: "):
+            continue
+        for free_range in line[len("Free blocks: "):].split(","):
+            if not free_range.strip():
+                continue
+            first, _, last = free_range.strip().partition("-")
+            free_ranges.append((offset + int(first) * fs_block_size, offset + (int(last or first) + 1) * fs_block_size))
+    return free_ranges
+
+
+# Write the mapped blocks of the image to a device and verify them. The rest of the device is not touched, unless
+# discard is set: then the whole device is discarded first, which also gives the flash controller of SD-cards and USB
+# sticks free blocks to write to.
+def flash(image_path: str, bmap_path: str, device: str, verify: bool = True, discard: bool = False) -> None:
+    image_size, bmap_block_size, ranges = read(bmap_path)
+    if os.path.getsize(image_path) != image_size:
+        print_error(f"{bmap_path} doesn't belong to {image_path}, the image size differs")
+        sys.exit(1)
+    device_fd = os.open(device, os.O_WRONLY)
+    try:
+        if os.lseek(device_fd, 0, os.SEEK_END) < image_size:
+            print_error(f"{device} is smaller than the image")
+            sys.exit(1)
+        if discard:
+            with contextlib.suppress(subprocess.CalledProcessError):  # not supported by the device
+                bash(f"blkdiscard -f {device} 2>/dev/null")
+        mapped_size = sum(min((last + 1) * bmap_block_size, image_size) - first * bmap_block_size for first, last, _ in
+                          ranges)
+        print_status(f"Writing {mapped_size // 1048576}mb of {image_size // 1048576}mb to {device}")
+        with open(image_path, "rb") as image, progress.start_task(f"Flashing {Path(image_path).name}",
+                                                                   mapped_size) as task:
+            for start, data in _read_ahead(image, image_size, bmap_block_size, ranges):
+                _pwrite_all(device_fd, data, start)
+                task.advance(len(data))
+        print_status("Syncing, might take a while")
+        os.fsync(device_fd)
+    finally:
+        os.close(device_fd)
+    if verify:
+        _verify(device, image_size, bmap_block_size, ranges, mapped_size)
+    print_status(f"Flashed {image_path} to {device}")
+
+
+# Returns (image size, block size, [(first block, last block, sha256)]) of a bmap file
+def read(bmap_path: str) -> Tuple[int, int, list]:
+    with open(bmap_path, "r") as file:
+        bmap = file.read()
+    root = ElementTree.fromstring(bmap)
+    if not root.get("version", "").startswith("2."):
+        print_error(f"Unsupported bmap version: {root.get('version')}")
+        sys.exit(1)
+    checksum = root.findtext("BmapFileChecksum").strip()
+    if hashlib.sha256(bmap.replace(checksum, "0" * 64, 1).encode()).hexdigest() != checksum:
+        print_error(f"{bmap_path} is corrupted")
+        sys.exit(1)
+    ranges = []
+    for block_range in root.find("BlockMap").findall("Range"):
+        first, _, last = block_range.text.strip().partition("-")
+        ranges.append((int(first), int(last or first), block_range.get("chksum")))
+    return int(root.findtext("ImageSize")), int(root.findtext("BlockSize")), ranges
+
+
+# Yields (offset, data) chunks of the mapped ranges of the image. The chunks are read and checked against the block map
+# in a background thread, while the caller writes the previous chunk -> reading and writing overlap.
+def _read_ahead(image, image_size: int, bmap_block_size: int, ranges: list):
+    chunks = Queue(maxsize=2)
+
+    def read_chunks() -> None:
+        try:
+            for first, last, expected_digest in ranges:
+                start = first * bmap_block_size
+                digest = hashlib.sha256()
+                for data in _read_range(image, start, min((last + 1) * bmap_block_size, image_size)):
+                    digest.update(data)
+                    chunks.put((start, data))
+                    start += len(data)
+                if digest.hexdigest() != expected_digest:
+                    print_error(f"The image doesn't match the block map at blocks {first}-{last}, it's corrupted")
+                    sys.exit(1)
+        finally:
+            chunks.put(None)
+
+    reader = BackgroundTask(read_chunks)
+    while (chunk := chunks.get()) is not None:
+        yield chunk
+    reader.join()  # re-raises the exit of the reader
+
+
+# Read the written ranges back from the device and compare them with the block map
+def _verify(device: str, image_size: int, bmap_block_size: int, ranges: list, mapped_size: int) -> None:
+    with open(device, "rb", buffering=0) as file, progress.start_task("Verifying", mapped_size) as task:
+        # the page cache still has the written data -> drop it to actually read from the device
+        os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        for first, last, expected_digest in ranges:
+            digest = hashlib.sha256()
+            for data in _read_range(file, first * bmap_block_size, min((last + 1) * bmap_block_size, image_size)):
+                digest.update(data)
+                task.advance(len(data))
+            if digest.hexdigest() != expected_digest:
+                print_error(f"Verification failed at blocks {first}-{last}, the device might be faulty")
+                sys.exit(1)
+
+
+# Returns the (start, end) byte ranges of the image that contain data. Holes of a sparse file and unwritten extents
+# (fallocate) are skipped.
+def _data_ranges(image_path: str, image_size: int) -> list:
+    ranges = []
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        position = 0
+        while position < image_size:
+            try:
+                start = os.lseek(fd, position, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:  # no data after position
+                    break
+                if e.errno == errno.EINVAL:  # SEEK_DATA not supported -> everything is data
+                    return [(0, image_size)]
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            ranges.append((start, end))
+            position = end
+    finally:
+        os.close(fd)
+    return ranges
+
+
+# Remove the removed ranges from ranges, only whole blocks are removed. Both lists are (start, end) byte ranges.
+def _subtract(ranges: list, removed: list) -> list:
+    # block aligned: data ranges are rounded outwards, removed ranges inwards
+    removed = sorted(((start + block_size - 1) // block_size * block_size, end // block_size * block_size) for
+                     start, end in removed)
+    result = []
+    for start, end in ranges:
+        start = start // block_size * block_size
+        end = (end + block_size - 1) // block_size * block_size
+        for removed_start, removed_end in removed:
+            if removed_end <= start or removed_start >= removed_end:
+                continue
+            if removed_start >= end:
+                break
+            if removed_start > start:
+                result.append((start, removed_start))
+            start = max(start, removed_end)
+        if start < end:
+            result.append((start, end))
+    # merge adjacent ranges
+    merged = []
+    for start, end in result:
+        if merged and merged[-1][1] >= start:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+# Yields the bytes of file from start to end in chunks that end at multiples of chunk_size
+def _read_range(file, start: int, end: int):
+    file.seek(start)
+    while start < end:
+        data = file.read(min(chunk_size - start % chunk_size, end - start))
+        if not data:
+            raise EOFError(f"Unexpected end of {file.name}")
+        start += len(data)
+        yield data
+
+
+def _pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
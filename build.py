@@ -3,12 +3,27 @@ import argparse
 import atexit
 import json
 import sys
+import time
+import uuid
 from typing import Tuple
 from urllib.error import URLError
 
+import artifact_cache
+import bmap
+import gpt
+import mirrors
+import package_cache
+import package_plan
+import package_proxy
+import prefetch
+import progress
+import selinux_labels
+import stage_cache
+import unsafe_io
 from functions import *
 
 img_mnt = ""  # empty to avoid variable not defined error in exit_handler
+rootfs_paths = []  # the downloaded rootfs parts, in the artifact cache or in /tmp/depthboot-build. See download_rootfs
 
 
 # the exit handler with user messages is in main.py
@@ -18,28 +33,18 @@ def exit_handler():
     if exc_type != KeyboardInterrupt:
         return
     print_error("Ctrl+C detected. Cleaning machine and exiting...")
-    # Kill arch gpg agent if present
-    print_status("Killing gpg-agent arch processes if they exist")
-    gpg_pids = []
-    for line in bash("ps aux").split("\n"):
-        if "gpg-agent --homedir /etc/pacman.d/gnupg --use-standard-socket --daemon" in line:
-            temp_string = line[line.find(" "):].strip()
-            gpg_pids.append(temp_string[:temp_string.find(" ")])
-    for pid in gpg_pids:
-        print(f"Killing gpg-agent proces with pid: {pid}")
-        bash(f"kill {pid}")
+    # Processes started in the chroot, e.g. the gpg-agent of pacman, keep the mounts busy
+    close_chroot()
+    kill_chroot_processes()
 
+    # In a build namespace the kernel removes the mounts anyway once the script exits, see enter_build_namespace()
     print_status("Unmounting partitions")
-    with contextlib.suppress(subprocess.CalledProcessError):
-        bash("umount -lf /mnt/depthboot")  # umount mountpoint
-    sleep(5)  # wait for umount to finish
-
-    # unmount image/device completely from system
-    # on crostini umount fails for some reason
-    with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lf {img_mnt}p*")  # umount all partitions from image
-    with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lf {img_mnt}*")  # umount all partitions from usb/sd-card
+    with contextlib.suppress(subprocess.CalledProcessError):  # not mounted
+        bash(f"umount -R {root_path()}")
+    # loop devices are not part of the namespace
+    if img_mnt.startswith("/dev/loop"):
+        with contextlib.suppress(subprocess.CalledProcessError):
+            bash(f"losetup -d {img_mnt}")
 
 
 def download_kernel(kernel_type: str, dev_release: bool, files: list = None) -> None:
@@ -60,7 +65,7 @@ def download_kernel(kernel_type: str, dev_release: bool, files: list = None) ->
     try:
         print_status(f"Downloading {kernel_type} kernel")
         if "bzImage" in files:
-            download_file(f"{urls[kernel_type]}bzImage", "/tmp/depthboot-build/bzImage")
+            artifact_cache.fetch(f"{urls[kernel_type]}bzImage", "/tmp/depthboot-build/bzImage")
 
     except URLError:
         print_error("Failed to reach github. Check your internet connection and try again or use local files with -l")
@@ -69,45 +74,120 @@ def download_kernel(kernel_type: str, dev_release: bool, files: list = None) ->
         sys.exit(1)
 
 
+# Returns the download urls of the distro rootfs. Split archives have one url per part.
+def rootfs_urls(distro_name: str, distro_version: str) -> list:
+    match distro_name:
+        case "arch":
+            return ["https://geo.mirror.pkgbuild.com/iso/latest/archlinux-bootstrap-x86_64.tar.gz"]
+        case "ubuntu" | "fedora":
+            return [f"https://github.com/eupnea-linux/{distro_name}-rootfs/releases/latest/download/"
+                    f"{distro_name}-rootfs-{distro_version}.tar.xz"]
+        case "pop-os":
+            # GitHub limits the size of release assets -> the pop-os rootfs might be split into multiple parts
+            return [f"https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/pop-os-rootfs-22.04.split."
+                    f"{part}" for part in ["aa"]]
+
+
+# Returns the local paths of the downloaded distro rootfs, one per part for split archives
+def rootfs_files(distro_name: str, distro_version: str) -> list:
+    match distro_name:
+        case "arch":
+            return ["/tmp/depthboot-build/arch-rootfs.tar.gz"]
+        case "ubuntu" | "fedora":
+            return [f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz"]
+        case "pop-os":
+            # the local path option provides the already combined archive
+            if path_exists("/tmp/depthboot-build/pop-os-rootfs.tar.xz"):
+                return ["/tmp/depthboot-build/pop-os-rootfs.tar.xz"]
+            return [f"/tmp/depthboot-build/pop-os-rootfs.split.{url.split('.')[-1]}" for url in
+                    rootfs_urls(distro_name, distro_version)]
+
+
 # download the distro rootfs
+# Cached parts are extracted directly from the artifact cache instead of copying them to /tmp/depthboot-build first
 def download_rootfs(distro_name: str, distro_version: str) -> None:
+    global rootfs_paths
+    match distro_name:
+        case "arch":
+            print_status("Downloading latest arch rootfs from geo.mirror.pkgbuild.com")
+        case "ubuntu" | "fedora":
+            print_status(f"Downloading {distro_name} rootfs, version {distro_version} from eupnea github releases")
+        case "pop-os":
+            print_status("Downloading pop-os rootfs from eupnea github releases")
     try:
-        match distro_name:
-            case "arch":
-                print_status("Downloading latest arch rootfs from geo.mirror.pkgbuild.com")
-                download_file("https://geo.mirror.pkgbuild.com/iso/latest/archlinux-bootstrap-x86_64.tar.gz",
-                              "/tmp/depthboot-build/arch-rootfs.tar.gz")
-            case "ubuntu" | "fedora":
-                print_status(f"Downloading {distro_name} rootfs, version {distro_version} from eupnea github releases")
-                download_file(f"https://github.com/eupnea-linux/{distro_name}-rootfs/releases/latest/download/"
-                              f"{distro_name}-rootfs-{distro_version}.tar.xz",
-                              f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz")
-            case "pop-os":
-                print_status("Downloading pop-os rootfs from eupnea github releases")
-                download_file("https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/pop-os-rootfs-"
-                              "22.04.split.aa", "/tmp/depthboot-build/pop-os-rootfs.split.aa")
-                # print_status("Downloading pop-os rootfs from eupnea GitHub releases, part 2/2")
-                # download_file("https://github.com/eupnea-linux/pop-os-rootfs/releases/latest/download/pop-os-rootfs"
-                #              "-22.04.split.ab", "/tmp/depthboot-build/pop-os-rootfs.split.ab")
-                print_status("Combining split pop-os rootfs, might take a while")
-                bash("cat /tmp/depthboot-build/pop-os-rootfs.split.?? > /tmp/depthboot-build/pop-os-rootfs.tar.xz")
+        # download all parts of split archives at the same time
+        download_tasks = [BackgroundTask(artifact_cache.fetch_path, url, file) for url, file in
+                          zip(rootfs_urls(distro_name, distro_version), rootfs_files(distro_name, distro_version))]
+        rootfs_paths = [task.join() for task in download_tasks]
     except URLError:
         print_error("Couldn't download rootfs. Check your internet connection and try again. If the error persists, "
                     "create an issue with the distro and version in the name")
         sys.exit(1)
 
 
+# Download the kernel or copy it from the local path
+def get_kernel(build_options: dict, args: argparse.Namespace) -> None:
+    if args.local_path is None:  # default
+        download_kernel(build_options["kernel_type"], args.dev_build)
+        return
+    # if local path is specified, copy files from it, instead of downloading from the internet
+    print_status("Copying local kernel files to /tmp/depthboot-build")
+    # clean local path string
+    local_path_posix = args.local_path if args.local_path.endswith("/") else f"{args.local_path}/"
+    # copy kernel files
+    kernel_files = ["bzImage", "modules.tar.xz", "headers.tar.xz", ]
+    for file in kernel_files:
+        try:
+            cpfile(f"{local_path_posix}{file}", f"/tmp/depthboot-build/{file}")
+        except FileNotFoundError:
+            print_warning(f"File {file} not found in {args.local_path}, attempting to download")
+            download_kernel(build_options["kernel_type"], args.dev_build, [file])
+
+
+# Download the distro rootfs or copy it from the local path
+def get_rootfs(build_options: dict, args: argparse.Namespace) -> None:
+    if args.local_path is None:  # default
+        download_rootfs(build_options["distro_name"], build_options["distro_version"])
+        return
+    print_status("Copying local rootfs to /tmp/depthboot-build")
+    local_path_posix = args.local_path if args.local_path.endswith("/") else f"{args.local_path}/"
+    # copy distro rootfs
+    distro_rootfs = {
+        # distro_name:[cp function type,filename]
+        "ubuntu": [cpfile, "ubuntu-rootfs.tar.xz"],
+        "arch": [cpfile, "arch-rootfs.tar.gz"],
+        "fedora": [cpfile, "fedora-rootfs.tar.xz"],
+        "pop-os": [cpfile, "pop-os-rootfs.tar.xz"],
+    }
+    try:
+        distro_rootfs[build_options["distro_name"]][0](
+            f"{local_path_posix}{distro_rootfs[build_options['distro_name']][1]}",
+            f"/tmp/depthboot-build/{distro_rootfs[build_options['distro_name']][1]}")
+    except FileNotFoundError:
+        print_warning(f"File {distro_rootfs[build_options['distro_name']][1]} not found in {args.local_path}, "
+                      f"attempting to download")
+        download_rootfs(build_options["distro_name"], build_options["distro_version"])
+
+
 # Create, mount, partition the img and flash the eupnea kernel
-def prepare_img(distro_name: str, img_size, verbose_kernel: bool) -> Tuple[str, str]:
+# If sparse_size is set, the image is a sparse file of that many bytes instead, see --build-in-image
+def prepare_img(distro_name: str, img_size, verbose_kernel: bool, kernel_task: BackgroundTask,
+                sparse_size: int = 0) -> Tuple[str, str]:
     print_status("Preparing image")
-    try:
-        bash(f"fallocate -l {img_size}G depthboot.img")
-    except subprocess.CalledProcessError:  # try fallocate, if it fails use dd
-        bash(f"dd if=/dev/zero of=depthboot.img status=progress bs=1024 count={img_size * 1000000}")
+    if sparse_size:
+        bash(f"truncate --size={sparse_size} depthboot.img")
+    else:
+        try:
+            bash(f"fallocate -l {img_size}G depthboot.img")
+        except subprocess.CalledProcessError:  # try fallocate, if it fails use dd
+            bash(f"dd if=/dev/zero of=depthboot.img status=progress bs=1024 count={img_size * 1000000}")
+
+    rootfs_partuuid = partition_and_flash_kernel("depthboot.img", distro_name, verbose_kernel, kernel_task)
 
-    print_status("Mounting empty image")
+    print_status("Mounting image")
     try:
-        mnt_point = bash("losetup -f --show depthboot.img")
+        # -P -> the kernel reads the partition table once, when attaching the image
+        mnt_point = bash("losetup -P -f --show depthboot.img")
     except subprocess.CalledProcessError as e:
         if not bash("systemd-detect-virt").lower().__contains__("wsl"):  # if not running WSL, the error is unexpected
             raise e
@@ -116,57 +196,92 @@ def prepare_img(distro_name: str, img_size, verbose_kernel: bool) -> Tuple[str,
     if mnt_point == "":
         print_error("Failed to mount image")
         sys.exit(1)
-    return partition_and_flash_kernel(mnt_point, False, distro_name, verbose_kernel)
+    format_and_mount_rootfs(gpt.partition_path(mnt_point, 3))
+    return mnt_point, rootfs_partuuid  # return loop device, so it can be unmounted at the end
+
+
+# Create the image around the root dir, which is a plain staging dir with --exact-size. mke2fs copies the staged files
+# into a new rootfs that is only as large as they need plus headroom_mb -> no shrinking with resize2fs afterwards.
+# Returns the loop device of the image.
+def prepare_exact_size_img(distro_name: str, headroom_mb: int, verbose_kernel: bool,
+                           kernel_task: BackgroundTask) -> str:
+    print_status("Creating image with the exact size of the rootfs")
+    used_kb = int(bash(f"du -sx --block-size=1K {root_path()}").split()[0])
+    inode_count = int(bash(f"du -sx --inodes {root_path()}").split()[0])
+    # ext4 needs extra space for extent trees and bitmaps (~5%), the inode tables (256 bytes per inode) and the
+    # journal (64mb for the usual rootfs sizes)
+    rootfs_kb = used_kb + used_kb // 20 + inode_count // 4 + 65536 + headroom_mb * 1024
+    for attempt in range(5):
+        rootfs_kb = (rootfs_kb + 1023) // 1024 * 1024  # whole mb -> the end of the rootfs stays aligned
+        # mke2fs creates one inode per 16kb by default, the staged files might need more
+        inodes = max(rootfs_kb // 16, inode_count + inode_count // 10)
+        rmfile("depthboot.img")
+        # the last mb is for the backup GPT
+        bash(f"truncate --size={gpt.rootfs_start + rootfs_kb * 1024 + 1048576} depthboot.img")
+        try:
+            bash(f"mke2fs -F -q -t ext4 -b 4096 -N {inodes} -d {root_path()} -E offset={gpt.rootfs_start} "
+                 f"depthboot.img {rootfs_kb}k 2>&1")
+            break
+        except subprocess.CalledProcessError as e:
+            # the size is only an estimate -> retry with more space if it was too small
+            if attempt == 4 or ("allocate" not in e.output and "space" not in e.output):
+                print_error(f"Failed to create the rootfs: {e.output}")
+                sys.exit(1)
+            rootfs_kb += rootfs_kb // 10
+            print_warning(f"Rootfs was too small, retrying with {rootfs_kb // 1024}mb")
+    print_status(f"Rootfs size: {rootfs_kb // 1024}mb")
+    # the staged files aren't needed anymore, post_config unmounted everything in the root dir
+    remove_root_dir()
+
+    partition_and_flash_kernel("depthboot.img", distro_name, verbose_kernel, kernel_task)
+    # the loop device is only needed for the block map, see generate_bmap
+    return bash("losetup -P -f --show depthboot.img")
 
 
 # Prepare USB/SD-card
-def prepare_usb_sd(device: str, distro_name: str, verbose_kernel: bool) -> Tuple[str, str]:
+def prepare_usb_sd(device: str, distro_name: str, verbose_kernel: bool, kernel_task: BackgroundTask) -> Tuple[
+    str, str]:
     print_status("Preparing USB/SD-card")
+    device = get_device_path(device)
+    umount_device(device)
+    rootfs_partuuid = partition_and_flash_kernel(device, distro_name, verbose_kernel, kernel_task)
+    try:
+        gpt.reread_partitions(device)
+    except OSError:  # usually EBUSY, the host still uses the old partitions
+        print_error("Failed to create partition table. Try physically unplugging and replugging the USB/SD-card.")
+        print_question("If you are seeing this message the second time, create an issue on GitHub/Discord/Revolt")
+        sys.exit(1)
+    format_and_mount_rootfs(gpt.partition_path(device, 3))
+    return device, rootfs_partuuid
+
 
+# Returns the path of the whole device, as the user might have entered a partition or left out /dev/
+def get_device_path(device: str) -> str:
     # fix device name if needed
     if device.endswith("/") or device.endswith("1") or device.endswith("2"):
         device = device[:-1]
     # add /dev/ to device name, if needed
     if not device.startswith("/dev/"):
         device = f"/dev/{device}"
+    return device
 
-    # unmount all partitions
+
+def umount_device(device: str) -> None:
+    # unmount all partitions, the host might have mounted them
     with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lf {device}*")
-    if device.__contains__("mmcblk"):  # sd card
-        return partition_and_flash_kernel(device, False, distro_name, verbose_kernel)
-    else:
-        return partition_and_flash_kernel(device, True, distro_name, verbose_kernel)
+        host_bash(f"umount -lf {device}*")
 
 
-def partition_and_flash_kernel(mnt_point: str, write_usb: bool, distro_name: str, verbose_kernel: bool) -> Tuple[
-    str, str]:
+# Partition the image file/device and write the signed kernel to both kernel partitions. Returns the PARTUUID of the
+# rootfs partition.
+def partition_and_flash_kernel(target: str, distro_name: str, verbose_kernel: bool,
+                               kernel_task: BackgroundTask) -> str:
     print_status("Preparing device/image partition")
 
-    # Determine rootfs part name
-    rootfs_mnt = f"{mnt_point}3" if write_usb else f"{mnt_point}p3"
-    # remove pre-existing partition table from storage device
-    bash(f"wipefs -af {mnt_point}")
-
-    # format as per depthcharge requirements,
+    # format as per depthcharge requirements, see gpt.py
     # READ: https://wiki.gentoo.org/wiki/Creating_bootable_media_for_depthcharge_based_devices
-    try:
-        bash(f"parted -s {mnt_point} mklabel gpt")
-    # TODO: Only show this prompt when parted throws: "we have been unable to inform the kernel of the change"
-    # TODO: Check if partprob-ing the drive could fix this error
-    except subprocess.CalledProcessError:
-        print_error("Failed to create partition table. Try physically unplugging and replugging the USB/SD-card.")
-        print_question("If you chose the image option or are seeing this message the second time, create an issue on "
-                       "GitHub/Discord/Revolt")
-        sys.exit(1)
-    bash(f"parted -s -a optimal {mnt_point} unit mib mkpart Kernel 1 65")  # kernel partition
-    bash(f"parted -s -a optimal {mnt_point} unit mib mkpart Kernel 65 129")  # reserve kernel partition
-    bash(f"parted -s -a optimal {mnt_point} unit mib mkpart Root 129 100%")  # rootfs partition
-    bash(f"cgpt add -i 1 -t kernel -S 1 -T 5 -P 15 {mnt_point}")  # set kernel flags
-    bash(f"cgpt add -i 2 -t kernel -S 1 -T 5 -P 1 {mnt_point}")  # set backup kernel flags
-
-    # get uuid of rootfs partition
-    rootfs_partuuid = bash(f"blkid -o value -s PARTUUID {rootfs_mnt}")
+    rootfs_partuuid = str(uuid.uuid4())
+    partitions = gpt.write(target, gpt.depthboot_layout(rootfs_partuuid))
     print_status(f"Rootfs partition UUID: {rootfs_partuuid}")
 
     # write PARTUUID to kernel flags and save it as a file
@@ -182,92 +297,136 @@ def partition_and_flash_kernel(mnt_point: str, write_usb: bool, distro_name: str
         config.write(base_string.replace("insert_partuuid", rootfs_partuuid))
 
     print_status("Flashing kernel to device/image")
+    if kernel_task.is_running():
+        print_status("Waiting for kernel download to finish")
+    kernel_task.join()
     # Sign kernel
     bash("futility vbutil_kernel --arch x86_64 --version 1 --keyblock /usr/share/vboot/devkeys/kernel.keyblock"
          + " --signprivate /usr/share/vboot/devkeys/kernel_data_key.vbprivk --bootloader kernel.flags" +
          " --config kernel.flags --vmlinuz /tmp/depthboot-build/bzImage --pack /tmp/depthboot-build/bzImage.signed")
 
-    # Flash kernel
-    if write_usb:
-        # if writing to usb, then no p in partition name
-        bash(f"dd if=/tmp/depthboot-build/bzImage.signed of={mnt_point}1")
-        bash(f"dd if=/tmp/depthboot-build/bzImage.signed of={mnt_point}2")  # Backup kernel
-    else:
-        # image is a loop device -> needs p in part name
-        bash(f"dd if=/tmp/depthboot-build/bzImage.signed of={mnt_point}p1")
-        bash(f"dd if=/tmp/depthboot-build/bzImage.signed of={mnt_point}p2")  # Backup kernel
-
+    # Flash kernel to the kernel partition and the backup kernel partition, at the partition offsets of the image/device
+    with open("/tmp/depthboot-build/bzImage.signed", "rb") as file:
+        signed_kernel = file.read()
+    target_fd = os.open(target, os.O_WRONLY)
+    try:
+        for partition in partitions[:2]:
+            if len(signed_kernel) > partition.end - partition.start:
+                print_error("The signed kernel is larger than the kernel partition")
+                sys.exit(1)
+            os.pwrite(target_fd, signed_kernel, partition.start)
+        os.fsync(target_fd)
+    finally:
+        os.close(target_fd)
+    return rootfs_partuuid
+
+
+def format_and_mount_rootfs(rootfs_part: str) -> None:
     print_status("Formatting rootfs part")
     # Create rootfs ext4 partition
-    bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_mnt}")  # 2>/dev/null is to supress yes broken pipe warning
+    bash(f"yes 2>/dev/null | mkfs.ext4 {rootfs_part}")  # 2>/dev/null is to supress yes broken pipe warning
 
     # Mount rootfs partition
-    bash(f"mount {rootfs_mnt} /mnt/depthboot")
+    bash(f"mount {rootfs_part} {root_path()}")
 
     print_status("Device/image preparation complete")
-    return mnt_point, rootfs_partuuid  # return loop device, so it can be unmounted at the end
 
 
-# extract the rootfs to /mnt/depthboot
-def extract_rootfs(distro_name: str, distro_version: str) -> None:
+# extract the rootfs to the root dir
+# If stream is set, the rootfs is extracted while it's being downloaded instead of from /tmp/depthboot-build
+def extract_rootfs(distro_name: str, distro_version: str, stream: bool = False) -> None:
     print_status("Extracting rootfs")
-    match distro_name:
-        case "arch":
-            print_status("Extracting arch rootfs")
-            mkdir("/tmp/depthboot-build/arch-rootfs")
-            extract_file("/tmp/depthboot-build/arch-rootfs.tar.gz", "/tmp/depthboot-build/arch-rootfs")
-            cpdir("/tmp/depthboot-build/arch-rootfs/root.x86_64/", "/mnt/depthboot/")
-        case "pop-os" | "ubuntu" | "fedora":
-            print_status(f"Extracting {distro_name} rootfs")
-            extract_file(f"/tmp/depthboot-build/{distro_name}-rootfs.tar.xz", "/mnt/depthboot")
+    # The arch bootstrap archive has the rootfs in a root.x86_64 dir -> extract only its contents into the target
+    strip_dir = "root.x86_64" if distro_name == "arch" else ""
+    compression = "gz" if distro_name == "arch" else "xz"
+    if stream:
+        print_status(f"Downloading and extracting {distro_name} rootfs at the same time")
+        try:
+            artifact_cache.fetch_and_extract(rootfs_urls(distro_name, distro_version), root_path(), compression,
+                                             strip_dir)
+        except URLError:
+            print_error("Couldn't download rootfs. Check your internet connection and try again. If the error "
+                        "persists, create an issue with the distro and version in the name")
+            sys.exit(1)
+    else:
+        print_status(f"Extracting {distro_name} rootfs")
+        extract_file(rootfs_paths or rootfs_files(distro_name, distro_version), root_path(), compression, strip_dir)
     print_status("\n" + "Rootfs extraction complete")
 
 
-# Configure distro agnostic options
-def post_extract(build_options) -> None:
-    print_status("Applying distro agnostic configuration")
+# Mount the filesystems needed by the package managers in the chroot
+def mount_chroot_fs() -> None:
     # Create a temporary resolv.conf for internet inside the chroot
-    mkdir("/mnt/depthboot/run/systemd/resolve", create_parents=True)  # dir doesnt exist coz systemd didnt run
-    open("/mnt/depthboot/run/systemd/resolve/stub-resolv.conf", "w").close()  # create empty file for mount
+    mkdir(root_path("/run/systemd/resolve"), create_parents=True)  # dir doesnt exist coz systemd didnt run
+    open(root_path("/run/systemd/resolve/stub-resolv.conf"), "w").close()  # create empty file for mount
     # Bind mount host resolv.conf to chroot resolv.conf.
     # If chroot /etc/resolv.conf is a symlink, then it will be resolved to the real file and bind mounted
     # This is needed for internet inside the chroot
-    bash("mount --bind /etc/resolv.conf /mnt/depthboot/etc/resolv.conf")
+    bash(f"mount --bind /etc/resolv.conf {root_path('/etc/resolv.conf')}")
 
     # the following mounts are mostly unneeded, but will produce a lot of warnings if not mounted
     # even though the resulting image will work as intended and won't have any issues
     # mounting the full directories results in broken host systems -> only mount what's explicitly needed
 
     # systemd needs /proc to not throw warnings
-    bash("mount --types proc /proc /mnt/depthboot/proc")
+    bash(f"mount --types proc /proc {root_path('/proc')}")
 
     # pacman needs the /dev/fd to not throw warnings
     # check if link already exists, if not, create it
-    if not path_exists("/mnt/depthboot/dev/fd"):
-        bash("cd /mnt/depthboot && ln -s /proc/self/fd ./dev/fd")
+    if not path_exists(root_path("/dev/fd")):
+        os.symlink("/proc/self/fd", root_path("/dev/fd"))
 
     # create new /dev/pts for apt to be able to write logs and not throw warnings
-    mkdir("/mnt/depthboot/dev/pts", create_parents=True)
-    bash("mount --types devpts devpts /mnt/depthboot/dev/pts")
+    mkdir(root_path("/dev/pts"), create_parents=True)
+    bash(f"mount --types devpts devpts {root_path('/dev/pts')}")
+
+    # keep downloaded packages on the host instead of in the image
+    if package_cache.is_enabled():
+        package_cache.mount()
+
+
+# Unmount everything mount_chroot_fs mounted. Processes started in the chroot would keep the mounts busy -> kill them.
+def umount_chroot_fs() -> None:
+    close_chroot()
+    kill_chroot_processes()
+    if package_cache.is_enabled():
+        package_cache.umount()
+    for mount in ["/dev/pts", "/proc", "/etc/resolv.conf"]:
+        with contextlib.suppress(subprocess.CalledProcessError):  # not mounted
+            bash(f"umount -l {root_path(mount)}")
 
+
+# In some environments(Crouton), the timezone is not set -> returns an empty string in that case
+def get_host_time_zone() -> str:
+    try:
+        host_time_zone = bash("file /etc/localtime")  # read host timezone link
+    except subprocess.CalledProcessError:
+        return ""
+    return host_time_zone[host_time_zone.find("/usr/share/zoneinfo/"):].strip()  # get actual timezone
+
+
+# Configure distro agnostic options, needs the mounts from mount_chroot_fs
+def post_extract(build_options) -> None:
+    print_status("Applying distro agnostic configuration")
     # create depthboot settings file for postinstall scripts to read
+    # The de is added by configure_de -> this stage is the same for all desktop environments
     with open("configs/eupnea.json", "r") as settings_file:
         settings = json.load(settings_file)
     settings["distro_name"] = build_options["distro_name"]
     settings["distro_version"] = build_options["distro_version"]
-    settings["de_name"] = build_options["de_name"]
     if build_options["device"] != "image":
         settings["install_type"] = "direct"
-    with open("/mnt/depthboot/etc/eupnea.json", "w") as settings_file:
+    with open(root_path("/etc/eupnea.json"), "w") as settings_file:
         json.dump(settings, settings_file)
 
     print_status("Fixing screen rotation")
     # Install hwdb file to fix auto rotate being flipped on some devices
-    cpfile("configs/hwdb/61-sensor.hwdb", "/mnt/depthboot/etc/udev/hwdb.d/61-sensor.hwdb")
+    # Files from the repo belong to the user who cloned it -> don't copy their owner into the image
+    cpfile("configs/hwdb/61-sensor.hwdb", root_path("/etc/udev/hwdb.d/61-sensor.hwdb"), preserve_metadata=False)
     chroot("systemd-hwdb update")
 
     print_status("Cleaning /boot")
-    rmdir("/mnt/depthboot/boot")  # clean stock kernels from /boot
+    rmdir(root_path("/boot"))  # clean stock kernels from /boot
 
     if build_options["distro_name"] == "fedora":
         print_status("Enabling resolved.conf systemd service")
@@ -276,10 +435,10 @@ def post_extract(build_options) -> None:
         chroot("systemctl enable systemd-resolved")
 
     print_status("Configuring user")
-    username = build_options["username"]  # quotes interfere with functions below
-    chroot(f"useradd --create-home --shell /bin/bash {username}")
-    password = build_options["password"]  # quotes interfere with functions below
-    chroot(f"echo '{username}:{password}' | chpasswd")
+    username = build_options["username"]
+    chroot_run(["useradd", "--create-home", "--shell", "/bin/bash", username])
+    # passed on stdin -> the password may contain quotes and other special characters
+    chroot_run(["chpasswd"], input=f"{username}:{build_options['password']}\n")
     match build_options["distro_name"]:
         case "ubuntu" | "pop-os":
             chroot(f"usermod -aG sudo {username}")
@@ -287,61 +446,160 @@ def post_extract(build_options) -> None:
             chroot(f"usermod -aG wheel {username}")
 
     # set timezone build system timezone on device
-    # In some environments(Crouton), the timezone is not set -> ignore in that case
-    with contextlib.suppress(subprocess.CalledProcessError):
-        host_time_zone = bash("file /etc/localtime")  # read host timezone link
-        host_time_zone = host_time_zone[host_time_zone.find("/usr/share/zoneinfo/"):].strip()  # get actual timezone
-        chroot(f"ln -sf {host_time_zone} /etc/localtime")
+    host_time_zone = get_host_time_zone()
+    if host_time_zone:
+        with contextlib.suppress(subprocess.CalledProcessError):
+            chroot(f"ln -sf {host_time_zone} /etc/localtime")
     print_status("Distro agnostic configuration complete")
 
 
+# Add the de to the settings file and install it
+def configure_de(build_options: dict, distro) -> None:
+    with open(root_path("/etc/eupnea.json"), "r") as settings_file:
+        settings = json.load(settings_file)
+    settings["de_name"] = build_options["de_name"]
+    with open(root_path("/etc/eupnea.json"), "w") as settings_file:
+        json.dump(settings, settings_file)
+    distro.config_de(build_options["de_name"], build_options["distro_version"], verbose)
+
+
 # post extract and distro config
 def post_config(de_name: str, distro_name) -> None:
+    config_start = time.time_ns()
     # Enable postinstall service
     print_status("Enabling postinstall service")
     chroot("systemctl enable eupnea-postinstall.service")
 
-    # Fedora requires all files to be relabled for SELinux to work
+    # Fedora requires all files to be labeled for SELinux to work
     # If this is not done, SELinux will prevent users from logging in
+    # With the stage cache, the stages already labeled their files -> only the ones systemctl changed in /etc are left.
+    # Otherwise all files are labeled now, see selinux_labels.py
     if distro_name == "fedora":
-        print_status("Relabeling files for SELinux")
-
-        # The following script needs some specific files in /proc -> unmount /proc
-        bash("umount -lR /mnt/depthboot/proc")
-
-        # copy /proc files needed for fixfiles
-        mkdir("/mnt/depthboot/proc/self")
-        cpfile("configs/selinux/mounts", "/mnt/depthboot/proc/self/mounts")
-        cpfile("configs/selinux/mountinfo", "/mnt/depthboot/proc/self/mountinfo")
-
-        # copy /sys files needed for fixfiles
-        mkdir("/mnt/depthboot/sys/fs/selinux/initial_contexts/", create_parents=True)
-        cpfile("configs/selinux/unlabeled", "/mnt/depthboot/sys/fs/selinux/initial_contexts/unlabeled")
-
-        # Backup original selinux
-        cpfile("/mnt/depthboot/usr/sbin/fixfiles", "/mnt/depthboot/usr/sbin/fixfiles.bak")
-        # Copy patched fixfiles script
-        cpfile("configs/selinux/fixfiles", "/mnt/depthboot/usr/sbin/fixfiles")
-
-        chroot("/sbin/fixfiles -T 0 restore")
+        if not selinux_labels.label_changes(config_start, image_dir="/etc"):
+            print_warning("No SELinux policy found in the image, files were not labeled")
+        selinux_labels.remove_index()
 
-        # Restore original fixfiles
-        cpfile("/mnt/depthboot/usr/sbin/fixfiles.bak", "/mnt/depthboot/usr/sbin/fixfiles")
-        rmfile("/mnt/depthboot/usr/sbin/fixfiles.bak")
-
-    # Unmount everything
-    with contextlib.suppress(subprocess.CalledProcessError):  # will throw errors for unmounted paths
-        bash("umount -lR /mnt/depthboot")  # recursive unmount
+    # Unmount everything inside the rootfs, so that the cleanup doesn't touch the host or the package cache
+    umount_chroot_fs()
 
     # Clean all temporary files from image/sd-card to reduce its size
-    rmdir("/mnt/depthboot/tmp")
-    rmdir("/mnt/depthboot/var/tmp")
-    rmdir("/mnt/depthboot/var/cache")
-    rmdir("/mnt/depthboot/proc")
-    rmdir("/mnt/depthboot/run")
-    rmdir("/mnt/depthboot/sys")
-    rmdir("/mnt/depthboot/lost+found")
-    rmdir("/mnt/depthboot/dev")
+    rmdir(root_path("/tmp"))
+    rmdir(root_path("/var/tmp"))
+    rmdir(root_path("/var/cache"))
+    rmdir(root_path("/proc"))
+    rmdir(root_path("/run"))
+    rmdir(root_path("/sys"))
+    rmdir(root_path("/lost+found"))
+    rmdir(root_path("/dev"))
+
+
+# The build stages in order and the inputs their results depend on, besides the previous stages
+# Everything before the de stage is the same for all desktop environments of a distro.
+def build_stages(build_options: dict) -> list:
+    return [
+        ("rootfs", {"distro_name": build_options["distro_name"], "distro_version": build_options["distro_version"]}),
+        ("post_extract", {"username": build_options["username"], "password": build_options["password"],
+                          "install_type": "image" if build_options["device"] == "image" else "direct",
+                          "time_zone": get_host_time_zone()}),
+        ("base", {"kernel_type": build_options["kernel_type"]}),
+        ("de", {"de_name": build_options["de_name"]})
+    ]
+
+
+# Returns the stage cache keys of all stages, empty if the rootfs digest is unknown
+def stage_keys(stages: list, rootfs_digest: str) -> list:
+    if not rootfs_digest:
+        return []
+    keys = []
+    parent_key = ""
+    for stage_name, inputs in stages:
+        if stage_name == "rootfs":
+            inputs = inputs | {"rootfs_digest": rootfs_digest}
+        parent_key = stage_cache.layer_key(parent_key, stage_name, inputs)
+        keys.append(parent_key)
+    return keys
+
+
+# Returns the sha256 of the rootfs archive without downloading it, empty if unknown
+def get_rootfs_digest(build_options: dict, args: argparse.Namespace) -> str:
+    if args.local_path is not None:
+        file_name = "arch-rootfs.tar.gz" if build_options["distro_name"] == "arch" else \
+            f"{build_options['distro_name']}-rootfs.tar.xz"
+        local_file = f"{args.local_path.removesuffix('/')}/{file_name}"
+        if path_exists(local_file):
+            return artifact_cache.sha256_file(local_file)
+    try:
+        hashes = [artifact_cache.cached_hash(url) for url in rootfs_urls(build_options["distro_name"],
+                                                                         build_options["distro_version"])]
+    except URLError:
+        return ""
+    return "" if "" in hashes else ",".join(hashes)
+
+
+def run_stage(stage_name: str, build_options: dict, args: argparse.Namespace, distro,
+              rootfs_task: BackgroundTask | None, stream_rootfs: bool) -> None:
+    match stage_name:
+        case "rootfs":
+            if rootfs_task is not None:
+                if rootfs_task.is_running():
+                    print_status("Waiting for rootfs download to finish")
+                rootfs_task.join()
+            extract_rootfs(build_options["distro_name"], build_options["distro_version"], stream_rootfs)
+        case "post_extract":
+            post_extract(build_options)
+        case "base" | "de":
+            stage_start = time.time_ns()
+            if args.package_proxy:
+                package_proxy.inject(build_options["distro_name"])
+            if args.unsafe_io:
+                unsafe_io.enable(build_options["distro_name"])
+            try:
+                if stage_name == "base":
+                    distro.config_base(build_options["distro_version"], verbose, build_options["kernel_type"])
+                else:
+                    configure_de(build_options, distro)
+                # label the files of the stage while the stage cache can still keep the labels in the layer
+                if build_options["distro_name"] == "fedora" and stage_cache.upper_dir:
+                    selinux_labels.label_changes(stage_start, stage_cache.upper_dir)
+            finally:
+                # never leave the proxy or unsafe io config in the image, even if the distro config failed
+                if args.package_proxy:
+                    package_proxy.remove(build_options["distro_name"])
+                if args.unsafe_io:
+                    unsafe_io.disable(build_options["distro_name"])
+
+
+# Run the stages on overlays, reusing the first cached_stages layers, then copy the result onto the rootfs partition
+def run_cached_stages(stages: list, layer_keys: list, cached_stages: int, build_options: dict, args: argparse.Namespace,
+                      distro, rootfs_task: BackgroundTask | None, stream_rootfs: bool) -> None:
+    stage_cache.prepare_target()
+    layers = [stage_cache.layer_path(key) for key in layer_keys[:cached_stages]]
+    for index, (stage_name, _) in enumerate(stages):
+        if index < cached_stages:
+            print_status(f"Using cached {stage_name} stage")
+            continue
+        stage_cache.begin_stage(layers)
+        try:
+            if stage_name != "rootfs":  # the mount points only exist after extracting the rootfs
+                mount_chroot_fs()
+            run_stage(stage_name, build_options, args, distro, rootfs_task, stream_rootfs)
+        finally:
+            umount_chroot_fs()
+        if not layer_keys:
+            # The rootfs wasn't cached before this build -> it is now
+            layer_keys = stage_keys(stages, get_rootfs_digest(build_options, args))
+        layers.append(stage_cache.finish_stage(layer_keys[index] if layer_keys else "",
+                                               layer_keys[index - 1] if layer_keys and index else "", stage_name))
+    stage_cache.flatten(layers)
+    mount_chroot_fs()
+
+
+# Write the block map of the image next to it. The free space of the rootfs doesn't have to be flashed, see bmap.py.
+# Needs the loop device, the rootfs partition has to be unmounted for its free blocks to be final.
+def generate_bmap(image_name: str) -> None:
+    with open(f"/sys/class/block/{os.path.basename(img_mnt)}p3/start", "r") as file:
+        rootfs_offset = int(file.read()) * 512
+    bmap.generate(f"./{image_name}", "./depthboot.bmap", bmap.ext4_free_ranges(f"{img_mnt}p3", rootfs_offset))
 
 
 # The main build script
@@ -352,53 +610,18 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
     print(args)
     if args.download_progress:
         disable_download_progress()  # disable download progress bar for non-interactive shells
+    elif args.progress_json:
+        progress.set_mode("json")  # machine-readable progress for CI logs and frontends
     set_verbose(args.verbose)
+    set_work_dir(args.work_dir)
     atexit.register(exit_handler)
     print_status("Starting build")
 
-    if args.local_path is None:  # default
-        download_kernel(build_options["kernel_type"], args.dev_build)
-        download_rootfs(build_options["distro_name"], build_options["distro_version"])
-    else:  # if local path is specified, copy files from it, instead of downloading from the internet
-        print_status("Copying local files to /tmp/depthboot-build")
-        # clean local path string
-        local_path_posix = args.local_path if args.local_path.endswith("/") else f"{args.local_path}/"
-        # copy kernel files
-        kernel_files = ["bzImage", "modules.tar.xz", "headers.tar.xz", ]
-        for file in kernel_files:
-            try:
-                cpfile(f"{local_path_posix}{file}", f"/tmp/depthboot-build/{file}")
-            except FileNotFoundError:
-                print_warning(f"File {file} not found in {args.local_path}, attempting to download")
-                download_kernel(build_options["kernel_type"], args.dev_build, [file])
-
-        # copy distro rootfs
-        distro_rootfs = {
-            # distro_name:[cp function type,filename]
-            "ubuntu": [cpfile, "ubuntu-rootfs.tar.xz"],
-            "arch": [cpfile, "arch-rootfs.tar.gz"],
-            "fedora": [cpfile, "fedora-rootfs.tar.xz"],
-            "pop-os": [cpfile, "pop-os-rootfs.tar.xz"],
-        }
-        try:
-            distro_rootfs[build_options["distro_name"]][0](
-                f"{local_path_posix}{distro_rootfs[build_options['distro_name']][1]}",
-                f"/tmp/depthboot-build/{distro_rootfs[build_options['distro_name']][1]}")
-        except FileNotFoundError:
-            print_warning(f"File {distro_rootfs[build_options['distro_name']][1]} not found in {args.local_path}, "
-                          f"attempting to download")
-            download_rootfs(build_options["distro_name"], build_options["distro_version"])
-
-    # Setup device
-    if build_options["device"] == "image":
-        output_temp = prepare_img(build_options["distro_name"], args.image_size[0], args.verbose_kernel)
-    else:
-        output_temp = prepare_usb_sd(build_options["device"], build_options["distro_name"], args.verbose_kernel)
-    global img_mnt
-    img_mnt = output_temp[0]
-    # Extract rootfs and configure distro agnostic settings
-    extract_rootfs(build_options["distro_name"], build_options["distro_version"])
-    post_extract(build_options)
+    if not args.no_cache:
+        artifact_cache.configure(args.cache_dir, args.cache_size)
+    if args.package_cache:
+        package_cache.configure(f"{args.cache_dir}/archives", args.package_cache_size, build_options["distro_name"],
+                                build_options["distro_version"])
 
     match build_options["distro_name"]:
         case "ubuntu":
@@ -412,29 +635,115 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
         case _:
             print_error("DISTRO NAME NOT FOUND! Please create an issue")
             sys.exit(1)
-    distro.config(build_options["de_name"], build_options["distro_version"], verbose, build_options["kernel_type"])
+
+    if not args.no_mirror_ranking:
+        # the results are kept with the download cache
+        mirrors.configure("" if args.no_cache else f"{args.cache_dir}/mirrors.json")
+    if not args.no_prefetch:
+        # the packages of both package stages are downloaded as soon as the base stage has refreshed the repos
+        prefetch.configure(build_options["distro_name"],
+                           package_plan.base_transactions(build_options["distro_name"], build_options["kernel_type"]) +
+                           package_plan.de_transactions(build_options["distro_name"], build_options["de_name"],
+                                                        build_options["distro_version"]))
+
+    # Find the cached stages before starting the downloads, the rootfs isn't needed if it's already in a layer
+    stages = build_stages(build_options)
+    use_stage_cache = args.stage_cache and not (args.no_cache and args.local_path is None)
+    if args.stage_cache and not use_stage_cache:
+        print_warning("The stage cache needs the download cache to identify the rootfs, stage cache disabled")
+    layer_keys = []
+    cached_stages = 0
+    if use_stage_cache:
+        stage_cache.configure(f"{args.cache_dir}/stages", args.stage_cache_age)
+        layer_keys = stage_keys(stages, get_rootfs_digest(build_options, args))
+        while cached_stages < len(layer_keys) and stage_cache.has_layer(layer_keys[cached_stages]):
+            cached_stages += 1
+
+    # The downloads are network-bound, preparing the image/device is subprocess-bound -> run them at the same time.
+    # The kernel is only needed for signing and the rootfs only for extraction.
+    # In streaming mode the rootfs is downloaded during extraction instead
+    stream_rootfs = args.stream_rootfs and args.local_path is None
+    kernel_task = BackgroundTask(get_kernel, build_options, args)
+    rootfs_task = None if stream_rootfs or cached_stages else BackgroundTask(get_rootfs, build_options, args)
+
+    # --exact-size only applies to images, USB/SD-cards are always partitioned to their full size
+    exact_size = args.exact_size and build_options["device"] == "image"
+    if args.exact_size and not exact_size:
+        print_warning("--exact-size only works when building an image, ignoring it")
+
+    # Setup device
+    # With --build-in-image the USB/SD-card is only written at the end, in one sequential pass. Flash storage is a lot
+    # faster at sequential writes than at the small random writes of the package managers. The image gets the size of
+    # the device -> the partitions fill the whole device. It's sparse and the free space is never written.
+    stream_device = ""
+    if build_options["device"] != "image" and args.build_in_image:
+        stream_device = get_device_path(build_options["device"])
+        umount_device(stream_device)
+        with open(stream_device, "rb") as device:
+            device_size = device.seek(0, os.SEEK_END)
+        output_temp = prepare_img(build_options["distro_name"], args.image_size[0], args.verbose_kernel, kernel_task,
+                                  sparse_size=device_size)
+    elif exact_size:
+        # the stages run in the plain root dir, the image is only created once the rootfs is complete
+        print_status(f"Building in {root_path()}, the image is created at the end")
+        output_temp = ("", "")
+    elif build_options["device"] == "image":
+        output_temp = prepare_img(build_options["distro_name"], args.image_size[0], args.verbose_kernel, kernel_task)
+    else:
+        output_temp = prepare_usb_sd(build_options["device"], build_options["distro_name"], args.verbose_kernel,
+                                     kernel_task)
+    global img_mnt
+    img_mnt = output_temp[0]
+
+    if args.package_proxy:
+        package_proxy.start(f"{args.cache_dir}/packages", args.package_proxy_size)
+    try:
+        if use_stage_cache:
+            run_cached_stages(stages, layer_keys, cached_stages, build_options, args, distro, rootfs_task,
+                              stream_rootfs)
+        else:
+            for stage_name, _ in stages:
+                run_stage(stage_name, build_options, args, distro, rootfs_task, stream_rootfs)
+                if stage_name == "rootfs":
+                    mount_chroot_fs()
+    finally:
+        if args.package_proxy:
+            package_proxy.stop()
 
     post_config(build_options["de_name"], build_options["distro_name"])
+    if package_cache.is_enabled():
+        package_cache.prune()
 
     print_status("Unmounting image/device")
 
     bash("sync")  # write all pending changes to usb
 
-    # unmount image/device completely from system
+    # unmount image/device completely from system, the rootfs partition is the only mounted one
     # on crostini umount fails for some reason
     with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lR {img_mnt}p*")  # umount all partitions from image
-    with contextlib.suppress(subprocess.CalledProcessError):
-        bash(f"umount -lR {img_mnt}*")  # umount all partitions from usb/sd-card
+        bash(f"umount -R {root_path()}")
 
-    if build_options["device"] == "image":
+    if stream_device:
+        # no shrinking needed, the free space of the rootfs isn't written to the device anyway
+        generate_bmap("depthboot.img")
+        bash(f"losetup -d {img_mnt}")  # unmount image from loop device
+        bash(f"wipefs -af {stream_device}")  # old signatures outside of the mapped blocks would confuse blkid
+        bmap.flash("./depthboot.img", "./depthboot.bmap", stream_device, discard=True)
+        rmfile("depthboot.img")
+        rmfile("depthboot.bmap")
+        print_header(f"USB/SD-card is ready to boot {build_options['distro_name'].capitalize()}")
+        print_header("It is safe to remove the USB-drive/SD-card now.")
+    elif build_options["device"] == "image":
         try:
             with open("/sys/devices/virtual/dmi/id/product_name", "r") as file:
                 product_name = file.read().strip()
         except FileNotFoundError:  # WSL doesnt have dmi data
             product_name = ""
+        if exact_size:
+            img_mnt = prepare_exact_size_img(build_options["distro_name"], args.exact_size_headroom,
+                                             args.verbose_kernel, kernel_task)
         # TODO: Fix shrinking on Crostini
-        if product_name != "crosvm" and not args.no_shrink:
+        elif product_name != "crosvm" and not args.no_shrink:
             # Shrink image to actual size
             print_status("Shrinking image")
             bash(f"e2fsck -fpv {img_mnt}p3")  # Force check filesystem for errors
@@ -446,13 +755,17 @@ def start_build(build_options: dict, args: argparse.Namespace) -> None:
             actual_fs_in_bytes += 134217728
             actual_fs_in_bytes += 20971520  # add 20mb for linux to be able to boot properly
             bash(f"truncate --size={actual_fs_in_bytes} ./depthboot.img")
+        image_name = "depthboot.img"
         if product_name == "crosvm":
             # rename the image to .bin for the chromeos recovery utility to be able to flash it
             bash("mv ./depthboot.img ./depthboot.bin")
+            image_name = "depthboot.bin"
 
+        generate_bmap(image_name)
         bash(f"losetup -d {img_mnt}")  # unmount image from loop device
         print_header(f"The ready-to-boot {build_options['distro_name'].capitalize()} Depthboot image is located at "
-                     f"{get_full_path('.')}/depthboot.img")
+                     f"{get_full_path('.')}/{image_name}")
+        print_header(f'Flash it with "./main.py flash <device>", which only writes the blocks that contain data')
     else:
         print_header(f"USB/SD-card is ready to boot {build_options['distro_name'].capitalize()}")
         print_header("It is safe to remove the USB-drive/SD-card now.")
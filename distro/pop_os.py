@@ -1,8 +1,11 @@
 from functions import *
+import package_plan
+import prefetch
 from urllib.request import urlretrieve
 
 
-def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str) -> None:
+# Base system setup, the same for all desktop environments
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> None:
     set_verbose(verbose)
     print_status("Configuring Pop!_OS")
 
@@ -12,35 +15,34 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
            " libinih1 libnss-mymachines localechooser-data os-prober pop-installer pop-installer-casper pop-shop-casper"
            " squashfs-tools systemd-container tcl-expect user-setup xfsprogs kernelstub efibootmgr")
     # Add eupnea repo
-    mkdir("/mnt/depthboot/usr/local/share/keyrings", create_parents=True)
+    mkdir(root_path("/usr/local/share/keyrings"), create_parents=True)
     # download public key
     urlretrieve("https://eupnea-linux.github.io/apt-repo/public.key",
-                filename="/mnt/depthboot/usr/local/share/keyrings/eupnea.key")
-    with open("/mnt/depthboot/etc/apt/sources.list.d/eupnea.list", "w") as file:
+                filename=root_path("/usr/local/share/keyrings/eupnea.key"))
+    with open(root_path("/etc/apt/sources.list.d/eupnea.list"), "w") as file:
         file.write("deb [signed-by=/usr/local/share/keyrings/eupnea.key] https://eupnea-linux.github.io/"
                    "apt-repo/debian_ubuntu jammy main")
     # update apt
     chroot("apt-get update -y")
+    # download the packages of the following transactions while the system is upgraded, see prefetch.py
+    prefetch.start()
     chroot("apt-get upgrade -y")
-    # Install eupnea packages
-    chroot("apt-get install -y eupnea-utils eupnea-system keyd")
+    # Install eupnea packages and the kernel
+    package_plan.run("pop-os", package_plan.base_transactions("pop-os", kernel_version))
 
-    # Install kernel
-    if kernel_version == "mainline":
-        chroot("apt-get install -y eupnea-mainline-kernel")
-    elif kernel_version == "chromeos":
-        chroot("apt-get install -y eupnea-chromeos-kernel")
 
+# Pop!_OS only comes with its own gnome based desktop -> de_name is ignored
+def config_de(de_name: str, distro_version: str, verbose: bool) -> None:
+    set_verbose(verbose)
     # Replace input-synaptics with newer input-libinput, for better touchpad support
     print_status("Upgrading touchpad drivers")
-    chroot("apt-get remove -y xserver-xorg-input-synaptics")
-    chroot("apt-get install -y xserver-xorg-input-libinput")
+    package_plan.run("pop-os", package_plan.de_transactions("pop-os", de_name, distro_version))
 
     # Enable wayland
     print_status("Enabling Wayland")
-    with open("/mnt/depthboot/etc/gdm3/custom.conf", "r") as file:
+    with open(root_path("/etc/gdm3/custom.conf"), "r") as file:
         gdm_config = file.read()
-    with open("/mnt/depthboot/etc/gdm3/custom.conf", "w") as file:
+    with open(root_path("/etc/gdm3/custom.conf"), "w") as file:
         file.write(gdm_config.replace("WaylandEnable=false", "#WaylandEnable=false"))
     # TODO: Set wayland as default
 
@@ -1,10 +1,14 @@
 import contextlib
-from urllib.request import urlretrieve
+from urllib.request import urlopen, urlretrieve
 import os
 from functions import *
+import mirrors
+import package_plan
+import prefetch
 
 
-def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str) -> None:
+# Base system setup, the same for all desktop environments
+def config_base(distro_version: str, verbose: bool, kernel_version: str) -> None:
     set_verbose(verbose)
     print_status("Configuring Ubuntu")
 
@@ -16,7 +20,7 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
         "22.10": "kinetic"
     }
     # add missing apt sources
-    with open("/mnt/depthboot/etc/apt/sources.list", "a") as file:
+    with open(root_path("/etc/apt/sources.list"), "a") as file:
         file.write(f"\ndeb http://archive.ubuntu.com/ubuntu {ubuntu_versions_codenames[distro_version]}-backports main "
                    "restricted universe multiverse\n")
         file.write(f"\ndeb http://security.ubuntu.com/ubuntu {ubuntu_versions_codenames[distro_version]}-security main"
@@ -24,27 +28,37 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
         file.write(f"\ndeb http://archive.ubuntu.com/ubuntu {ubuntu_versions_codenames[distro_version]}-updates main "
                    f"restricted universe multiverse\n")
 
+    # Use the fastest archive mirror during the build, see mirrors.py. The original sources.list is backed up, as it's
+    # only restored at the end of config_de. The security repo is always used directly.
+    fastest_mirrors = []
+    if mirrors.enabled:  # don't ask the mirror service if ranking is disabled
+        fastest_mirrors = mirrors.rank(["http://archive.ubuntu.com/ubuntu/"] + get_archive_mirrors(),
+                                       f"dists/{ubuntu_versions_codenames[distro_version]}/Release", 1)
+    if fastest_mirrors and fastest_mirrors[0] != "http://archive.ubuntu.com/ubuntu/":
+        cpfile(root_path("/etc/apt/sources.list"), root_path("/etc/apt/sources.list.bak"))
+        with open(root_path("/etc/apt/sources.list"), "r") as file:
+            sources = file.read()
+        with open(root_path("/etc/apt/sources.list"), "w") as file:
+            # the mirror is needed again when restoring the sources
+            file.write(f"## Mirror during the build: {fastest_mirrors[0]}\n")
+            file.write(sources.replace("http://archive.ubuntu.com/ubuntu", fastest_mirrors[0].rstrip("/")))
+
     print_status("Installing dependencies")
     # Add eupnea repo
-    mkdir("/mnt/depthboot/usr/local/share/keyrings", create_parents=True)
+    mkdir(root_path("/usr/local/share/keyrings"), create_parents=True)
     # download public key
     urlretrieve("https://eupnea-linux.github.io/apt-repo/public.key",
-                filename="/mnt/depthboot/usr/local/share/keyrings/eupnea.key")
-    with open("/mnt/depthboot/etc/apt/sources.list.d/eupnea.list", "w") as file:
+                filename=root_path("/usr/local/share/keyrings/eupnea.key"))
+    with open(root_path("/etc/apt/sources.list.d/eupnea.list"), "w") as file:
         file.write("deb [signed-by=/usr/local/share/keyrings/eupnea.key] https://eupnea-linux.github.io/"
                    f"apt-repo/debian_ubuntu {ubuntu_versions_codenames[distro_version]} main")
     # update apt
     chroot("apt-get update -y")
+    # download the packages of the following transactions while the system is upgraded, see prefetch.py
+    prefetch.start()
     chroot("apt-get upgrade -y")
-    # Install general dependencies + eupnea packages
-    chroot("apt-get install -y linux-firmware network-manager software-properties-common nano eupnea-utils "
-           "eupnea-system")
-
-    # Install kernel
-    if kernel_version == "mainline":
-        chroot("apt-get install -y eupnea-mainline-kernel")
-    elif kernel_version == "chromeos":
-        chroot("apt-get install -y eupnea-chromeos-kernel")
+    # Install general dependencies, eupnea packages and the kernel
+    package_plan.run("ubuntu", package_plan.base_transactions("ubuntu", kernel_version))
 
     print_status("Installing zram, ignore dpkg errors")
     # Install zram
@@ -52,83 +66,68 @@ def config(de_name: str, distro_version: str, verbose: bool, kernel_version: str
     with contextlib.suppress(subprocess.CalledProcessError):
         chroot("apt-get install -y systemd-zram-generator")
     # Edit the postinstall script to force success
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "r") as file:
+    with open(root_path("/var/lib/dpkg/info/systemd-zram-generator.postinst"), "r") as file:
         config = file.read()
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
+    with open(root_path("/var/lib/dpkg/info/systemd-zram-generator.postinst"), "w") as file:
         file.write("#!/bin/sh\nexit 0\n")
     # Rerun dpkg configuration for package to be recognized as installed
     # for some reason on some systems dpkg says that the package is already installed -> ignore it
     with contextlib.suppress(subprocess.CalledProcessError):
         chroot("dpkg --configure systemd-zram-generator")
     # Restore postinstall script
-    with open("/mnt/depthboot/var/lib/dpkg/info/systemd-zram-generator.postinst", "w") as file:
+    with open(root_path("/var/lib/dpkg/info/systemd-zram-generator.postinst"), "w") as file:
         file.write(config)
 
-    print_status("Downloading and installing de, might take a while")
-    match de_name:
-        case "gnome":
-            print_status("Installing GNOME")
-            chroot("apt-get install -y ubuntu-desktop gnome-software epiphany-browser wireplumber")
-        case "kde":
-            print_status("Installing KDE")
-            chroot("DEBIAN_FRONTEND=noninteractive apt-get install -y kde-standard plasma-workspace-wayland "
-                   "sddm-theme-breeze wireplumber")
-        case "xfce":
-            print_status("Installing Xfce")
-            # install xfce without heavy unnecessary packages
-            chroot("apt-get install -y xubuntu-desktop gimp- gnome-font-viewer- gnome-mines- gnome-sudoku- gucharmap-"
-                   " hexchat- libreoffice-*- mate-calc- pastebinit- synaptic- thunderbird- transmission-gtk-")
-            chroot("apt-get install -y nano gnome-software epiphany-browser")
-        case "lxqt":
-            print_status("Installing LXQt")
-            chroot("apt-get install -y lubuntu-desktop discover konqueror")
-        case "deepin":
-            print_status("Installing deepin")
-            chroot("add-apt-repository -y ppa:ubuntudde-dev/stable")
-            chroot("apt-get update -y")
-            with contextlib.suppress(subprocess.CalledProcessError):
-                chroot("apt-get install -y ubuntudde-dde")
-            # remove dpkg deepin-anything files to avoid dpkg errors
-            # These are later reinstated by the postinstall script
-            for file in os.listdir("/mnt/depthboot/var/lib/dpkg/info/"):
-                if file.startswith("deepin-anything-"):
-                    rmfile(f"/mnt/depthboot/var/lib/dpkg/info/{file}")
-            chroot("apt-get install -y discover konqueror")
-        case "budgie":
-            print_status("Installing Budgie")
-            # do not install tex-common, it breaks the installation
-            chroot("DEBIAN_FRONTEND=noninteractive apt-get install -y lightdm lightdm-gtk-greeter ubuntu-budgie-desktop"
-                   " tex-common-")
-        case "cinnamon":
-            print_status("Installing Cinnamon")
-            chroot("apt-get install -y cinnamon-desktop-environment")
-        case "cli":
-            print_status("Skipping desktop environment install")
-        case _:
-            print_error("Invalid desktop environment! Please create an issue")
-            exit(1)
 
-    if de_name != "cli":
-        # Replace input-synaptics with newer input-libinput, for better touchpad support
-        print_status("Upgrading touchpad drivers")
-        chroot("apt-get remove -y xserver-xorg-input-synaptics")
-        chroot("apt-get install -y xserver-xorg-input-libinput")
-        print_status("Installing keyd")
-        chroot("apt-get install -y keyd")
+# Returns the archive mirrors close to the build machine, according to the Ubuntu mirror service
+def get_archive_mirrors() -> list:
+    try:
+        with urlopen("http://mirrors.ubuntu.com/mirrors.txt", timeout=10) as response:
+            return [line.strip() for line in response.read().decode().split("\n") if line.startswith("http")]
+    except OSError:  # includes URLError and timeouts
+        return []
 
-        # Install libasound2 backport on jammy
-        if distro_version == "22.04":
-            chroot("apt-get install -y libasound2-eupnea")
+
+def config_de(de_name: str, distro_version: str, verbose: bool) -> None:
+    set_verbose(verbose)
+    print_status("Downloading and installing de, might take a while")
+    # The de, touchpad drivers and keyd are installed in one transaction, see package_plan.py
+    transactions = package_plan.de_transactions("ubuntu", de_name, distro_version)
+    if de_name == "deepin":
+        chroot("add-apt-repository -y ppa:ubuntudde-dev/stable")
+        chroot("apt-get update -y")
+        with contextlib.suppress(subprocess.CalledProcessError):
+            package_plan.run("ubuntu", transactions[:1])
+        # remove dpkg deepin-anything files to avoid dpkg errors
+        # These are later reinstated by the postinstall script
+        for file in os.listdir(root_path("/var/lib/dpkg/info/")):
+            if file.startswith("deepin-anything-"):
+                rmfile(root_path(f"/var/lib/dpkg/info/{file}"))
+        transactions = transactions[1:]
+    package_plan.run("ubuntu", transactions)
 
     # GDM3 auto installs gnome-minimal. Gotta remove it if user didn't choose gnome
     if de_name != "gnome":
-        rmfile("/mnt/depthboot/usr/share/xsessions/ubuntu.desktop")
+        rmfile(root_path("/usr/share/xsessions/ubuntu.desktop"))
         chroot("apt-get remove -y gnome-shell")
         chroot("apt-get autoremove -y")
 
     # Fix gdm3, https://askubuntu.com/questions/1239503/ubuntu-20-04-and-20-10-etc-securetty-no-such-file-or-directory
     with contextlib.suppress(FileNotFoundError):
-        cpfile("/mnt/depthboot/usr/share/doc/util-linux/examples/securetty", "/mnt/depthboot/etc/securetty")
+        cpfile(root_path("/usr/share/doc/util-linux/examples/securetty"), root_path("/etc/securetty"))
     print_status("Desktop environment setup complete")
 
+    # Restore the apt sources, if a mirror was used during the build
+    if path_exists(root_path("/etc/apt/sources.list.bak")):
+        with open(root_path("/etc/apt/sources.list"), "r") as file:
+            mirror = file.readline().split(":", 1)[1].strip()
+        cpfile(root_path("/etc/apt/sources.list.bak"), root_path("/etc/apt/sources.list"))
+        rmfile(root_path("/etc/apt/sources.list.bak"))
+        # the package lists of the mirror would only waste space, apt downloads the lists of the archive on the next
+        # update anyway. List files are named after the url without the scheme, with _ instead of /
+        list_prefix = mirror.split("://", 1)[1].rstrip("/").replace("/", "_") + "_"
+        for file in os.listdir(root_path("/var/lib/apt/lists")):
+            if file.startswith(list_prefix):
+                rmfile(root_path(f"/var/lib/apt/lists/{file}"))
+
     print_status("Ubuntu setup complete")
@@ -1,12 +1,37 @@
+import abc
+import base64
 import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
+import signal
 import subprocess
+import sys
+import time
 from pathlib import Path
-from threading import Thread
+from queue import Empty, Queue
+from threading import Event, Lock, Thread
 from time import sleep
-from urllib.request import urlopen, urlretrieve
+from typing import Tuple, Union
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen, urlretrieve
+
+import progress
 
 verbose = False
-no_download_progress = False
+download_connections = 4  # initial amount of parallel connections per download
+max_download_connections = 16
+download_chunk_size = 16777216  # 16mb
+download_retries = 3  # per chunk
+copy_workers = 8  # parallel file copies in cpdir
+FICLONE = 0x40049409  # ioctl to create a reflink copy, from linux/fs.h
+# the image/device is mounted here, a dir of its own in the work dir. Use root_path() in other modules.
+root_dir = "/mnt/depthboot/rootfs"
 
 
 #######################################################################################
@@ -63,53 +88,137 @@ def get_full_path(path_str: str) -> str:
     return Path(path_str).absolute().as_posix()
 
 
-# recursively copy files from a dir into another dir
-def cpdir(src_as_str: str, dst_as_string: str) -> None:  # dst_dir must be a full path, including the new dir name
-    def copy_files(src: Path, dst: Path) -> None:
-        # create dst dir if it doesn't exist
-        if verbose:
-            print(f"Copying {src} to {dst}")
-        mkdir(dst.absolute().as_posix(), create_parents=True)
-        for src_file in src.iterdir():
-            if src_file.is_file():
-                dst_file = dst.joinpath(src_file.stem + src_file.suffix)
-                dst_file.write_bytes(src_file.read_bytes())
-            elif src_file.is_dir():
-                if src_file.exists():
-                    new_dst = dst.joinpath(src_file.stem + src_file.suffix)
-                    copy_files(src_file, new_dst)
-                else:
-                    raise FileNotFoundError(f"No such file or directory: {src_file.absolute().as_posix()}")
-
-    src_as_path = Path(src_as_str)
-    dst_as_path = Path(dst_as_string)
-    if src_as_path.exists():
-        if not dst_as_path.exists():
-            mkdir(dst_as_string)
-        # TODO: Fix python copy dir
-        '''
-        try:
-            copy_files(src_as_path, dst_as_path)
-        except RecursionError:
-            print("\033[93m" + f"Failed to copy {root_src} to {root_dst}, using bash" + "\033[0m")
-            bash(f"cp -rp {src_as_path.absolute().as_posix()} {dst_as_path.absolute().as_posix()}")
-        '''
-        bash(f"cp -rp {src_as_path.absolute().as_posix()}/* {dst_as_path.absolute().as_posix()}")
-    else:
-        raise FileNotFoundError(f"No such directory: {src_as_path.absolute().as_posix()}")
+# return the host path of a path in the image, e.g. "/etc/fstab" -> "/mnt/depthboot/etc/fstab"
+def root_path(path_in_image: str = "") -> str:
+    return f"{root_dir}{path_in_image}"
 
 
-def cpfile(src_as_str: str, dst_as_str: str) -> None:  # "/etc/resolv.conf", "/var/some_config/resolv.conf"
+# recursively copy the contents of a dir (including dotfiles) into another dir
+# Files are copied by a pool of worker threads. With preserve_metadata the owner, mode, timestamps and xattrs (including
+# SELinux labels) are copied as well, otherwise new files are owned by root like any other new file.
+def cpdir(src_as_str: str, dst_as_string: str, preserve_metadata: bool = True) -> None:
+    src_root = get_full_path(src_as_str)
+    dst_root = get_full_path(dst_as_string)
+    if not Path(src_root).is_dir():
+        raise FileNotFoundError(f"No such directory: {src_root}")
+    if verbose:
+        print(f"Copying {src_root} to {dst_root}")
+    mkdir(dst_root, create_parents=True)
+
+    jobs = Queue(maxsize=copy_workers * 4)  # bounded -> the dir walk doesn't run far ahead of the copies
+    errors = []
+
+    def _copy_worker() -> None:
+        while (job := jobs.get()) is not None:
+            if errors:
+                continue  # drain the queue
+            try:
+                _copy_file(*job, preserve_metadata)
+            except BaseException as e:
+                errors.append(e)
+
+    workers = [Thread(target=_copy_worker, daemon=True) for _ in range(copy_workers)]
+    for worker in workers:
+        worker.start()
+
+    copied_inodes = {}  # (st_dev, st_ino) -> first copy, to recreate hardlinks
+    dirs = []
+    try:
+        pending_dirs = [(src_root, dst_root)]
+        while pending_dirs and not errors:
+            src_dir, dst_dir = pending_dirs.pop()
+            dirs.append((src_dir, dst_dir))
+            with os.scandir(src_dir) as entries:
+                for entry in entries:
+                    dst_path = f"{dst_dir}/{entry.name}"
+                    entry_stat = entry.stat(follow_symlinks=False)
+                    if entry.is_dir(follow_symlinks=False):
+                        mkdir(dst_path)
+                        pending_dirs.append((entry.path, dst_path))
+                        continue
+                    if os.path.lexists(dst_path):
+                        os.unlink(dst_path)
+                    if entry.is_symlink():
+                        os.symlink(os.readlink(entry.path), dst_path)
+                        if preserve_metadata:
+                            _copy_metadata(entry.path, dst_path, entry_stat)
+                    elif not entry.is_file(follow_symlinks=False):  # device files, fifos, sockets
+                        os.mknod(dst_path, entry_stat.st_mode, entry_stat.st_rdev)
+                        if preserve_metadata:
+                            _copy_metadata(entry.path, dst_path, entry_stat)
+                    elif entry_stat.st_nlink > 1:
+                        inode = (entry_stat.st_dev, entry_stat.st_ino)
+                        if inode in copied_inodes:
+                            os.link(copied_inodes[inode], dst_path)
+                        else:
+                            # copied right away, the following links need the file to exist
+                            _copy_file(entry.path, dst_path, entry_stat, preserve_metadata)
+                            copied_inodes[inode] = dst_path
+                    else:
+                        jobs.put((entry.path, dst_path, entry_stat))
+    finally:
+        for _ in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+    if errors:
+        raise errors[0]
+
+    # Creating files changes the timestamps of a dir -> apply the dir metadata last, deepest dirs first
+    if preserve_metadata:
+        for src_dir, dst_dir in reversed(dirs):
+            _copy_metadata(src_dir, dst_dir, os.stat(src_dir, follow_symlinks=False))
+
+
+# copy a single file. The destination is overwritten if it exists, see cpdir for preserve_metadata
+def cpfile(src_as_str: str, dst_as_str: str, preserve_metadata: bool = True) -> None:
     src_as_path = Path(src_as_str)
     dst_as_path = Path(dst_as_str)
     if verbose:
         print(f"Copying {src_as_path.absolute().as_posix()} to {dst_as_path.absolute().as_posix()}")
     if src_as_path.exists():
-        dst_as_path.write_bytes(src_as_path.read_bytes())
+        _copy_file(src_as_path.absolute().as_posix(), dst_as_path.absolute().as_posix(), os.stat(src_as_path),
+                   preserve_metadata)
     else:
         raise FileNotFoundError(f"No such file: {src_as_path.absolute().as_posix()}")
 
 
+def _copy_file(src: str, dst: str, src_stat: os.stat_result, preserve_metadata: bool) -> None:
+    with open(src, "rb") as src_file, open(os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                                   src_stat.st_mode & 0o777), "wb") as dst_file:
+        _copy_file_data(src_file.fileno(), dst_file.fileno())
+    if preserve_metadata:
+        _copy_metadata(src, dst, src_stat)
+
+
+# Copy the contents without passing them through userspace. Tries the fastest method first:
+# 1. reflink: the new file shares the data blocks with the old one (btrfs, xfs, ...), no data is copied at all
+# 2. copy_file_range: the kernel copies the data, filesystems can offload it (e.g. nfs server side copy)
+# 3. sendfile: the kernel copies the data, works across all filesystems
+def _copy_file_data(src_fd: int, dst_fd: int) -> None:
+    with contextlib.suppress(OSError):
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return
+    copied = 0
+    try:
+        while sent := os.copy_file_range(src_fd, dst_fd, 1073741824):
+            copied += sent
+        return
+    except OSError as e:
+        # EXDEV: different filesystems on kernels that don't support that, the others: not supported by the filesystem
+        if copied or e.errno not in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP]:
+            raise
+    while os.sendfile(dst_fd, src_fd, None, 1073741824):
+        pass
+
+
+def _copy_metadata(src: str, dst: str, src_stat: os.stat_result) -> None:
+    # chown first, as it clears the setuid/setgid bits
+    with contextlib.suppress(PermissionError):  # only root can change owners
+        os.chown(dst, src_stat.st_uid, src_stat.st_gid, follow_symlinks=False)
+    shutil.copystat(src, dst, follow_symlinks=False)  # mode, timestamps and xattrs
+
+
 #######################################################################################
 #                               BASH FUNCTIONS                                        #
 #######################################################################################
@@ -122,8 +231,164 @@ def bash(command: str) -> str:
     return output
 
 
+# The result of a command that ran in the chroot, see chroot_run
+class ChrootResult:
+    def __init__(self, argv: list, returncode: int, output: str, duration: float):
+        self.argv = argv
+        self.returncode = returncode
+        self.output = output  # stdout, stderr is passed on to the terminal
+        self.duration = duration  # in seconds
+
+
+# Commands in the chroot are run by one long-lived bash inside the chroot, which reads them from a pipe. This saves
+# starting chroot and two shells for every command, and the commands don't have to be quoted for a host shell.
+# Each command runs in a subshell -> cd, exit, set -e, ... don't affect the following commands. After the command, the
+# executor prints a marker line with the exit status. The executor is restarted if the root dir was remounted (e.g.
+# by the stage cache), as it would still run in the old root.
+_executor = None
+_executor_env = {}  # the environment the executor passes on to the commands
+_executor_lock = Lock()
+
+
+# Run a shell command in the chroot, returns its output
 def chroot(command: str) -> str:
-    return bash(f'chroot /mnt/depthboot /bin/bash -c "{command}"')
+    return _run_in_chroot(command, command).output.strip()
+
+
+# Run a command given as argv in the chroot, no quoting needed. input is passed to the stdin of the command.
+# Raises CalledProcessError if check is set and the command failed.
+def chroot_run(argv: list, input: str = None, check: bool = True) -> ChrootResult:
+    command = " ".join(shlex.quote(arg) for arg in argv)
+    if input is not None:
+        # base64 -> the input can't end the command line or contain the marker
+        command = f"printf '%s' {base64.b64encode(input.encode()).decode()} | base64 -d | {command}"
+    return _run_in_chroot(command, argv, check)
+
+
+# Stop the executor, has to be done before unmounting the root dir
+def close_chroot() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            return
+        with contextlib.suppress(OSError):
+            _executor.stdin.write("exit 0\n")
+            _executor.stdin.close()
+        try:
+            _executor.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            _executor.kill()
+            _executor.wait()
+        _executor.stdout.close()
+        _executor = None
+
+
+def _run_in_chroot(command: str, argv, check: bool = True) -> ChrootResult:
+    with _executor_lock:
+        executor = _start_executor()
+        marker = f"__depthboot_{os.urandom(8).hex()}__"
+        lines = _sync_executor_env()
+        # stdin of the executor is the command pipe -> commands must not read from it, they get /dev/null of the host
+        # (fd 9) instead, the image might not have one
+        lines.append(f"( {command}\n) <&9 9<&-")
+        lines.append(f"printf '\\n{marker} %d\\n' $?")
+        start = time.monotonic()
+        executor.stdin.write("\n".join(lines) + "\n")
+        executor.stdin.flush()
+        output = []
+        while True:
+            line = executor.stdout.readline()
+            if not line:
+                raise RuntimeError("The chroot executor exited unexpectedly")
+            if line.startswith(marker):
+                returncode = int(line.split()[1])
+                if verbose and output and output[-1] != "\n":  # the last line of the command had no newline
+                    print(output[-1][:-1], flush=True)
+                break
+            # printed one line late, the last line is the newline before the marker
+            if verbose and output:
+                print(output[-1], end="", flush=True)
+            output.append(line)
+        duration = time.monotonic() - start
+    # the marker is printed on a new line, remove that extra newline
+    output = "".join(output)[:-1]
+    if verbose:
+        print(f"Finished in {duration:.1f}s: {command}", flush=True)
+    if check and returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv, output)
+    return ChrootResult(argv, returncode, output, duration)
+
+
+# Returns the executor, starts a new one if there is none or it runs in an outdated root
+def _start_executor() -> subprocess.Popen:
+    global _executor
+    if _executor is not None:
+        try:
+            root_stat = os.stat(root_path())
+            executor_root_stat = os.stat(f"/proc/{_executor.pid}/root")
+            if _executor.poll() is None and (root_stat.st_dev, root_stat.st_ino) == (executor_root_stat.st_dev,
+                                                                                    executor_root_stat.st_ino):
+                return _executor
+        except OSError:  # the executor exited
+            pass
+        _executor.kill()
+        _executor.wait()
+        _executor.stdout.close()
+    _executor_env.clear()
+    _executor_env.update(os.environ)
+    devnull = os.open("/dev/null", os.O_RDONLY)
+    try:
+        _executor = subprocess.Popen(["chroot", root_path(), "/bin/bash", "--noprofile", "--norc"],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, encoding="utf-8",
+                                     errors="replace", env=_executor_env, pass_fds=[devnull])
+    finally:
+        os.close(devnull)
+    if devnull != 9:
+        _executor.stdin.write(f"exec 9<&{devnull} {devnull}<&-\n")
+    return _executor
+
+
+# Returns the shell lines that bring the environment of the executor up to date with the one of this process, e.g. the
+# http_proxy set by package_proxy.inject()
+def _sync_executor_env() -> list:
+    lines = []
+    for name in list(_executor_env):
+        if name not in os.environ:
+            lines.append(f"unset {name}")
+            del _executor_env[name]
+    for name, value in os.environ.items():
+        # names that aren't valid shell identifiers, e.g. exported bash functions, can't be set with export
+        if _executor_env.get(name) != value and name.isidentifier():
+            lines.append(f"export {name}={shlex.quote(value)}")
+            _executor_env[name] = value
+    return lines
+
+
+# Kill all processes running inside the chroot, e.g. daemons started by package managers, as they keep the mount busy
+def kill_chroot_processes() -> None:
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        with contextlib.suppress(OSError):  # the process exited in the meantime
+            if os.readlink(f"/proc/{pid}/root") == root_path():
+                os.kill(int(pid), signal.SIGKILL)
+                pids.append(pid)
+    # wait for the processes to actually exit
+    for _ in range(100):
+        if not any(_is_running(pid) for pid in pids):
+            return
+        sleep(0.05)
+
+
+# A killed process stays a zombie until its parent reaps it, it doesn't keep anything busy anymore though
+def _is_running(pid: str) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat", "r") as file:
+            # the state follows the command name in parentheses, which might contain spaces and parentheses itself
+            return file.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):  # reaped in the meantime
+        return False
 
 
 #######################################################################################
@@ -135,10 +400,106 @@ def set_verbose(new_state: bool) -> None:
     verbose = new_state
 
 
+# The root dir is created in the work dir by the script itself -> removing it never touches files of the user, even if
+# the work dir is e.g. the home dir
+def set_work_dir(work_dir: str) -> None:
+    global root_dir
+    root_dir = f"{get_full_path(work_dir)}/rootfs"
+
+
+# Remove the root dir with everything in it. Exits if anything is still mounted in it, as the files of the mounted
+# filesystem would be removed as well.
+def remove_root_dir() -> None:
+    with open("/proc/self/mountinfo", "r") as file:
+        mount_points = [line.split()[4] for line in file]
+    if any(mount_point == root_dir or mount_point.startswith(f"{root_dir}/") for mount_point in mount_points):
+        print_error(f"{root_dir} is still mounted, unmount it first")
+        sys.exit(1)
+    with contextlib.suppress(FileNotFoundError):
+        shutil.rmtree(root_dir)
+
+
+# Restart the script in a private mount and pid namespace. Once the script exits, even if it crashed or was killed, the
+# kernel removes all mounts of the build and kills all processes started in the chroot (e.g. the gpg-agent of pacman).
+# Mounts of the build are invisible to the host and to other builds. The mount namespace of the host stays available
+# through an inherited fd, see host_bash().
+def enter_build_namespace() -> None:
+    if "DEPTHBOOT_HOST_MOUNT_NS" in os.environ:  # already restarted
+        if os.getpid() == 1:
+            _run_init()
+        return
+    unshare = "unshare --mount --pid --fork --kill-child --mount-proc --propagation private"
+    try:
+        bash(f"{unshare} true 2>/dev/null")
+    except subprocess.CalledProcessError:  # old util-linux or no permission, e.g. in some containers
+        print_warning("Failed to create a mount namespace for the build, a failed build might leave mounts behind")
+        return
+    host_mount_ns = os.open("/proc/self/ns/mnt", os.O_RDONLY)
+    os.set_inheritable(host_mount_ns, True)
+    os.environ["DEPTHBOOT_HOST_MOUNT_NS"] = str(host_mount_ns)
+    sys.stdout.flush()
+    os.execvp("unshare", unshare.split() + [sys.executable] + sys.argv)
+
+
+# The first process of a pid namespace is its init: processes whose parent exited (e.g. the daemons of pacman-key) are
+# reparented to it and stay zombies until it reaps them, and it only gets the signals it has a handler for. The script
+# therefore forks once: this process only reaps and passes SIGTERM and SIGHUP on, the child continues with the build.
+# Once the build exits, this process exits with its exit code and the kernel kills everything left in the namespace.
+def _run_init() -> None:
+    sys.stdout.flush()
+    build_pid = os.fork()
+    if build_pid == 0:
+        return
+
+    def forward_signal(signal_number: int, frame) -> None:
+        with contextlib.suppress(ProcessLookupError):  # the build exited already
+            os.kill(build_pid, signal_number)
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C reaches the build directly, it's in the same process group
+    signal.signal(signal.SIGTERM, forward_signal)
+    signal.signal(signal.SIGHUP, forward_signal)
+    while True:
+        pid, status = os.wait()
+        if pid == build_pid:
+            exit_code = os.waitstatus_to_exitcode(status)
+            os._exit(exit_code if exit_code >= 0 else 128 - exit_code)  # negative -> killed by a signal
+
+
+# Run a command in the mount namespace of the host, e.g. to unmount partitions that the host mounted
+def host_bash(command: str) -> str:
+    if "DEPTHBOOT_HOST_MOUNT_NS" not in os.environ:
+        return bash(command)  # not in a build namespace
+    return bash(f"nsenter --mount=/proc/{os.getpid()}/fd/{os.environ['DEPTHBOOT_HOST_MOUNT_NS']} {command}")
+
+
 # This is for non-interactive shells
 def disable_download_progress() -> None:
-    global no_download_progress
-    no_download_progress = True
+    progress.set_mode("none")
+
+
+# Run a function in a daemon thread. join() waits for it to finish, returns its result and re-raises any exception
+# raised in the thread, including SystemExit from sys.exit().
+class BackgroundTask:
+    def __init__(self, target, *args):
+        self._result = None
+        self._exception = None
+        self._thread = Thread(target=self._run, args=(target, args,), daemon=True)
+        self._thread.start()
+
+    def _run(self, target, args: tuple) -> None:
+        try:
+            self._result = target(*args)
+        except BaseException as e:
+            self._exception = e
+
+    def is_running(self) -> bool:
+        return self._thread.is_alive()
+
+    def join(self):
+        self._thread.join()
+        if self._exception is not None:
+            raise self._exception
+        return self._result
 
 
 def prevent_idle() -> None:
@@ -156,173 +517,522 @@ def __prevent_idle():
 # TO AVOID ISSUES: Sync all repos before calling package manager functions
 # The functions below, will start a thread to monitor the progress of their respective package managers
 
-def track_apt(path_to_log: str) -> None:
-    Thread(target=_track_apt, args=(path_to_log,), daemon=True).start()
-
-
-def track_dnf(path_to_log) -> None:
-    Thread(target=_track_dnf, args=(path_to_log,), daemon=True).start()
-
-
-def track_pacman(path_to_log) -> None:
-    # The actual start of this function is at the bottom
-    def _track_pacman() -> None:
-        # As funny as it may sound in python, this function is optimized for performance, due to the huge amount of
-        # disk I/O Therefore some functions could be shorter, but that might increase the already relatively huge load.
-        # wait for install to start
-        while not path_exists(path_to_log):
-            sleep(0.1)
-        # wait for total package amount to appear in log
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log:
-                    if "Old Version  New Version             Net Change  Download Size" in line:
-                        total_packages = int(line.strip().split(" ")[1][1:-1])
-                        stop = True
-                        break
-
-        # wait and find line where packages start to download
-        # Pacman might be resolving dependencies, so we need to wait for that to finish
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log:
-                    if ":: Retrieving packages..." in line:
-                        download_start_index = log.index(line) + 1
-                        stop = True
-                        break
-
-        # Print download progress
-        stop = False
-        downloaded_functions = []
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[download_start_index:]:  # check lines after the start index to increase performance
-                    if ":: Processing package changes..." in line:  # pacman is preparing to install packages
-                        install_start_index = log.index(line) + 1
-                        stop = True
-                        break
-                    package = line.strip()[:-15]
-                    if package not in downloaded_functions:
-                        print(f"Downloading {package}, ({len(downloaded_functions)}/{total_packages})", end="\r",
-                              flush=True)
-                        downloaded_functions.append(package)
-
-        # Print install progress
-        stop = False
-        installed_packages = []
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[
-                            install_start_index:]:  # only check lines after the install start to increase performance
-                    if ":: Running post-transaction hooks..." in line:  # pacman is preparing to run post install hooks
-                        post_install_start_index = log.index(line) + 1
-                        stop = True
-                        break
-                    if "installing " in line:
-                        package = line.strip()[11:-3]
-                        if package not in installed_packages:
-                            print(f"Installing package {package}, ({len(installed_packages)}/{total_packages})",
-                                  end="\r",
-                                  flush=True)
-                            installed_packages.append(package)
-
-        # Monitor postinstall hooks
-        # Don't print the full output, as it might include "scary"-ish messages
-        stop = False
-        while not stop:
-            sleep(1)
-            with open(path_to_log, "r") as file:
-                log = file.readlines()
-                for line in log[post_install_start_index:]:
-                    # pacman has no final success message, so we have to manually check if the install is finished
-                    if not line.startswith("("):  # if the line doesn't start with a number, it's not relevant for us
-                        continue
-                    temp_line = line.strip().split(" ")[0]
-                    # check if this is the last line by comparing the numbers inside the brackets
-                    if temp_line[1:-1].split("/")[0] == temp_line[1:-1].split("/")[1]:
-                        print("Installation finished", flush=True)
-                        stop = True
-                        break
-                    print(f"Running postinstall hooks: {temp_line}", end="\r", flush=True)
-                    installed_packages.append(package)
+# Each tracker follows the log of one package manager command in a background thread and publishes its progress.
+# finished has to be set once the command exited, the returned task finishes after the rest of the log was parsed.
+def track_apt(path_to_log: str, finished: Event) -> BackgroundTask:
+    return BackgroundTask(_track_log, AptProgressParser(), path_to_log, finished)
+
 
-    Thread(target=_track_pacman, daemon=True).start()
+def track_dnf(path_to_log: str, finished: Event) -> BackgroundTask:
+    return BackgroundTask(_track_log, DnfProgressParser(), path_to_log, finished)
 
 
-# Track progress of apt/apt-get
-def _track_apt(path_to_log) -> None:
-    pass
+def track_pacman(path_to_log: str, finished: Event) -> BackgroundTask:
+    return BackgroundTask(_track_log, PacmanProgressParser(), path_to_log, finished)
 
 
-# Track progress of dnf
-def _track_dnf(path_to_log) -> None:
-    pass
+def _track_log(parser, path_to_log: str, finished: Event) -> None:
+    try:
+        for line in follow_log(path_to_log, finished):
+            parser.feed(line)
+    finally:
+        parser.finish()
+
+
+# Yields the lines of a log that is still being written, without reading anything twice. Returns at the end of the log
+# once finished is set.
+def follow_log(path_to_log: str, finished: Event):
+    while not path_exists(path_to_log):
+        if finished.is_set():
+            return
+        sleep(0.1)
+    with open(path_to_log, "r", errors="replace") as file:
+        log_lines = LogLines()
+        while True:
+            # check before reading -> nothing written before the command exited is missed
+            was_finished = finished.is_set()
+            data = file.read()  # from the last offset to the current end of the file
+            if not data:
+                if was_finished:
+                    break
+                sleep(0.2)
+                continue
+            yield from log_lines.split(data)
+        if log_lines.partial_line:
+            yield log_lines.partial_line
+
+
+# Splits the data of a log into lines as it's read. Progress bars overwrite their line with \r -> every update is a line
+# of its own. A read can end in the middle of a line, the rest of it is kept until the next read.
+class LogLines:
+    def __init__(self):
+        self.partial_line = ""  # not terminated yet
+
+    def split(self, data: str) -> list:
+        lines = (self.partial_line + data).replace("\r", "\n").split("\n")
+        self.partial_line = lines.pop()
+        return lines
+
+
+# The parsers get the log line by line and publish one progress task per phase of the package manager.
+# They don't read any files themselves -> captured logs can be replayed through feed().
+class _ProgressParser(abc.ABC):
+    def __init__(self):
+        self.task = None
+
+    @abc.abstractmethod
+    def feed(self, line: str) -> None:
+        pass
+
+    def finish(self) -> None:
+        if self.task is not None:
+            self.task.finish()
+            self.task = None
+
+    # finish the task of the previous phase and start a new one, unless it's already running
+    def _phase(self, name: str, total: int = 0, unit: str = "packages") -> progress.Task:
+        if self.task is None or self.task.name != name:
+            self.finish()
+            self.task = progress.start_task(name, total, unit)
+        return self.task
+
+
+# apt-get -o APT::Status-Fd=<fd> writes machine-readable status lines to fd:
+#   dlstatus:<item>:<percent>:<description>
+#   pmstatus:<package>:<percent>:<description>
+class AptProgressParser(_ProgressParser):
+    def feed(self, line: str) -> None:
+        fields = line.split(":", 3)
+        if len(fields) < 3:
+            return
+        # no match statement: functions.py is imported before main.py checks the python version
+        with contextlib.suppress(ValueError):
+            if fields[0] == "dlstatus":
+                self._phase("Downloading packages", 100, "percent").update(int(float(fields[2])))
+            elif fields[0] == "pmstatus":
+                self._phase("Installing packages", 100, "percent").update(int(float(fields[2])))
+
+
+# Output of dnf without a terminal:
+#   (3/120): package-1.0-1.fc37.x86_64.rpm   1.0 MB/s | 200 kB     00:00
+#     Installing       : package-1.0-1.fc37.x86_64                 3/120
+#     Verifying        : package-1.0-1.fc37.x86_64                 3/120
+class DnfProgressParser(_ProgressParser):
+    download_pattern = re.compile(r"^\((\d+)/(\d+)\): ")
+    transaction_pattern = re.compile(r"^\s+(Installing|Upgrading|Reinstalling|Downgrading|Erasing|Removing|Obsoleting|"
+                                     r"Cleanup|Verifying)\s*: .*\s(\d+)/(\d+)\s*$")
+
+    def feed(self, line: str) -> None:
+        if match := self.download_pattern.match(line):
+            self._phase("Downloading packages").update(int(match[1]), int(match[2]))
+        elif match := self.transaction_pattern.match(line):
+            name = "Verifying packages" if match[1] == "Verifying" else "Installing packages"
+            self._phase(name).update(int(match[2]), int(match[3]))
+        elif line.startswith("Complete!"):
+            self.finish()
+
+
+# Output of pacman without a terminal:
+#   Packages (120) package-1.0-1 ...
+#   :: Retrieving packages...
+#    package-1.0-1-x86_64 downloading...
+#   :: Processing package changes...
+#   installing package...
+#   :: Running post-transaction hooks...
+#   (1/12) Arming ConditionNeedsUpdate...
+class PacmanProgressParser(_ProgressParser):
+    total_pattern = re.compile(r"^Packages? \((\d+)\)")
+    change_pattern = re.compile(r"^(installing|upgrading|reinstalling|downgrading|removing) (\S+)\.\.\.")
+    hook_pattern = re.compile(r"^\((\d+)/(\d+)\) ")
+
+    def __init__(self):
+        super().__init__()
+        self.total_packages = 0
+        self.hooks = False  # the numbered lines after ":: Running post-transaction hooks..." are hooks
+        self.packages = set()
+
+    def feed(self, line: str) -> None:
+        line = line.strip()
+        if match := self.total_pattern.match(line):
+            self.total_packages = int(match[1])
+        elif line.startswith(":: Retrieving packages"):
+            self.packages = set()
+            self._phase("Downloading packages", self.total_packages)
+        elif line.endswith(" downloading...") and self.task is not None:
+            self.packages.add(line.removesuffix(" downloading..."))
+            self.task.update(len(self.packages))
+        elif line.startswith(":: Processing package changes"):
+            self.packages = set()
+            self._phase("Installing packages", self.total_packages)
+        elif match := self.change_pattern.match(line):
+            self.packages.add(match[2])
+            self._phase("Installing packages", self.total_packages).update(len(self.packages))
+        elif line.startswith(":: Running post-transaction hooks"):
+            self.hooks = True
+            self._phase("Running post-transaction hooks", unit="hooks")
+        elif self.hooks and (match := self.hook_pattern.match(line)):
+            self.task.update(int(match[1]), int(match[2]))
 
 
 #######################################################################################
 #                              FILE PROGRESS MONITOR FUNCTIONS                        #
 #######################################################################################
 
-def extract_file(file: str, dest: str) -> None:
-    try:
-        bash("which pv")
-    except subprocess.CalledProcessError:
-        global no_download_progress
-        no_download_progress = True
-    if no_download_progress:  # for non-interactive shells only
-        if file.endswith(".gz"):
-            # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
-            bash(f"tar xfpz {file} --warning=no-unknown-keyword -C {dest}")
-        elif file.endswith(".xz"):
-            bash(f"tar xfpJ {file} -C {dest}")
-        return
+# Extract one or more files, which together form one archive (e.g. split archives), to dest.
+# Split archives are extracted as one concatenated stream -> the parts never have to be joined on disk.
+# compression is "gz" or "xz". If not set, it's determined from the file extension
+def extract_file(files: Union[str, list], dest: str, compression: str = "", strip_dir: str = "") -> None:
+    if isinstance(files, str):
+        files = [files]
+    if not compression:
+        compression = files[0].split(".")[-1]
+    total_size = sum(os.stat(file).st_size for file in files)
+    tar = _start_tar(dest, compression, files[0] if len(files) == 1 else "", strip_dir)
+    with progress.start_task(f"Extracting {Path(files[0]).name}", total_size) as task:
+        try:
+            for file in files:
+                _stream_file(file, tar, task)
+            _finish_tar(tar)
+        except BaseException:
+            tar.kill()
+            raise
+
+
+# tar and a separate decompressor, connected by a pipe. Data is written to stdin of the decompressor.
+class _TarPipeline:
+    def __init__(self, processes: list):
+        self.processes = processes
+        self.stdin = processes[0].stdin
+        self.args = processes[-1].args
+
+    def kill(self) -> None:
+        for process in self.processes:
+            process.kill()
+
+
+# Pick the fastest available decompressor for the archive. Returns the command (empty if tar should decompress
+# by itself) and a description for the user.
+# archive is the local archive file if there is exactly one, it is used to check how well xz can parallelize
+def _decompressor(compression: str, archive: str = "") -> Tuple[list, str]:
+    if compression == "gz":
+        try:
+            bash("which pigz")
+            # gzip can't be decompressed in parallel, but pigz moves reading, writing and checksums to extra threads
+            return ["pigz", "-dc"], "pigz"
+        except subprocess.CalledProcessError:
+            return [], "gzip (single-threaded, install pigz for faster extraction)"
 
-    if file.endswith(".gz"):
+    try:
+        xz_version = int(bash("xz --robot --version").split("\n")[0].split("=")[1])
+    except (subprocess.CalledProcessError, IndexError, ValueError):
+        return [], "xz (single-threaded)"
+    if xz_version < 50040000:  # xz only decompresses multithreaded since 5.4
+        return ["xz", "-dc"], "xz (single-threaded, xz 5.4 or newer is needed for multithreaded decompression)"
+    if not archive:  # the block count is only known after reading the whole stream
+        return ["xz", "-dc", "-T0"], "xz (multithreaded if the archive has multiple blocks)"
+    try:
+        # the totals line contains: "totals", streams, blocks, ...
+        blocks = int(bash(f"xz --robot --list {archive}").split("\n")[-1].split("\t")[2])
+    except (subprocess.CalledProcessError, IndexError, ValueError):
+        blocks = 0
+    if blocks == 0:
+        return ["xz", "-dc", "-T0"], "xz (multithreaded if the archive has multiple blocks)"
+    if blocks == 1:
+        return ["xz", "-dc"], "xz (single-threaded, the archive consists of only one block)"
+    return ["xz", "-dc", "-T0"], f"xz (multithreaded, {blocks} blocks)"
+
+
+# Start tar reading an archive from stdin
+# If strip_dir is set, only that top-level dir of the archive is extracted, with its contents placed directly in dest
+def _start_tar(dest: str, compression: str, archive: str = "", strip_dir: str = "") -> _TarPipeline:
+    decompressor, description = _decompressor(compression, archive)
+    print_status(f"Decompressing with {description}")
+    tar_command = ["tar", "xfp", "-", "-C", dest]
+    if compression == "gz":
         # --warning=no-unknown-keyword is to supress a warning about unknown headers in the arch rootfs
-        bash(f"pv {file} | tar xfpz - --warning=no-unknown-keyword -C {dest}")
-    elif file.endswith(".xz"):
-        bash(f"pv {file} | tar xfpJ - -C {dest}")
-
-
-def download_file(url: str, path: str) -> None:
-    # start monitor in a separate thread
-    if no_download_progress:  # for non-interactive shells only
-        # start download
-        urlretrieve(url=url, filename=path)
-        return
-
-    # get total file size from server
-    total_file_size = int(urlopen(url).headers["Content-Length"])
-    Thread(target=_print_download_progress, args=(Path(path), total_file_size,), daemon=True).start()
+        tar_command.append("--warning=no-unknown-keyword")
+    if strip_dir:
+        tar_command.extend(["--strip-components=1", strip_dir])
+    if not decompressor:
+        tar_command[1] += "z" if compression == "gz" else "J"
+        return _TarPipeline([subprocess.Popen(tar_command, stdin=subprocess.PIPE)])
+    decompress = subprocess.Popen(decompressor, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    tar = subprocess.Popen(tar_command, stdin=decompress.stdout)
+    decompress.stdout.close()  # only tar reads from it -> tar exiting early terminates the decompressor
+    return _TarPipeline([decompress, tar])
+
+
+def _finish_tar(tar: _TarPipeline) -> None:
+    tar.stdin.close()
+    # check tar first: if tar fails, the decompressor fails as well because its output pipe is closed
+    for process in reversed(tar.processes):
+        if process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+
+# Download an archive and extract it at the same time, without writing the archive to disk first.
+# sources are urls or local files, which are concatenated into one stream, e.g. the parts of a split archive.
+# If a tee path is set for a source, the source is additionally written to that file (e.g. for the artifact cache).
+# Returns the sha256 and the validators of each url. Local files are not hashed.
+def stream_extract(sources: list, dest: str, compression: str, tee_paths: list = None, strip_dir: str = "") -> list:
+    if tee_paths is None:
+        tee_paths = [""] * len(sources)
+    results = []
+    tar = _start_tar(dest, compression, strip_dir=strip_dir)
+    try:
+        for source, tee_path in zip(sources, tee_paths):
+            if source.startswith("/"):  # local file
+                with progress.start_task(f"Extracting {Path(source).name}", os.stat(source).st_size) as task:
+                    _stream_file(source, tar, task)
+                results.append(("", {}))
+            else:
+                results.append(_stream_url(source, tar, tee_path))
+        _finish_tar(tar)
+    except BaseException:
+        tar.kill()
+        raise
+    return results
+
+
+def _stream_file(path: str, tar: _TarPipeline, task: progress.Task) -> None:
+    with open(path, "rb") as file:
+        while data := file.read(1048576):
+            tar.stdin.write(data)
+            task.advance(len(data))
+
+
+def _stream_url(url: str, tar: _TarPipeline, tee_path: str) -> Tuple[str, dict]:
+    file_hash = hashlib.sha256()
+    validators = {}
+    tee_file = open(tee_path, "wb") if tee_path else None
+    task = progress.start_task(f"Downloading and extracting {_url_file_name(url)}")
+    try:
+        for attempt in range(download_retries + 1):
+            # resume at the current position if the connection was interrupted
+            headers = {"Range": f"bytes={task.done}-", "If-Range": validators["etag"] or
+                       validators["last_modified"]} if task.done else {}
+            try:
+                with urlopen(Request(url, headers=headers)) as response:
+                    if not task.done:
+                        validators = {"asset": response.url.split("?")[0], "etag": response.headers["ETag"],
+                                      "last_modified": response.headers["Last-Modified"]}
+                        task.update(0, int(response.headers.get("Content-Length") or 0))
+                    elif response.status != 206:
+                        raise HTTPError(url, response.status, "File changed on server or range requests ignored",
+                                        response.headers, None)
+                    while data := response.read(1048576):
+                        file_hash.update(data)
+                        tar.stdin.write(data)
+                        if tee_file is not None:
+                            tee_file.write(data)
+                        task.advance(len(data))
+                break
+            except (URLError, ConnectionError, TimeoutError) as e:
+                resumable = validators.get("etag") is not None or validators.get("last_modified") is not None
+                if isinstance(e, HTTPError) and e.code < 500 or attempt == download_retries or \
+                        (task.done and not resumable):
+                    raise
+                sleep(2 ** attempt)
+    except BaseException:
+        if tee_file is not None:
+            tee_file.close()
+            rmfile(tee_path)
+        raise
+    finally:
+        task.finish()
+    if tee_file is not None:
+        tee_file.close()
+    if verbose:
+        print(f"sha256 of {url}: {file_hash.hexdigest()}")
+    return file_hash.hexdigest(), validators
 
-    # start download
-    urlretrieve(url=url, filename=path)
 
-    # stop monitor
-    open(".stop_download_progress", "a").close()
-    print("\n", end="")
+def _url_file_name(url: str) -> str:
+    return url.split("?")[0].split("/")[-1]
 
 
-def _print_download_progress(file_path: Path, total_size) -> None:
-    while True:
-        if path_exists(".stop_download_progress"):
-            rmfile(".stop_download_progress")
-            return
+def download_file(url: str, path: str) -> None:
+    # A single HEAD request resolves redirects and tells us the file size and whether the server supports ranges
+    resolved_url, total_size, supports_ranges, validators = _probe_url(url)
+    with progress.start_task(f"Downloading {_url_file_name(url)}", total_size) as task:
+        if supports_ranges and total_size > download_chunk_size:
+            _download_ranges(url, resolved_url, path, total_size, validators, task)
+        else:
+            _download_stream(resolved_url, path, task)
+
+
+# Returns the url after redirects, the file size (0 if unknown), whether the server accepts range requests and the
+# validators (ETag/Last-Modified) that identify this version of the file
+def _probe_url(url: str) -> Tuple[str, int, bool, dict]:
+    try:
+        with urlopen(Request(url, method="HEAD")) as response:
+            return (response.url, int(response.headers.get("Content-Length") or 0),
+                    response.headers.get("Accept-Ranges", "").lower() == "bytes",
+                    {"etag": response.headers["ETag"], "last_modified": response.headers["Last-Modified"]})
+    except HTTPError as e:
+        if e.code not in [405, 501]:  # some servers don't implement HEAD -> fall back to a plain download
+            raise
+        return url, 0, False, {"etag": None, "last_modified": None}
+
+
+# Download the file in chunks over multiple connections, directly into a preallocated file.
+# The amount of connections is increased as long as it results in a higher throughput.
+# Finished ranges are recorded in a journal next to the file, so that an interrupted download can be resumed.
+def _download_ranges(url: str, resolved_url: str, path: str, total_size: int, validators: dict,
+                     downloaded: progress.Task) -> None:
+    journal_path = f"{path}.journal"
+    journal = {"url": url, "size": total_size, **validators, "done": []}
+    # Only reuse partial data if the file on the server is still the same one
+    resumable = validators["etag"] is not None or validators["last_modified"] is not None
+    if resumable and path_exists(path) and path_exists(journal_path):
+        with contextlib.suppress(ValueError, KeyError):  # corrupted journal -> start from scratch
+            with open(journal_path, "r") as file:
+                old_journal = json.load(file)
+            if {key: old_journal.get(key) for key in ["url", "size", "etag", "last_modified"]} == \
+                    {key: journal[key] for key in ["url", "size", "etag", "last_modified"]}:
+                journal["done"] = old_journal["done"]
+                print_status(f"Resuming download at {sum(end - start + 1 for start, end in journal['done']) // 1048576}"
+                             "mb")
+    if not journal["done"]:
+        rmfile(journal_path)
+
+    chunks = Queue()
+    for gap_start, gap_end in _missing_ranges(journal["done"], total_size):
+        for start in range(gap_start, gap_end + 1, download_chunk_size):
+            chunks.put((start, min(start + download_chunk_size - 1, gap_end)))
+    downloaded.advance(sum(end - start + 1 for start, end in journal["done"]))
+    current_url = [resolved_url]  # shared between workers, updated if the resolved url expires
+    journal_lock = Lock()
+    errors = []
+
+    def worker() -> None:
+        while not errors:
+            try:
+                start, end = chunks.get_nowait()
+            except Empty:
+                return
+            try:
+                _download_range(url, current_url, validators, file_descriptor, start, end, downloaded)
+            except Exception as e:
+                errors.append(e)
+                return
+            if resumable:
+                with journal_lock:
+                    journal["done"] = _merge_ranges(journal["done"] + [[start, end]])
+                    with open(f"{journal_path}.tmp", "w") as file:
+                        json.dump(journal, file)
+                    os.replace(f"{journal_path}.tmp", journal_path)
+
+    if journal["done"]:
+        file_descriptor = os.open(path, os.O_WRONLY)
+    else:
+        file_descriptor = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
         try:
-            print("\rDownloading: " + "%.0f" % int(file_path.stat().st_size / 1048576) + "mb / "
-                  + "%.0f" % (total_size / 1048576) + "mb", end="", flush=True)
-        except FileNotFoundError:
-            sleep(0.5)  # in case download hasn't started yet
+            os.posix_fallocate(file_descriptor, 0, total_size)
+        except OSError:  # not supported by all filesystems
+            os.ftruncate(file_descriptor, total_size)
+
+        workers = []
+        for _ in range(download_connections):
+            workers.append(Thread(target=worker, daemon=True))
+            workers[-1].start()
+
+        # measure throughput and add connections while that makes the download faster
+        previous_throughput = 0
+        previous_bytes = downloaded.done
+        while any(thread.is_alive() for thread in workers):
+            sleep(2)
+            throughput = (downloaded.done - previous_bytes) / 2
+            previous_bytes = downloaded.done
+            if throughput > previous_throughput * 1.1 and len(workers) < max_download_connections \
+                    and not chunks.empty():
+                if verbose:
+                    print(f"\nDownload throughput: {throughput / 1048576:.1f}mb/s, "
+                          f"increasing connections to {len(workers) + 2}")
+                for _ in range(2):
+                    workers.append(Thread(target=worker, daemon=True))
+                    workers[-1].start()
+                previous_throughput = throughput
+            elif previous_throughput != 0:
+                previous_throughput = float("inf")  # saturated -> stop adding connections
+        if errors:
+            if resumable:
+                print_warning("\nDownload interrupted, finished parts were kept and will be resumed on the next try")
+            raise errors[0]
+    finally:
+        os.close(file_descriptor)
+    rmfile(journal_path)
+
+
+# Download a single range, retrying a few times on network errors
+def _download_range(url: str, current_url: list, validators: dict, file_descriptor: int, start: int, end: int,
+                    downloaded: progress.Task) -> None:
+    headers = {"Range": f"bytes={start}-{end}"}
+    # make the server send the whole file instead of a range, if the file changed since the HEAD request
+    if validators["etag"] is not None or validators["last_modified"] is not None:
+        headers["If-Range"] = validators["etag"] or validators["last_modified"]
+    for attempt in range(download_retries + 1):
+        offset = start
+        request_url = current_url[0]
+        try:
+            try:
+                response = urlopen(Request(request_url, headers=headers))
+            except HTTPError as e:
+                # signed redirect targets (e.g. GitHub release assets) expire after a few minutes -> resolve them again
+                if e.code not in [403, 404, 410] or request_url == url:
+                    raise
+                current_url[0] = _probe_url(url)[0]
+                response = urlopen(Request(current_url[0], headers=headers))
+            with response:
+                if response.status != 206:
+                    raise HTTPError(url, response.status, "File changed on server or range requests ignored",
+                                    response.headers, None)
+                while data := response.read(1048576):
+                    os.pwrite(file_descriptor, data, offset)
+                    offset += len(data)
+                    downloaded.advance(len(data))
+            if offset != end + 1:
+                raise URLError(f"Connection closed early while downloading {url}")
+            return
+        except (URLError, OSError) as e:
+            if isinstance(e, HTTPError) and e.code < 500:
+                raise  # retrying won't help
+            downloaded.advance(start - offset)  # the range is downloaded again
+            if attempt == download_retries:
+                raise e if isinstance(e, URLError) else URLError(e)
+            sleep(2 ** attempt)
+
+
+# Returns the gaps between the (sorted, non-overlapping) ranges in [0, total_size)
+def _missing_ranges(done_ranges: list, total_size: int) -> list:
+    missing = []
+    position = 0
+    for start, end in done_ranges:
+        if start > position:
+            missing.append([position, start - 1])
+        position = end + 1
+    if position < total_size:
+        missing.append([position, total_size - 1])
+    return missing
+
+
+def _merge_ranges(ranges: list) -> list:
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+# Fallback for servers that don't support ranges
+def _download_stream(url: str, path: str, downloaded: progress.Task) -> None:
+    with urlopen(url) as response, open(path, "wb") as file:
+        while data := response.read(1048576):
+            file.write(data)
+            downloaded.advance(len(data))
 
 
 #######################################################################################
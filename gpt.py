@@ -0,0 +1,124 @@
+# Write the partition table of depthboot images/devices: a protective MBR and a GPT with the ChromeOS kernel attributes
+# Replaces wipefs, parted and cgpt: the whole table is written in one pass, directly to the image file or the device,
+# and the PARTUUIDs are generated here -> they are known before the partitions exist.
+# Layout, the same as parted created before:
+#   1: Kernel 1mb - 65mb, ChromeOS kernel, priority 15, 5 tries, successful
+#   2: Kernel 65mb - 129mb, ChromeOS kernel (backup), priority 1, 5 tries, successful
+#   3: Root 129mb - end of the disk, Linux filesystem
+import fcntl
+import struct
+import uuid
+import zlib
+
+from functions import *
+
+chromeos_kernel_type = uuid.UUID("fe3a2a5d-4f32-41a7-b725-accc3285a309")
+linux_filesystem_type = uuid.UUID("0fc63daf-8483-4772-8e79-3d69d8477de4")
+entry_count = 128
+entry_size = 128
+BLKSSZGET = 0x1268  # ioctl to get the logical sector size of a block device, from linux/fs.h
+BLKRRPART = 0x125f  # ioctl to make the kernel re-read the partition table
+rootfs_start = 135266304  # in bytes, after the two kernel partitions
+
+
+class Partition:
+    def __init__(self, name: str, type_guid: uuid.UUID, start: int, end: int, attributes: int = 0,
+                 part_uuid: str = ""):
+        self.name = name
+        self.type_guid = type_guid
+        self.start = start  # in bytes
+        self.end = end  # in bytes, exclusive. 0 -> until the end of the disk
+        self.attributes = attributes
+        self.part_uuid = part_uuid or str(uuid.uuid4())
+
+
+# The attributes of cgpt: priority (0-15), tries (0-15) and successful (0/1) in bits 48-56
+def chromeos_kernel_attributes(priority: int, tries: int, successful: bool) -> int:
+    return (priority << 48) | (tries << 52) | (int(successful) << 56)
+
+
+# Returns the partitions of a depthboot image/device, rootfs_partuuid becomes the PARTUUID of the rootfs partition
+def depthboot_layout(rootfs_partuuid: str) -> list:
+    return [Partition("Kernel", chromeos_kernel_type, 1048576, 68157440, chromeos_kernel_attributes(15, 5, True)),
+            Partition("Kernel", chromeos_kernel_type, 68157440, 135266304, chromeos_kernel_attributes(1, 5, True)),
+            Partition("Root", linux_filesystem_type, rootfs_start, 0, part_uuid=rootfs_partuuid)]
+
+
+# Write a protective MBR, the primary and the backup GPT to a device or image file. Old partition tables and filesystem
+# signatures in the first and last mb are removed. Returns the partitions with their end set.
+def write(path: str, partitions: list) -> list:
+    fd = os.open(path, os.O_RDWR)
+    try:
+        disk_size = os.lseek(fd, 0, os.SEEK_END)
+        sector_size = _sector_size(fd)
+        sectors = disk_size // sector_size
+        entry_sectors = entry_count * entry_size // sector_size
+        first_usable = 2 + entry_sectors
+        last_usable = sectors - 2 - entry_sectors
+
+        entries = b""
+        for partition in partitions:
+            if not partition.end:
+                # parted aligns the end of the last partition to the end of the usable space
+                partition.end = (last_usable + 1) * sector_size
+            first_lba = partition.start // sector_size
+            last_lba = partition.end // sector_size - 1
+            if first_lba < first_usable or last_lba > last_usable or first_lba > last_lba:
+                raise ValueError(f"Partition {partition.name} doesn't fit on {path}")
+            entries += struct.pack("<16s16sQQQ72s", partition.type_guid.bytes_le,
+                                   uuid.UUID(partition.part_uuid).bytes_le, first_lba, last_lba, partition.attributes,
+                                   partition.name.encode("utf-16-le"))
+        entries = entries.ljust(entry_count * entry_size, b"\0")
+        disk_guid = uuid.uuid4().bytes_le
+
+        # remove old signatures, the partitions start at 1mb at the earliest
+        wipe_size = min(1048576, disk_size // 2)
+        os.pwrite(fd, bytes(wipe_size), 0)
+        os.pwrite(fd, bytes(wipe_size), disk_size - wipe_size)
+        os.pwrite(fd, _protective_mbr(sectors), 0)
+        os.pwrite(fd, entries, 2 * sector_size)
+        os.pwrite(fd, _header(1, sectors - 1, first_usable, last_usable, disk_guid, 2, entries, sector_size),
+                  sector_size)
+        os.pwrite(fd, entries, (last_usable + 1) * sector_size)
+        os.pwrite(fd, _header(sectors - 1, 1, first_usable, last_usable, disk_guid, last_usable + 1, entries,
+                              sector_size), (sectors - 1) * sector_size)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return partitions
+
+
+# Make the kernel re-read the partition table of a device, the partition device files exist afterwards
+def reread_partitions(device: str) -> None:
+    fd = os.open(device, os.O_RDONLY)
+    try:
+        fcntl.ioctl(fd, BLKRRPART)
+    finally:
+        os.close(fd)
+
+
+# Returns the device file of a partition, with a p between device and number if the device name ends with a digit
+def partition_path(device: str, number: int) -> str:
+    return f"{device}p{number}" if device[-1].isdigit() else f"{device}{number}"
+
+
+def _sector_size(fd: int) -> int:
+    try:
+        return struct.unpack("I", fcntl.ioctl(fd, BLKSSZGET, b"\0" * 4))[0]
+    except OSError:  # not a block device, i.e. an image file
+        return 512
+
+
+def _protective_mbr(sectors: int) -> bytes:
+    # one partition of type 0xee over the whole disk, the chs values are the usual placeholders
+    entry = struct.pack("<B3sB3sII", 0, b"\x00\x02\x00", 0xee, b"\xff\xff\xff", 1, min(sectors - 1, 0xffffffff))
+    return bytes(446) + entry + bytes(48) + b"\x55\xaa"
+
+
+def _header(current_lba: int, backup_lba: int, first_usable: int, last_usable: int, disk_guid: bytes,
+            entries_lba: int, entries: bytes, sector_size: int) -> bytes:
+    header = struct.pack("<8sIIIIQQQQ16sQIII", b"EFI PART", 0x10000, 92, 0, 0, current_lba, backup_lba, first_usable,
+                         last_usable, disk_guid, entries_lba, entry_count, entry_size, zlib.crc32(entries))
+    # the crc of the header is calculated with the crc field set to 0
+    header = header[:16] + struct.pack("<I", zlib.crc32(header)) + header[20:]
+    return header.ljust(sector_size, b"\0")
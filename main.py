@@ -25,6 +25,8 @@ def process_args():
     parser.add_argument("-v", "--verbose", dest="verbose", help="Print more output", action="store_true")
     parser.add_argument("--no-download-progress", dest="download_progress", action="store_true",
                         help="Do not print download/extraction progress")
+    parser.add_argument("--progress-json", dest="progress_json", action="store_true",
+                        help="Print progress as one json object per line instead of a progress bar")
     parser.add_argument("--no-shrink", dest="no_shrink", help="Do not shrink image", action="store_true")
     parser.add_argument("--verbose-kernel", dest="verbose_kernel", action="store_true",
                         help="Set loglevel=15 in cmdline for visible kernel logs on boot")
@@ -35,9 +37,74 @@ def process_args():
     parser.add_argument("--dev", dest="dev_build", action="store_true", help="Use latest dev build. May be unstable.")
     parser.add_argument("--skip-commit-check", dest="skip_commit_check", action="store_true",
                         help="Do not check if local commit hash matches remote commit hash")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true",
+                        help="Do not use the persistent download cache for kernel and rootfs files")
+    parser.add_argument("--cache-dir", dest="cache_dir", default="/var/cache/depthboot",
+                        help="Location of the persistent download cache(default: /var/cache/depthboot)")
+    parser.add_argument("--cache-size", dest="cache_size", type=int, default=20,
+                        help="Maximum size of the download cache in GB(default: 20GB)")
+    parser.add_argument("--package-proxy", dest="package_proxy", action="store_true",
+                        help="Cache packages downloaded by the package manager in a local proxy for later builds")
+    parser.add_argument("--package-proxy-size", dest="package_proxy_size", type=int, default=10,
+                        help="Maximum size of the package proxy cache in GB(default: 10GB)")
+    parser.add_argument("--package-cache", dest="package_cache", action="store_true",
+                        help="Keep downloaded packages on the host for later builds of the same distro release")
+    parser.add_argument("--package-cache-size", dest="package_cache_size", type=int, default=10,
+                        help="Maximum size of the package archive cache in GB(default: 10GB)")
+    parser.add_argument("--stage-cache", dest="stage_cache", action="store_true",
+                        help="Reuse the results of previous builds with the same distro, user settings and kernel type")
+    parser.add_argument("--stage-cache-age", dest="stage_cache_age", type=int, default=7,
+                        help="Maximum age of cached build stages in days(default: 7)")
+    parser.add_argument("--no-mirror-ranking", dest="no_mirror_ranking", action="store_true",
+                        help="Do not probe for the fastest package mirrors, use the default ones of the distro")
+    parser.add_argument("--no-prefetch", dest="no_prefetch", action="store_true",
+                        help="Do not download packages in the background before the package manager needs them")
+    parser.add_argument("--unsafe-io", dest="unsafe_io", action="store_true",
+                        help="Disable fsync for the package managers while building. Faster, but a crash or power "
+                             "loss during the build leaves a broken image/device")
+    parser.add_argument("--stream-rootfs", dest="stream_rootfs", action="store_true",
+                        help="Extract the rootfs while downloading it, without storing the archive in /tmp")
+    parser.add_argument("--build-in-image", dest="build_in_image", action="store_true",
+                        help="Build on a local image and write it to the USB/SD-card at the end. Much faster on slow "
+                             "USB/SD-cards, but needs free space for the installed system on the build system")
+    parser.add_argument("--exact-size", dest="exact_size", action="store_true",
+                        help="Build the rootfs in the work dir and create the image with its exact size at the end, "
+                             "instead of shrinking a 10GB image")
+    parser.add_argument("--exact-size-headroom", dest="exact_size_headroom", type=int, default=200,
+                        help="Free space in the rootfs of --exact-size images in MB(default: 200MB)")
+    parser.add_argument("--work-dir", dest="work_dir", default="/mnt/depthboot",
+                        help="Where to build, the image/device is mounted at <work dir>/rootfs(default: "
+                             "/mnt/depthboot)")
+    # "./main.py flash /dev/sdX" flashes an already built image instead of building one
+    subparsers = parser.add_subparsers(dest="command")
+    flash_parser = subparsers.add_parser("flash", help="Flash a built image to a USB/SD-card. Only the blocks that "
+                                                       "contain data are written")
+    flash_parser.add_argument(dest="flash_device", help="USB/SD-card to flash, e.g. /dev/sdb")
+    flash_parser.add_argument("--image", dest="flash_image", default="depthboot.img",
+                              help="Image to flash(default: depthboot.img)")
+    flash_parser.add_argument("--bmap", dest="flash_bmap", default="depthboot.bmap",
+                              help="Block map of the image(default: depthboot.bmap)")
+    flash_parser.add_argument("--no-verify", dest="no_verify", action="store_true",
+                              help="Do not read the written blocks back to verify them")
     return parser.parse_args()
 
 
+# Flash an image built earlier, using the block map the build created next to it
+def flash_image(args: argparse.Namespace) -> None:
+    import bmap
+
+    device = args.flash_device if args.flash_device.startswith("/dev/") else f"/dev/{args.flash_device}"
+    for path in [args.flash_image, args.flash_bmap, device]:
+        if not path_exists(path):
+            print_error(f"{path} not found")
+            sys.exit(1)
+    # unmount all partitions
+    with contextlib.suppress(subprocess.CalledProcessError):
+        bash(f"umount -lf {device}*")
+    bmap.flash(args.flash_image, args.flash_bmap, device, verify=not args.no_verify)
+    print_header("It is safe to remove the USB-drive/SD-card now.")
+
+
 class ExitHooks(object):
     def __init__(self):
         self.exit_code = None
@@ -92,6 +159,14 @@ if __name__ == "__main__":
         sudo_args = ['sudo', sys.executable] + sys.argv + [os.environ]
         os.execlpe('sudo', *sudo_args)
 
+    if args.command == "flash":
+        flash_image(args)
+        sys.exit(0)
+
+    # Restart the script in its own mount namespace, see enter_build_namespace()
+    enter_build_namespace()
+    set_work_dir(args.work_dir)
+
     # PATH vars are inherited in chroots -> check if the current path has /usr/sbin, as some systems dont have that var
     # but some chroot distros expect them to be set
     if not os.environ.get("PATH").__contains__("/usr/sbin"):
@@ -99,7 +174,7 @@ if __name__ == "__main__":
 
     # check script dependencies are already installed with which
     try:
-        bash("which pv xz parted cgpt futility")
+        bash("which xz futility")
         print_status("Dependencies already installed, skipping")
     except subprocess.CalledProcessError:
         print_status("Installing dependencies")
@@ -115,22 +190,22 @@ if __name__ == "__main__":
             # Install downloaded package
             bash("pacman --noconfirm -U /tmp/cgpt-vboot-utils.pkg.tar.gz")
             # Install other dependencies
-            bash("pacman --noconfirm -S pv xz parted")
+            bash("pacman --noconfirm -S xz")
         elif distro.lower().__contains__("void"):
             bash("xbps-install -y --sync")
-            bash("xbps-install -y pv xz parted cgpt vboot-utils")
+            bash("xbps-install -y xz vboot-utils")
         elif distro.lower().__contains__("ubuntu") or distro.lower().__contains__("debian"):
             bash("apt-get update -y")  # sync repos
-            bash("apt-get install -y pv xz-utils parted cgpt vboot-kernel-utils")
+            bash("apt-get install -y xz-utils vboot-kernel-utils")
         elif distro.lower().__contains__("suse"):
             bash("zypper --non-interactive refresh")  # sync repos
-            bash("zypper --non-interactive install vboot parted pv xz")  # cgpt is included in vboot-utils on fedora
+            bash("zypper --non-interactive install vboot xz")  # futility is included in vboot
         elif distro.lower().__contains__("fedora"):
             bash("dnf update -y")  # sync repos
-            bash("dnf install -y vboot-utils parted pv xz")  # cgpt is included in vboot-utils on fedora
+            bash("dnf install -y vboot-utils xz")  # futility is included in vboot-utils on fedora
         else:
             print_warning("Script dependencies not found, please install the following packages with your package "
-                          "manager: which pv xz parted cgpt futility")
+                          "manager: which xz futility")
             sys.exit(1)
 
     # Check python version
@@ -211,6 +286,26 @@ if __name__ == "__main__":
         print_warning("Verbosity increased")
     if args.no_shrink:
         print_warning("Image will not be shrunk")
+    if args.no_cache:
+        print_warning("Download cache disabled")
+    if args.package_proxy:
+        print_warning("Caching packages through the package proxy")
+    if args.package_cache:
+        print_warning("Keeping downloaded packages in the package archive cache")
+    if args.stage_cache:
+        print_warning("Reusing cached build stages if possible, packages might not be the newest ones")
+    if args.no_mirror_ranking:
+        print_warning("Mirror ranking disabled")
+    if args.no_prefetch:
+        print_warning("Package prefetching disabled")
+    if args.unsafe_io:
+        print_warning("Package managers won't sync to disk, the image/device is only synced at the end")
+    if args.build_in_image:
+        print_warning("Building on a local image, the USB/SD-card is only written at the end")
+    if args.exact_size:
+        print_warning(f"Creating the image with the exact size of the rootfs plus {args.exact_size_headroom}MB")
+    if args.work_dir != "/mnt/depthboot":
+        print_warning(f"Work dir overridden to {args.work_dir}")
     if args.image_size[0] != 10:
         print_warning(f"Image size overridden to {args.image_size[0]}GB")
 
@@ -229,31 +324,32 @@ if __name__ == "__main__":
     mkdir("/tmp/depthboot-build", create_parents=True)
 
     print_status("Unmounting old depthboot mounts if present")
-    try:
-        bash("umount -lf /mnt/depthboot")  # just in case
-        sleep(5)  # wait for umount to finish
-        bash("umount -lf /mnt/depthboot")  # umount a second time, coz first time might not work
-    except subprocess.CalledProcessError:
-        print("Failed to unmount /mnt/depthboot, ignore")
-    rmdir("/mnt/depthboot")
-    mkdir("/mnt/depthboot", create_parents=True)
+    # Builds run in their own mount namespace -> only builds without one leave mounts behind. A lazy unmount detaches
+    # the mounts immediately, even if they are busy.
+    with contextlib.suppress(subprocess.CalledProcessError):  # not mounted
+        bash(f"umount -lR {root_path()}")
+    remove_root_dir()
+    mkdir(root_path(), create_parents=True)
 
     rmfile("depthboot.img")
+    rmfile("depthboot.bmap")
     rmfile("kernel.flags")
-    rmfile(".stop_download_progress")
 
     # Check if there is enough space in /tmp
     avail_space = int(bash("BLOCK_SIZE=m df --output=avail /tmp").split("\n")[1][:-1])  # read tmp size in MB
     restore_tmp = False
 
-    if user_input["device"] == "image" and avail_space < 13000 and not args.skip_size_check:
-        print_warning("Not enough space in /tmp to build image. At least 13GB is required")
+    # The rootfs archive isn't stored in /tmp when streaming it -> less space is needed
+    required_space = 10 if args.stream_rootfs and not args.local_path else 13  # in GB
+    if (user_input["device"] == "image" or args.build_in_image) and avail_space < required_space * 1000 and \
+            not args.skip_size_check:
+        print_warning(f"Not enough space in /tmp to build image. At least {required_space}GB is required")
         # check if /tmp is a tmpfs mount
         if bash("df --output=fstype /tmp").__contains__("tmpfs"):
             user_answer = input("\033[92m" + "Remount /tmp to increase its size? (Y/n)\n" + "\033[0m").lower()
             if user_answer in ["y", ""]:
                 print_status("Increasing size of /tmp")
-                bash("mount -o remount,size=13G /tmp")
+                bash(f"mount -o remount,size={required_space}G /tmp")
                 print_status("Size of /tmp increased")
                 restore_tmp = True
             else:
@@ -0,0 +1,120 @@
+# Rank package mirrors by latency and throughput
+# All candidates get a HEAD request to measure the latency, the fastest ones then download a short sample of a small
+# repo file to measure the throughput. The results are cached for a while, so that following builds don't have to
+# probe again. Mirrors that didn't answer are cached as well, to not wait for their timeouts on every build.
+# Format of the cache file:
+#   {"<url of the probed file>": {"latency": seconds or null, "throughput": bytes/s or null, "time": unix time}}
+import json
+import time
+from queue import Empty, Queue
+from threading import Lock, Thread
+from urllib.request import ProxyHandler, Request, build_opener
+
+from functions import *
+
+enabled = False
+cache_file = ""  # empty -> results are only kept for this build
+cache_ttl = 86400  # in seconds
+probe_workers = 16
+probe_timeout = 3  # in seconds
+sample_size = 262144  # bytes of the throughput sample
+sample_candidates = 3  # times the number of requested mirrors that get a throughput sample
+# Only the mirror itself should be measured, not the package proxy
+_opener = build_opener(ProxyHandler({}))
+_results = {}
+_lock = Lock()
+
+
+def configure(new_cache_file: str) -> None:
+    global enabled, cache_file
+    enabled = True
+    cache_file = new_cache_file
+    if cache_file:
+        with contextlib.suppress(FileNotFoundError, json.JSONDecodeError):
+            with open(cache_file, "r") as file:
+                _results.update(json.load(file))
+
+
+# Returns up to count mirrors from candidates, the fastest first. probe_path is a small file relative to the mirror
+# url, that exists on all mirrors. Returns an empty list if ranking is disabled or no mirror answered.
+def rank(candidates: list, probe_path: str, count: int) -> list:
+    if not enabled:
+        return []
+    print_status(f"Ranking {len(candidates)} mirrors")
+    candidates = list(dict.fromkeys(candidates))  # remove duplicates, keep the order
+    urls = {mirror: f"{mirror.rstrip('/')}/{probe_path}" for mirror in candidates}
+    # latency of all candidates
+    _run_parallel(_probe_latency, [url for url in urls.values() if not _is_fresh(url)])
+    reachable = sorted([mirror for mirror, url in urls.items() if _results[url]["latency"] is not None],
+                       key=lambda mirror: _results[urls[mirror]]["latency"])
+    # throughput of the ones with the lowest latency
+    sampled = reachable[:count * sample_candidates]
+    _run_parallel(_probe_throughput, [urls[mirror] for mirror in sampled if
+                                      _results[urls[mirror]]["throughput"] is None])
+    _save()
+    ranked = sorted([mirror for mirror in sampled if _results[urls[mirror]]["throughput"]],
+                    key=lambda mirror: _score(_results[urls[mirror]]))
+    for mirror in ranked[:count]:
+        print_status(f"Using mirror {mirror}: {_results[urls[mirror]]['latency'] * 1000:.0f}ms, "
+                     f"{_results[urls[mirror]]['throughput'] / 1048576:.1f}MB/s")
+    return ranked[:count]
+
+
+# estimated time to download 1MB, a package is usually about that size
+def _score(result: dict) -> float:
+    return result["latency"] + 1048576 / result["throughput"]
+
+
+def _is_fresh(url: str) -> bool:
+    return url in _results and time.time() - _results[url]["time"] < cache_ttl
+
+
+def _probe_latency(url: str) -> None:
+    start = time.monotonic()
+    try:
+        with _opener.open(Request(url, method="HEAD"), timeout=probe_timeout):
+            latency = time.monotonic() - start
+    except (OSError, ValueError):  # includes HTTP errors, timeouts and invalid urls
+        latency = None
+    with _lock:
+        _results[url] = {"latency": latency, "throughput": None, "time": time.time()}
+
+
+def _probe_throughput(url: str) -> None:
+    # servers without range support send the whole file -> only read the sample
+    request = Request(url, headers={"Range": f"bytes=0-{sample_size - 1}"})
+    throughput = 0.0
+    try:
+        with _opener.open(request, timeout=probe_timeout) as response:
+            start = time.monotonic()  # after the response headers -> the latency is not part of the throughput
+            received = len(response.read(sample_size))
+            throughput = received / max(time.monotonic() - start, 0.001)
+    except (OSError, ValueError):
+        pass
+    with _lock:
+        _results[url]["throughput"] = throughput
+
+
+def _run_parallel(function, urls: list) -> None:
+    jobs = Queue()
+    for url in urls:
+        jobs.put(url)
+
+    def worker():
+        while not jobs.empty():
+            with contextlib.suppress(Empty):
+                function(jobs.get_nowait())
+
+    workers = [Thread(target=worker, daemon=True) for _ in range(min(probe_workers, len(urls)))]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def _save() -> None:
+    if not cache_file:
+        return
+    with open(f"{cache_file}.tmp", "w") as file:
+        json.dump(_results, file)
+    os.replace(f"{cache_file}.tmp", cache_file)  # atomic -> parallel builds never read a partial file
@@ -0,0 +1,62 @@
+# Persistent package-archive caches for the package managers in the chroot
+# A host dir per distro release is bind-mounted over the package cache dir of the chroot. Downloaded packages are kept
+# on the host for the next build of the same release and never end up in the image.
+# Layout of the cache dir:
+#   <distro_name>-<distro_version>/   -> contents of the package cache dir of the chroot
+import os
+
+from functions import *
+
+# package cache dir of the package manager of each distro
+chroot_cache_dirs = {
+    "ubuntu": "/var/cache/apt/archives",
+    "pop-os": "/var/cache/apt/archives",
+    "arch": "/var/cache/pacman/pkg",
+    "fedora": "/var/cache/dnf"  # dnf only keeps the packages with keepcache enabled, see distro/fedora.py
+}
+cache_dir = ""  # empty -> cache disabled
+release_dir = ""
+chroot_dir = ""
+max_cache_size = 10 * 1073741824  # bytes, for all releases together
+
+
+def configure(new_cache_dir: str, max_size_gb: int, distro_name: str, distro_version: str) -> None:
+    global cache_dir, release_dir, chroot_dir, max_cache_size
+    cache_dir = get_full_path(new_cache_dir)
+    release_dir = f"{cache_dir}/{distro_name}-{distro_version}"
+    chroot_dir = root_path(chroot_cache_dirs[distro_name])
+    max_cache_size = max_size_gb * 1073741824
+    mkdir(release_dir, create_parents=True)
+    os.chmod(cache_dir, 0o700)
+    if distro_name in ["ubuntu", "pop-os"]:
+        mkdir(f"{release_dir}/partial")  # apt expects it to exist
+
+
+def is_enabled() -> bool:
+    return cache_dir != ""
+
+
+def mount() -> None:
+    mkdir(chroot_dir, create_parents=True)
+    bash(f"mount --bind {release_dir} {chroot_dir}")
+
+
+def umount() -> None:
+    with contextlib.suppress(subprocess.CalledProcessError):  # not mounted
+        bash(f"umount {chroot_dir}")
+
+
+# Delete the least recently used packages of all releases until the cache is below its size limit
+def prune() -> None:
+    files = []
+    for root, _, file_names in os.walk(cache_dir):
+        for file_name in file_names:
+            file_stat = os.stat(f"{root}/{file_name}", follow_symlinks=False)
+            # atime is only updated once a day with the default relatime mount option -> accurate enough
+            files.append((max(file_stat.st_atime, file_stat.st_mtime), file_stat.st_size, f"{root}/{file_name}"))
+    cache_size = sum(file[1] for file in files)
+    for _, size, path in sorted(files):
+        if cache_size <= max_cache_size:
+            break
+        rmfile(path)
+        cache_size -= size
@@ -0,0 +1,200 @@
+# Declarative package plans for the distro configs
+# Every package manager call resolves dependencies, reads the package database and runs its hooks again. The packages
+# of a stage are therefore collected into as few transactions as possible, including removals where the package
+# manager supports them in the same transaction (apt: "package-" in an install).
+# A transaction is a dict: {"install": [packages], "remove": [packages]}. Groups are written as "@Group name" (dnf).
+# Transactions are only split where the order matters, the reason is noted next to each split.
+import prefetch
+from functions import *
+
+KERNEL = "<kernel>"  # placeholder for the eupnea kernel package of the selected kernel type
+# stdout of the running package manager command, or the apt status lines. The command writes it inside the chroot.
+package_manager_log = "/tmp/depthboot-package-manager.log"
+kernel_packages = {
+    "mainline": "eupnea-mainline-kernel",
+    "chromeos": "eupnea-chromeos-kernel"
+}
+
+# Packages of the base stage, after the repos were added and the system was updated
+base_plans = {
+    "ubuntu": [
+        {"install": ["linux-firmware", "network-manager", "software-properties-common", "nano", "eupnea-utils",
+                     "eupnea-system", KERNEL]}
+    ],
+    "pop-os": [
+        {"install": ["eupnea-utils", "eupnea-system", "keyd", KERNEL]}
+    ],
+    "fedora": [
+        {"install": ["eupnea-system", "eupnea-utils", KERNEL, "@Core", "@Hardware Support",
+                     "@Common NetworkManager Submodules", "linux-firmware"]}
+    ],
+    "arch": [
+        {"install": ["base", "base-devel", "nano", "networkmanager", "xkeyboard-config", "linux-firmware", "sudo",
+                     "bluez", "bluez-utils", "python3", "cgpt-vboot-utils", "zram-generator"]},
+        # the install scripts of the eupnea packages need python3 to be installed already
+        {"install": ["eupnea-utils", "eupnea-system", KERNEL]}
+    ]
+}
+
+# Packages of each de
+de_plans = {
+    "ubuntu": {
+        "gnome": [{"install": ["ubuntu-desktop", "gnome-software", "epiphany-browser", "wireplumber"]}],
+        "kde": [{"install": ["kde-standard", "plasma-workspace-wayland", "sddm-theme-breeze", "wireplumber"]}],
+        # install xfce without heavy unnecessary packages
+        "xfce": [{"install": ["xubuntu-desktop", "nano", "gnome-software", "epiphany-browser"],
+                  "remove": ["gimp", "gnome-font-viewer", "gnome-mines", "gnome-sudoku", "gucharmap", "hexchat",
+                             "libreoffice-*", "mate-calc", "pastebinit", "synaptic", "thunderbird",
+                             "transmission-gtk"]}],
+        "lxqt": [{"install": ["lubuntu-desktop", "discover", "konqueror"]}],
+        # the deepin install always fails in a chroot -> distro/ubuntu.py fixes dpkg between the two transactions
+        "deepin": [{"install": ["ubuntudde-dde"]},
+                   {"install": ["discover", "konqueror"]}],
+        # do not install tex-common, it breaks the installation
+        "budgie": [{"install": ["lightdm", "lightdm-gtk-greeter", "ubuntu-budgie-desktop"], "remove": ["tex-common"]}],
+        "cinnamon": [{"install": ["cinnamon-desktop-environment"]}],
+        "cli": [{}]
+    },
+    # Pop!_OS only comes with its own gnome based desktop, which is already in the rootfs
+    "pop-os": {
+        "cosmic-gnome": [{}]
+    },
+    "fedora": {
+        # Fedora has gnome by default in a workstation install
+        "gnome": [{"install": ["@Fedora Workstation", "firefox"]}],
+        "kde": [{"install": ["@KDE Plasma Workspaces", "firefox"]}],
+        "xfce": [{"install": ["@Xfce Desktop", "firefox", "gnome-software", "xfce4-pulseaudio-plugin"]}],
+        "lxqt": [{"install": ["@LXQt Desktop", "plasma-discover"]}],
+        "deepin": [{"install": ["@Deepin Desktop", "plasma-discover"]}],
+        "budgie": [{"install": ["budgie-desktop", "lightdm", "lightdm-gtk", "xorg-x11-server-Xorg", "gnome-terminal",
+                                "firefox", "gnome-software", "nemo"]}],
+        "cinnamon": [{"install": ["@Cinnamon Desktop"]}],
+        # install network tui
+        "cli": [{"install": ["NetworkManager-tui"]}]
+    },
+    "arch": {
+        "gnome": [{"install": ["gnome", "gnome-extra"]}],
+        "kde": [{"install": ["plasma-meta", "plasma-wayland-session", "kde-system-meta", "kde-utilities-meta",
+                             "packagekit-qt5", "firefox"]}],
+        # no wayland support in xfce
+        # xfce doesn't have proper audio settings and uses pavucontrol instead
+        # xfce does not have any audio servers as dependencies -> manually install pipewire
+        "xfce": [{"install": ["xfce4", "xfce4-goodies", "xorg", "xorg-server", "lightdm", "lightdm-gtk-greeter",
+                              "network-manager-applet", "nm-connection-editor", "xfce4-pulseaudio-plugin",
+                              "pavucontrol", "pipewire", "gnome-software", "firefox", "wireplumber"]}],
+        "lxqt": [{"install": ["lxqt", "breeze-icons", "xorg", "xorg-server", "sddm", "firefox", "networkmanager-qt",
+                              "network-manager-applet", "nm-connection-editor", "discover", "packagekit-qt5"]}],
+        "deepin": [{"install": ["deepin", "deepin-kwin", "deepin-extra", "xorg", "xorg-server", "lightdm",
+                                "kde-applications", "firefox", "discover", "packagekit-qt5"]}],
+        "budgie": [{"install": ["lightdm", "lightdm-gtk-greeter", "budgie-desktop", "budgie-desktop-view",
+                                "budgie-screensaver", "budgie-control-center", "xorg", "xorg-server",
+                                "network-manager-applet", "gnome-terminal", "firefox", "gnome-software", "nemo"]}],
+        "cinnamon": [{"install": ["cinnamon", "cinnamon-translations", "lightdm", "lightdm-gtk-greeter", "xed",
+                                  "xreader", "gnome-terminal", "system-config-printer", "gnome-keyring",
+                                  "blueberry"]}],
+        "cli": [{}]
+    }
+}
+
+# Added to the last transaction of every de except cli
+gui_plans = {
+    # Replace input-synaptics with newer input-libinput, for better touchpad support
+    "ubuntu": {"install": ["xserver-xorg-input-libinput", "keyd"], "remove": ["xserver-xorg-input-synaptics"]},
+    "pop-os": {"install": ["xserver-xorg-input-libinput"], "remove": ["xserver-xorg-input-synaptics"]},
+    "fedora": {"install": ["keyd"]},
+    # auto-rotate service and keyd
+    "arch": {"install": ["iio-sensor-proxy", "keyd"]}
+}
+
+
+def base_transactions(distro_name: str, kernel_type: str) -> list:
+    return [_transaction(transaction, kernel_type) for transaction in base_plans[distro_name]]
+
+
+# Exits if the de is not available for the distro
+def de_transactions(distro_name: str, de_name: str, distro_version: str) -> list:
+    if distro_name == "pop-os":
+        de_name = "cosmic-gnome"  # the only option
+    if de_name not in de_plans[distro_name]:
+        print_error(f"Invalid desktop environment: {de_name}. Please create an issue")
+        exit(1)
+    transactions = [_transaction(transaction) for transaction in de_plans[distro_name][de_name]]
+    if de_name != "cli":
+        transactions[-1]["install"] += gui_plans[distro_name].get("install", [])
+        transactions[-1]["remove"] += gui_plans[distro_name].get("remove", [])
+        # Install libasound2 backport on jammy
+        if distro_name == "ubuntu" and distro_version == "22.04":
+            transactions[-1]["install"].append("libasound2-eupnea")
+    return transactions
+
+
+def run(distro_name: str, transactions: list) -> None:
+    for transaction in transactions:
+        prefetch.place(transaction)
+        for command in commands(distro_name, transaction):
+            _run_tracked(distro_name, command)
+
+
+# Compile a transaction into package manager commands, usually only one
+def commands(distro_name: str, transaction: dict) -> list:
+    install = transaction.get("install", [])
+    remove = transaction.get("remove", [])
+    match distro_name:
+        case "ubuntu" | "pop-os":
+            if not install and not remove:
+                return []
+            # apt removes packages with a "-" suffix in the same transaction
+            # noninteractive -> no prompts from debconf, e.g. for the display manager
+            return ["DEBIAN_FRONTEND=noninteractive apt-get install -y " +
+                    " ".join(install + [f"{package}-" for package in remove])]
+        case "fedora":
+            # dnf 4 can't remove packages in an install transaction
+            return ([f"dnf remove -y {_quote(remove)}"] if remove else []) + \
+                ([f"dnf install -y {_quote(install)}"] if install else [])
+        case "arch":
+            return ([f"pacman -R --noconfirm {' '.join(remove)}"] if remove else []) + \
+                ([f"pacman -S --noconfirm --needed {' '.join(install)}"] if install else [])
+
+
+# Run a package manager command and publish its progress, see the trackers in functions.py
+def _run_tracked(distro_name: str, command: str) -> None:
+    if verbose:
+        chroot(command)  # the output is printed instead
+        return
+    host_log = root_path(package_manager_log)
+    rmfile(host_log)
+    finished = Event()
+    match distro_name:
+        case "ubuntu" | "pop-os":
+            # apt writes its status lines to fd 3, the normal output is returned by chroot() and ignored
+            command = command.replace("apt-get ", "apt-get -o APT::Status-Fd=3 ", 1)
+            redirect = f"3>{package_manager_log}"
+            tracker = track_apt(host_log, finished)
+        case "fedora":
+            redirect = f">{package_manager_log}"
+            tracker = track_dnf(host_log, finished)
+        case _:
+            redirect = f">{package_manager_log}"
+            tracker = track_pacman(host_log, finished)
+    try:
+        chroot(f"{command} {redirect}")  # errors still go to stderr
+    finally:
+        finished.set()
+        tracker.join()
+        rmfile(host_log)
+
+
+# Copy a transaction of a plan and replace the kernel placeholder
+def _transaction(transaction: dict, kernel_type: str = "") -> dict:
+    install = []
+    for package in transaction.get("install", []):
+        if package != KERNEL:
+            install.append(package)
+        elif kernel_type in kernel_packages:
+            install.append(kernel_packages[kernel_type])
+    return {"install": install, "remove": list(transaction.get("remove", []))}
+
+
+# group names contain spaces -> single quotes for the shell in the chroot
+def _quote(packages: list) -> str:
+    return " ".join(f"'{package}'" if " " in package else package for package in packages)
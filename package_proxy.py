@@ -0,0 +1,251 @@
+# Local caching forward proxy for the package managers inside the chroot
+# Package files are immutable (the version is part of the file name), so they can be served from disk on later builds
+# without asking the mirror again. Everything else (repo metadata, https via CONNECT) is passed through uncached.
+# Layout of the proxy cache dir:
+#   blobs/<sha256 of url>  -> cached package files
+#   staging/               -> packages that are still being downloaded
+import hashlib
+import os
+import select
+import socket
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
+from urllib.request import ProxyHandler, Request, build_opener
+
+from functions import *
+
+# Only these files are cached. Signatures of arch packages are as immutable as the packages themselves.
+cacheable_suffixes = (".deb", ".udeb", ".ddeb", ".rpm", ".drpm", ".pkg.tar.zst", ".pkg.tar.xz", ".pkg.tar.zst.sig",
+                      ".pkg.tar.xz.sig")
+# Request headers that are passed on to the mirror
+forwarded_headers = ["User-Agent", "Accept", "Range", "If-Range", "If-Modified-Since", "If-None-Match",
+                     "Cache-Control", "Pragma"]
+# Hop-by-hop response headers, these are only valid between the mirror and the proxy
+hop_headers = ["connection", "keep-alive", "proxy-authenticate", "proxy-connection", "transfer-encoding", "te",
+               "trailer", "upgrade"]
+
+cache_dir = ""
+max_cache_size = 10 * 1073741824  # bytes
+cache_size = 0  # current size of the blobs in bytes
+stats = {"hits": 0, "hit_bytes": 0, "misses": 0, "miss_bytes": 0}
+server = None
+_lock = Lock()
+# The proxy itself must never use the http_proxy env var, which points at the proxy while the distro is configured
+_opener = build_opener(ProxyHandler({}))
+
+# Arch mirrors are https by default, which can't be cached without breaking tls. The packages are signed, so plain http
+# mirrors are used while the proxy is active. Urls of the rewritten mirrors, to restore them afterwards. The distro
+# config might add lines to the mirrorlist in between, see distro/arch.py
+_rewritten_mirrors = set()
+
+
+def start(new_cache_dir: str, max_size_gb: int) -> None:
+    global cache_dir, max_cache_size, cache_size, server
+    cache_dir = get_full_path(new_cache_dir)
+    max_cache_size = max_size_gb * 1073741824
+    for sub_dir in ["blobs", "staging"]:
+        mkdir(f"{cache_dir}/{sub_dir}", create_parents=True)
+    os.chmod(cache_dir, 0o700)
+    # leftovers from interrupted builds
+    for file in os.listdir(f"{cache_dir}/staging"):
+        rmfile(f"{cache_dir}/staging/{file}")
+    cache_size = sum(os.path.getsize(f"{cache_dir}/blobs/{blob}") for blob in os.listdir(f"{cache_dir}/blobs"))
+    for key in stats:
+        stats[key] = 0
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _ProxyRequestHandler)  # port 0 -> any free port
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    print_status(f"Package proxy listening on {address()}")
+
+
+def stop() -> None:
+    global server
+    if server is None:
+        return
+    server.shutdown()
+    server.server_close()
+    server = None
+    print_status(f"Package proxy: {stats['hits']} cached packages ({stats['hit_bytes'] // 1048576}mb), "
+                 f"{stats['misses']} downloaded ({stats['miss_bytes'] // 1048576}mb)")
+
+
+def address() -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# Point the package manager of the distro in the root dir at the proxy.
+# apt, dnf and pacman all respect the http_proxy env var, which chroot() passes on. Nothing is written into the image
+# except for the arch mirrorlist, which is restored by remove().
+# The chroot shares the network namespace with the host -> 127.0.0.1 is reachable from inside it.
+def inject(distro_name: str) -> None:
+    os.environ["http_proxy"] = address()
+    if distro_name == "arch":
+        with open(root_path("/etc/pacman.d/mirrorlist"), "r") as file:
+            mirrors = file.readlines()
+        _rewritten_mirrors.clear()
+        for index, line in enumerate(mirrors):
+            if "Server = https://" in line:
+                mirrors[index] = line.replace("Server = https://", "Server = http://")
+                _rewritten_mirrors.add(mirrors[index].split("=", 1)[1].strip())
+        with open(root_path("/etc/pacman.d/mirrorlist"), "w") as file:
+            file.writelines(mirrors)
+
+
+# Remove the proxy config again, the proxy is not available on the booted system
+def remove(distro_name: str) -> None:
+    os.environ.pop("http_proxy", None)
+    if distro_name == "arch":
+        with open(root_path("/etc/pacman.d/mirrorlist"), "r") as file:
+            mirrors = file.readlines()
+        for index, line in enumerate(mirrors):
+            if "Server = http://" in line and line.split("=", 1)[1].strip() in _rewritten_mirrors:
+                mirrors[index] = line.replace("Server = http://", "Server = https://")
+        with open(root_path("/etc/pacman.d/mirrorlist"), "w") as file:
+            file.writelines(mirrors)
+
+
+# Delete the least recently used packages until the cache is below its size limit
+def evict() -> None:
+    global cache_size
+    with _lock:
+        if cache_size <= max_cache_size:
+            return
+        blobs = []
+        for blob in os.listdir(f"{cache_dir}/blobs"):
+            blob_stat = os.stat(f"{cache_dir}/blobs/{blob}")
+            blobs.append((blob_stat.st_mtime, blob_stat.st_size, blob))
+        for _, size, blob in sorted(blobs):
+            if cache_size <= max_cache_size:
+                break
+            rmfile(f"{cache_dir}/blobs/{blob}")
+            cache_size -= size
+
+
+def _is_cacheable(url: str) -> bool:
+    return urlsplit(url).path.endswith(cacheable_suffixes)
+
+
+def _blob_path(url: str) -> str:
+    return f"{cache_dir}/blobs/{hashlib.sha256(url.encode()).hexdigest()}"
+
+
+class _ProxyRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, apt sends all requests over one connection
+
+    def do_GET(self) -> None:
+        self._handle()
+
+    def do_HEAD(self) -> None:
+        self._handle()
+
+    # https -> tunnel the encrypted connection, nothing can be cached here
+    def do_CONNECT(self) -> None:
+        host, port = self.path.rsplit(":", 1)
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=30)
+        except OSError:
+            self.send_error(502)
+            return
+        self.send_response(200, "Connection established")
+        self.end_headers()
+        self.close_connection = True
+        with upstream:
+            sockets = [self.connection, upstream]
+            while True:
+                readable = select.select(sockets, [], sockets, 60)[0]
+                if not readable:
+                    return  # idle for a minute
+                for sock in readable:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    (upstream if sock is self.connection else self.connection).sendall(data)
+
+    def log_message(self, *args) -> None:
+        if verbose:
+            super().log_message(*args)
+
+    def _handle(self) -> None:
+        if not self.path.startswith("http://"):
+            self.send_error(400, "Only absolute http urls are supported")
+            return
+        if self.command == "GET" and _is_cacheable(self.path):
+            blob = _blob_path(self.path)
+            if path_exists(blob):
+                self._send_blob(blob)
+                return
+        self._forward()
+
+    def _send_blob(self, blob: str) -> None:
+        os.utime(blob)  # mark as recently used for eviction
+        size = os.path.getsize(blob)
+        self.send_response(200)
+        self.send_header("Content-Length", str(size))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        with open(blob, "rb") as file:
+            self.connection.sendfile(file)
+        with _lock:
+            stats["hits"] += 1
+            stats["hit_bytes"] += size
+
+    # Pass the request on to the mirror. Cacheable files are requested completely and written to the cache while they
+    # are sent to the client.
+    def _forward(self) -> None:
+        global cache_size
+        cache = self.command == "GET" and _is_cacheable(self.path)
+        headers = {name: self.headers[name] for name in forwarded_headers if name in self.headers}
+        if cache:
+            for name in ["Range", "If-Range", "If-Modified-Since", "If-None-Match"]:
+                headers.pop(name, None)
+        try:
+            response = _opener.open(Request(self.path, headers=headers, method=self.command), timeout=60)
+        except HTTPError as e:
+            response = e  # error responses are passed on as they are
+            cache = False
+        except (URLError, OSError):
+            self.send_error(502)
+            return
+
+        with response:
+            length = response.headers.get("Content-Length")
+            self.send_response(response.status)
+            for name, value in response.headers.items():
+                if name.lower() not in hop_headers:
+                    self.send_header(name, value)
+            if length is None and self.command != "HEAD":
+                # no length -> the end of the body can only be signaled by closing the connection
+                self.send_header("Connection", "close")
+                self.close_connection = True
+            self.end_headers()
+            if self.command == "HEAD":
+                return
+
+            staging_file = f"{cache_dir}/staging/{os.path.basename(_blob_path(self.path))}.{os.getpid()}" \
+                           f".{self.connection.fileno()}"
+            received = 0
+            try:
+                with open(staging_file, "wb") if cache else contextlib.nullcontext() as staging:
+                    while data := response.read(1048576):
+                        self.wfile.write(data)
+                        if cache:
+                            staging.write(data)
+                        received += len(data)
+            except OSError:  # client disconnected or the mirror connection broke
+                rmfile(staging_file)
+                self.close_connection = True
+                return
+        if not cache:
+            return
+        if length is not None and received != int(length):
+            rmfile(staging_file)  # incomplete
+            return
+        os.replace(staging_file, _blob_path(self.path))
+        with _lock:
+            cache_size += received
+            stats["misses"] += 1
+            stats["miss_bytes"] += received
+        evict()
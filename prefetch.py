@@ -0,0 +1,133 @@
+# Download the packages of the whole build in the background, while the chroot is busy with other work
+# apt and pacman download the packages of a transaction mostly one after another and only start installing once all of
+# them are there. Once the repos of the distro are refreshed, the package urls of all planned transactions (see
+# package_plan.py) are resolved at once and downloaded concurrently into a staging dir on the host. Before a
+# transaction runs, its packages are moved into the package cache dir of the chroot -> the package manager finds them
+# there and only downloads what the prefetcher missed. Packages of later transactions keep downloading meanwhile.
+# dnf downloads in parallel itself (max_parallel_downloads) and keeps its cache per repo -> not prefetched.
+import os
+import shutil
+from queue import Queue
+from threading import Event, Thread
+from urllib.request import build_opener
+
+import package_cache
+import progress
+from functions import *
+
+prefetch_workers = 8
+staging_dir = "/tmp/depthboot-build/prefetch"
+
+distro_name = ""  # empty -> prefetching disabled
+planned_transactions = []
+_transaction_files = {}  # transaction key -> list of (file name, event set once the download is done)
+
+
+# transactions are all transactions of the build in the order they will run
+def configure(new_distro_name: str, transactions: list) -> None:
+    global distro_name, planned_transactions
+    if new_distro_name in ["ubuntu", "pop-os", "arch"]:
+        distro_name = new_distro_name
+        planned_transactions = transactions
+
+
+# Resolve the package urls and start downloading, needs refreshed repos in the chroot
+def start() -> None:
+    if not distro_name:
+        return
+    print_status("Prefetching packages in the background")
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    mkdir(staging_dir, create_parents=True)
+    downloads = []
+    known_files = set()
+    for transaction in planned_transactions:
+        try:
+            packages = _resolve(transaction)
+        except subprocess.CalledProcessError:
+            # e.g. the package comes from a repo that is only added later -> the package manager downloads it itself
+            print_warning("Couldn't resolve packages for prefetching, skipping them")
+            continue
+        files = []
+        for url, file_name, size in packages:
+            if file_name in known_files:  # needed by an earlier transaction, already installed when this one runs
+                continue
+            known_files.add(file_name)
+            files.append((file_name, Event()))
+            downloads.append((url, file_name, size, files[-1][1]))
+        _transaction_files[_key(transaction)] = files
+    if not downloads:
+        return
+    jobs = Queue()
+    for download in downloads:  # in order of the transactions -> the next transaction is never stuck behind later ones
+        jobs.put(download)
+    workers = min(prefetch_workers, len(downloads))
+    for _ in range(workers):
+        jobs.put(None)  # stop signal for the workers
+    # build the opener now, so that the http_proxy of the package proxy is used, see package_proxy.inject
+    opener = build_opener()
+    task = progress.start_task("Prefetching packages", sum(download[2] for download in downloads))
+    Thread(target=_finish_task, args=(task, [download[3] for download in downloads]), daemon=True).start()
+    for _ in range(workers):
+        Thread(target=_download_worker, args=(jobs, opener, task), daemon=True).start()
+
+
+# Wait for the prefetched packages of a transaction and move them into the package cache dir of the chroot
+def place(transaction: dict) -> None:
+    files = _transaction_files.pop(_key(transaction), [])
+    if not files:
+        return
+    cache_dir = root_path(package_cache.chroot_cache_dirs[distro_name])
+    for file_name, done in files:
+        done.wait()
+        # a failed download doesn't exist -> the package manager downloads it
+        with contextlib.suppress(FileNotFoundError):
+            shutil.move(f"{staging_dir}/{file_name}", f"{cache_dir}/{file_name}")
+
+
+# Returns a list of (url, file name, size in bytes or 0 if unknown) of the packages the transaction would download
+def _resolve(transaction: dict) -> list:
+    packages = []
+    if not transaction.get("install"):
+        return packages
+    match distro_name:
+        case "ubuntu" | "pop-os":
+            # --print-uris doesn't lock the package cache -> works while apt runs in the chroot
+            # Output lines: 'url' file_name size hash
+            removals = [f"{package}-" for package in transaction.get("remove", [])]
+            output = chroot(f"apt-get install -qq --print-uris {' '.join(transaction['install'] + removals)}")
+            for line in output.split("\n"):
+                fields = line.split()
+                if len(fields) >= 3 and fields[0].startswith("'"):
+                    packages.append((fields[0].strip("'"), fields[1], int(fields[2])))
+        case "arch":
+            # Output lines: url, file:// for packages that are already in the cache
+            output = chroot(f"pacman -Sp --needed --noconfirm {' '.join(transaction['install'])}")
+            for line in output.split("\n"):
+                if line.startswith(("http://", "https://")):
+                    packages.append((line.strip(), line.strip().split("/")[-1], 0))
+    return packages
+
+
+def _download_worker(jobs: Queue, opener, task: progress.Task) -> None:
+    while job := jobs.get():
+        url, file_name, _, done = job
+        try:
+            with opener.open(url, timeout=60) as response, open(f"{staging_dir}/{file_name}.part", "wb") as file:
+                while data := response.read(1048576):
+                    file.write(data)
+                    task.advance(len(data))
+            os.rename(f"{staging_dir}/{file_name}.part", f"{staging_dir}/{file_name}")
+        except OSError:  # includes URLError and timeouts
+            rmfile(f"{staging_dir}/{file_name}.part")
+        finally:
+            done.set()
+
+
+def _finish_task(task: progress.Task, events: list) -> None:
+    for event in events:
+        event.wait()
+    task.finish()
+
+
+def _key(transaction: dict) -> tuple:
+    return tuple(transaction.get("install", [])), tuple(transaction.get("remove", []))
@@ -0,0 +1,177 @@
+# Progress reporting for downloads, extraction and package installs
+# Stages create a task and publish their byte/item counters to it. Every change is passed to the subscribed renderers as
+# an event, there is no polling involved. The renderers limit how often they actually print something.
+import json
+import sys
+import time
+from threading import Lock
+from typing import Optional
+
+_lock = Lock()
+_subscribers = []
+_active_tasks = []
+
+
+class Task:
+    def __init__(self, name: str, total: int, unit: str):
+        self.name = name
+        self.total = total  # 0 if unknown
+        self.unit = unit  # "bytes" or a word like "packages"
+        self.done = 0
+        self.rate = 0.0  # units per second
+        self.started = time.monotonic()
+        self.finished = False
+        self._rate_time = self.started
+        self._rate_done = 0
+
+    def advance(self, amount: int) -> None:
+        with _lock:
+            self.done += amount
+            self._update_rate()
+            _publish("progress", self)
+
+    def update(self, done: int, total: int = None) -> None:
+        with _lock:
+            self.done = done
+            if total is not None:
+                self.total = total
+            self._update_rate()
+            _publish("progress", self)
+
+    def finish(self) -> None:
+        with _lock:
+            if self.finished:
+                return
+            self.finished = True
+            _active_tasks.remove(self)
+            _publish("finish", self)
+
+    # seconds until the task is finished, None if unknown
+    def eta(self) -> Optional[float]:
+        if not self.total or not self.rate:
+            return None
+        return max(self.total - self.done, 0) / self.rate
+
+    # exponential moving average over ~1 second windows
+    def _update_rate(self) -> None:
+        now = time.monotonic()
+        if now - self._rate_time < 1:
+            return
+        current_rate = (self.done - self._rate_done) / (now - self._rate_time)
+        self.rate = current_rate if not self.rate else self.rate * 0.7 + current_rate * 0.3
+        self._rate_time = now
+        self._rate_done = self.done
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.finish()
+
+
+def start_task(name: str, total: int = 0, unit: str = "bytes") -> Task:
+    task = Task(name, total, unit)
+    with _lock:
+        _active_tasks.append(task)
+        _publish("start", task)
+    return task
+
+
+# callback(event: str, task: Task, active_tasks: list) is called for every event with the progress lock held
+def subscribe(callback) -> None:
+    with _lock:
+        _subscribers.append(callback)
+
+
+# mode is "tty", "json" or "none"
+def set_mode(mode: str) -> None:
+    with _lock:
+        _subscribers.clear()
+        if mode == "tty":
+            _subscribers.append(TerminalRenderer().handle)
+        elif mode == "json":
+            _subscribers.append(JsonRenderer().handle)
+
+
+def _publish(event: str, task: Task) -> None:
+    for callback in _subscribers:
+        callback(event, task, _active_tasks)
+
+
+def _format_amount(amount: float, unit: str) -> str:
+    if unit == "bytes":
+        return "%.0f" % (amount / 1048576) + "mb"
+    return f"{amount:.0f}"
+
+
+def _format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "--:--"
+    minutes, seconds = divmod(int(seconds), 60)
+    return f"{minutes}:{seconds:02d}"
+
+
+# Prints all active tasks in one line, which is overwritten at most 4 times per second
+class TerminalRenderer:
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self._last_render = 0.0
+
+    def handle(self, event: str, task: Task, active_tasks: list) -> None:
+        now = time.monotonic()
+        if event == "progress" and now - self._last_render < self.interval:
+            return
+        self._last_render = now
+        if event == "finish":
+            # leave the final state of the task in the terminal
+            print("\r\033[K" + self._describe(task), flush=True)
+            if not active_tasks:
+                return
+        print("\r\033[K" + " | ".join(self._describe(active_task) for active_task in active_tasks), end="",
+              flush=True)
+
+    @staticmethod
+    def _describe(task: Task) -> str:
+        description = f"{task.name}: {_format_amount(task.done, task.unit)}"
+        if task.total:
+            description += f" / {_format_amount(task.total, task.unit)}"
+        if task.unit != "bytes":
+            description += f" {task.unit}"
+        if task.finished:
+            return description
+        if task.unit == "bytes":
+            description += f", {task.rate / 1048576:.1f}mb/s"
+        if task.total:
+            description += f", ETA {_format_eta(task.eta())}"
+        return description
+
+
+# Prints one json object per line, for CI logs and other programs. Progress events are limited to one per second per
+# task, start and finish events are always printed.
+class JsonRenderer:
+    def __init__(self, interval: float = 1):
+        self.interval = interval
+        self._last_render = {}
+
+    def handle(self, event: str, task: Task, active_tasks: list) -> None:
+        now = time.monotonic()
+        if event == "progress" and now - self._last_render.get(id(task), 0) < self.interval:
+            return
+        self._last_render[id(task)] = now
+        if event == "finish":
+            self._last_render.pop(id(task))
+        eta = task.eta()
+        sys.stdout.write(json.dumps({
+            "event": event,
+            "task": task.name,
+            "unit": task.unit,
+            "done": task.done,
+            "total": task.total,
+            "rate": round(task.rate, 1),
+            "eta": None if eta is None else round(eta),
+            "elapsed": round(now - task.started, 1)
+        }) + "\n")
+        sys.stdout.flush()
+
+
+set_mode("tty")
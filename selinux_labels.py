@@ -0,0 +1,198 @@
+# Set the SELinux labels (security.selinux xattrs) of the files in the root dir from the file_contexts of the image
+# Instead of running fixfiles, which needs a faked /proc and /sys in the chroot, the labels are set by the builder:
+#   without the stage cache: once in post_config, for all files
+#   with the stage cache: at the end of each stage, for the files in the upper dir of the stage overlay, i.e. only the
+#     ones the stage created or changed -> the labels end up in the stage cache layers. post_config then only labels
+#     the files it changed itself.
+# If the file_contexts changed since the last labeling (i.e. the policy was updated), or nothing was labeled yet, all
+# files are labeled, as the labels of the previous stages might be outdated.
+# Lookup rules as in libselinux (see file_contexts(5)): path substitutions first, then the last matching spec wins, with
+# specs without regex meta characters (exact paths) preferred over regexes.
+import hashlib
+import json
+import re
+import stat
+import warnings
+
+from functions import *
+
+# the file_contexts digest the image was last labeled with, removed by post_config. Path inside the image.
+index_file = "/.depthboot-selinux-labels"
+file_types = {"--": stat.S_IFREG, "-d": stat.S_IFDIR, "-l": stat.S_IFLNK, "-c": stat.S_IFCHR, "-b": stat.S_IFBLK,
+              "-s": stat.S_IFSOCK, "-p": stat.S_IFIFO}
+posix_classes = {"[:alnum:]": "a-zA-Z0-9", "[:alpha:]": "a-zA-Z", "[:digit:]": "0-9", "[:lower:]": "a-z",
+                 "[:upper:]": "A-Z", "[:space:]": r" \t\n\r\f\v", "[:xdigit:]": "0-9a-fA-F"}
+
+
+class _Spec:
+    def __init__(self, index: int, regex: str, file_type: int, context: str):
+        self.index = index  # position after sorting, the highest matching index wins
+        self.regex = re.compile(regex)
+        self.file_type = file_type  # 0 -> any type
+        self.context = context  # "<<none>>" -> don't label
+
+
+# Label the files that changed since since_ns (time.time_ns()). Only tree is walked: a dir with the contents of the
+# image dir image_dir, e.g. the upper dir of the stage overlay for "/". Nothing outside of it can have changed. The
+# labels are always set in the root dir. Returns False if the image has no SELinux policy.
+def label_changes(since_ns: int, tree: str = "", image_dir: str = "/") -> bool:
+    contexts_dir = _contexts_dir()
+    if not path_exists(f"{contexts_dir}/file_contexts"):
+        return False
+    # file timestamps come from a coarse clock, which lags behind time.time_ns() by a few ms. Relabeling a few files
+    # twice doesn't hurt.
+    since_ns = max(since_ns - 1000000000, 0)
+    digest = _contexts_digest(contexts_dir)
+    try:
+        with open(root_path(index_file), "r") as file:
+            if json.load(file)["file_contexts"] != digest:
+                since_ns = 0  # the policy changed -> relabel everything
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        since_ns = 0  # never labeled
+    if since_ns == 0:
+        print_status("Labeling all files for SELinux")
+        tree, image_dir = root_path(), "/"
+    else:
+        print_status("Labeling changed files for SELinux")
+        tree = tree or root_path(image_dir)
+    labeled = 0
+    if path_exists(tree):
+        labeled = _label_tree(tree, image_dir, _load_specs(contexts_dir), _load_substitutions(contexts_dir), since_ns)
+    print_status(f"Labeled {labeled} files")
+    with open(root_path(index_file), "w") as file:
+        json.dump({"file_contexts": digest}, file)
+    return True
+
+
+def remove_index() -> None:
+    rmfile(root_path(index_file))
+
+
+def _contexts_dir() -> str:
+    policy = "targeted"
+    with contextlib.suppress(FileNotFoundError):
+        with open(root_path("/etc/selinux/config"), "r") as file:
+            for line in file:
+                if line.startswith("SELINUXTYPE="):
+                    policy = line.split("=", 1)[1].strip()
+    return root_path(f"/etc/selinux/{policy}/contexts/files")
+
+
+def _contexts_digest(contexts_dir: str) -> str:
+    digest = hashlib.sha256()
+    for name in ["file_contexts", "file_contexts.homedirs", "file_contexts.local", "file_contexts.subs",
+                 "file_contexts.subs_dist"]:
+        with contextlib.suppress(FileNotFoundError):
+            with open(f"{contexts_dir}/{name}", "rb") as file:
+                digest.update(file.read())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+# Returns a dict: literal prefix of the regex -> specs with that prefix, the highest index first
+def _load_specs(contexts_dir: str) -> dict:
+    specs = []
+    for name in ["file_contexts", "file_contexts.homedirs", "file_contexts.local"]:
+        with contextlib.suppress(FileNotFoundError):
+            with open(f"{contexts_dir}/{name}", "r") as file:
+                for line in file:
+                    fields = line.split("#", 1)[0].split()
+                    if len(fields) in [2, 3]:
+                        specs.append((fields[0], file_types.get(fields[1], 0) if len(fields) == 3 else 0, fields[-1]))
+    # exact paths after the regexes, the order within both groups stays the same
+    specs = [spec for spec in specs if _has_meta_chars(spec[0])] + [spec for spec in specs if not
+                                                                     _has_meta_chars(spec[0])]
+    prefixes = {}
+    for index, (regex, file_type, context) in enumerate(specs):
+        for posix_class, replacement in posix_classes.items():
+            regex = regex.replace(posix_class, replacement)
+        try:
+            with warnings.catch_warnings():  # "possible nested set" warnings for posix style brackets
+                warnings.simplefilter("ignore")
+                spec = _Spec(index, regex, file_type, context)
+        except re.error:
+            print_warning(f"Ignoring invalid file_contexts regex: {regex}")
+            continue
+        prefixes.setdefault(_literal_prefix(regex), []).insert(0, spec)
+    return prefixes
+
+
+# Returns a list of (alias, path), paths starting with alias are looked up as path instead
+def _load_substitutions(contexts_dir: str) -> list:
+    substitutions = []
+    for name in ["file_contexts.subs_dist", "file_contexts.subs"]:
+        with contextlib.suppress(FileNotFoundError):
+            with open(f"{contexts_dir}/{name}", "r") as file:
+                for line in file:
+                    fields = line.split("#", 1)[0].split()
+                    if len(fields) == 2:
+                        substitutions.append((fields[0].rstrip("/"), fields[1].rstrip("/")))
+    return substitutions
+
+
+def _has_meta_chars(regex: str) -> bool:
+    return any(char in regex for char in ".^$?*+|[({\\")
+
+
+# The part of the regex before the first meta character, every path the regex matches starts with it
+def _literal_prefix(regex: str) -> str:
+    if "|" in regex:  # might be a top level alternation
+        return ""
+    for position, char in enumerate(regex):
+        if char in ".^$?*+|[({\\":
+            # the char before an optional quantifier might not be part of the path
+            return regex[:position - 1] if char in "?*{" else regex[:position]
+    return regex
+
+
+def _lookup(path: str, mode: int, prefixes: dict, substitutions: list) -> str:
+    for alias, original in substitutions:
+        if path == alias or path.startswith(f"{alias}/"):
+            path = original + path[len(alias):]
+            break
+    candidates = []
+    for length in range(len(path) + 1):
+        candidates += prefixes.get(path[:length], [])
+    for spec in sorted(candidates, key=lambda candidate: candidate.index, reverse=True):
+        if (not spec.file_type or spec.file_type == stat.S_IFMT(mode)) and spec.regex.fullmatch(path):
+            return spec.context
+    return "<<none>>"
+
+
+# Walk tree and label all files with a ctime of at least since_ns. Returns the number of labeled files.
+def _label_tree(tree: str, image_dir: str, prefixes: dict, substitutions: list, since_ns: int) -> int:
+    # mounts in the chroot (proc, resolv.conf from the host, ...) are not part of the image
+    with open("/proc/self/mountinfo", "r") as file:
+        mount_points = {line.split()[4] for line in file}
+    image_dir = image_dir.rstrip("/")
+    labeled = 0
+    pending_dirs = [tree]
+    tree_stat = os.stat(tree)
+    if tree_stat.st_ctime_ns >= since_ns:
+        labeled += _set_label(root_path(image_dir), image_dir or "/", tree_stat.st_mode, prefixes, substitutions)
+    while pending_dirs:
+        with os.scandir(pending_dirs.pop()) as entries:
+            for entry in entries:
+                image_path = image_dir + entry.path.removeprefix(tree)
+                if root_path(image_path) in mount_points:
+                    continue
+                # the upper dir of an overlay has the same mode and ctime as the file in the root dir
+                entry_stat = entry.stat(follow_symlinks=False)
+                if stat.S_ISCHR(entry_stat.st_mode) and entry_stat.st_rdev == 0:
+                    continue  # whiteout in the upper dir, the file was removed
+                if entry_stat.st_ctime_ns >= since_ns:
+                    labeled += _set_label(root_path(image_path), image_path, entry_stat.st_mode, prefixes,
+                                          substitutions)
+                if entry.is_dir(follow_symlinks=False):
+                    pending_dirs.append(entry.path)
+    return labeled
+
+
+# Returns 1 if the file was labeled
+def _set_label(path: str, image_path: str, mode: int, prefixes: dict, substitutions: list) -> int:
+    context = _lookup(image_path, mode, prefixes, substitutions)
+    if context == "<<none>>":
+        return 0
+    # libselinux stores the context with a terminating null byte
+    os.setxattr(path, "security.selinux", context.encode() + b"\0", follow_symlinks=False)
+    return 1
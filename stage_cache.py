@@ -0,0 +1,175 @@
+# Cache for the results of the build stages (rootfs extraction, distro agnostic config, distro base setup, de install)
+# Every stage runs on an overlayfs mounted at the root dir, with the results of the previous stages as lower layers.
+# The upper dir of the overlay, i.e. only what the stage changed, is then kept as a new layer. The key of a layer is a
+# hash of the stage inputs and the key of the previous layer -> a layer is only used if all stages before it had the
+# same inputs as well. Once all stages are done, the layers are flattened onto the actual rootfs partition, or into the
+# root dir itself if it's a plain staging dir (--exact-size).
+# Layout of the stage cache dir:
+#   layers/<key>/       -> upper dir of a finished stage
+#   layers/<key>.json   -> stage name, key of the previous layer and creation time
+#   work/               -> overlayfs work dir, the upper dir of the running stage and layers that can't be cached
+import hashlib
+import json
+import os
+import time
+
+from functions import *
+
+cache_dir = ""
+max_layer_age = 7 * 86400  # in seconds. Packages get updated -> old layers would result in outdated images
+target_dir = "/tmp/depthboot-build/target"  # the rootfs partition is mounted here while the stages run
+target_device = ""
+upper_dir = ""  # upper dir of the running stage, empty if no stage is running
+# With metacopy, changing only the metadata of a file from a lower layer (e.g. its SELinux label) doesn't copy its
+# contents to the upper dir
+metacopy = False
+_temp_layers = 0  # counter for names of layers that are not cached
+
+
+def configure(new_cache_dir: str, max_age_days: int) -> None:
+    global cache_dir, max_layer_age, metacopy
+    cache_dir = get_full_path(new_cache_dir)
+    max_layer_age = max_age_days * 86400
+    mkdir(f"{cache_dir}/layers", create_parents=True)
+    os.chmod(cache_dir, 0o700)  # the layers contain the password hash of the user
+    # leftovers from interrupted builds
+    _remove_tree(f"{cache_dir}/work")
+    mkdir(f"{cache_dir}/work/empty", create_parents=True)  # overlayfs needs at least one lower dir
+    # the parameters of overlayfs only exist once the module is loaded
+    with contextlib.suppress(subprocess.CalledProcessError):
+        bash("modprobe overlay 2>/dev/null")
+    metacopy = path_exists("/sys/module/overlay/parameters/metacopy")
+    prune()
+
+
+# Returns the key of the layer with the results of a stage
+def layer_key(parent_key: str, stage_name: str, inputs: dict) -> str:
+    return hashlib.sha256(json.dumps({
+        "parent": parent_key,
+        "stage": stage_name,
+        "inputs": inputs,
+        "builder": _builder_version(),
+        "metacopy": metacopy  # layers with metacopy files are only readable with metacopy=on
+    }, sort_keys=True).encode()).hexdigest()
+
+
+def has_layer(key: str) -> bool:
+    try:
+        with open(f"{cache_dir}/layers/{key}.json", "r") as file:
+            return time.time() - json.load(file)["created"] < max_layer_age
+    except (FileNotFoundError, json.JSONDecodeError, KeyError):
+        return False
+
+
+def layer_path(key: str) -> str:
+    return f"{cache_dir}/layers/{key}"
+
+
+# Move the rootfs partition from the root dir to target_dir, so that the overlay can be mounted at the root dir
+def prepare_target() -> None:
+    global target_device
+    if not os.path.ismount(root_path()):
+        target_device = ""  # no rootfs partition yet, see --exact-size
+        return
+    target_device = bash(f"findmnt -no SOURCE {root_path()}")
+    bash(f"umount {root_path()}")
+    mkdir(target_dir, create_parents=True)
+    bash(f"mount {target_device} {target_dir}")
+
+
+# Mount an overlay at the root dir for a new stage. layers are the paths of the previous layers, the oldest first.
+def begin_stage(layers: list) -> None:
+    global upper_dir
+    _remove_tree(f"{cache_dir}/work/upper")
+    _remove_tree(f"{cache_dir}/work/work")
+    mkdir(f"{cache_dir}/work/upper")
+    mkdir(f"{cache_dir}/work/work")
+    bash(f"mount -t overlay overlay -o lowerdir={_lower_dirs(layers)},upperdir={cache_dir}/work/upper,"
+         f"workdir={cache_dir}/work/work{_metacopy_option()} {root_path()}")
+    upper_dir = f"{cache_dir}/work/upper"
+
+
+# Unmount the overlay and keep its upper dir as a layer. Returns the path of the layer.
+# If key is empty, the layer is only kept until the end of the build.
+def finish_stage(key: str, parent_key: str, stage_name: str) -> str:
+    global _temp_layers, upper_dir
+    bash(f"umount {root_path()}")
+    upper_dir = ""
+    if not key:
+        _temp_layers += 1
+        layer = f"{cache_dir}/work/layer{_temp_layers}"
+        os.rename(f"{cache_dir}/work/upper", layer)
+        return layer
+    _remove_tree(layer_path(key))  # an expired layer with the same key
+    # The package managers might not have synced anything (--unsafe-io) -> sync before the layer is marked as valid
+    bash(f"sync -f {cache_dir}/work/upper")
+    os.rename(f"{cache_dir}/work/upper", layer_path(key))
+    with open(f"{layer_path(key)}.json", "w") as file:
+        json.dump({"stage": stage_name, "parent": parent_key, "created": time.time()}, file)
+    return layer_path(key)
+
+
+# Copy the merged layers onto the rootfs partition and mount it at the root dir again
+# Without a rootfs partition the merged layers are mounted at target_dir instead and copied into the plain root dir
+def flatten(layers: list) -> None:
+    print_status("Copying cached build stages to the rootfs partition")
+    # without an upper dir the overlay is read-only
+    if not target_device:
+        mkdir(target_dir, create_parents=True)
+        bash(f"mount -t overlay overlay -o lowerdir={_lower_dirs(layers)}{_metacopy_option()} {target_dir}")
+        cpdir(target_dir, root_path())
+        bash(f"umount {target_dir}")
+    else:
+        bash(f"mount -t overlay overlay -o lowerdir={_lower_dirs(layers)}{_metacopy_option()} {root_path()}")
+        cpdir(root_path(), target_dir)
+        bash(f"umount {root_path()}")
+        bash(f"umount {target_dir}")
+        bash(f"mount {target_device} {root_path()}")
+    _remove_tree(f"{cache_dir}/work")
+    mkdir(f"{cache_dir}/work/empty", create_parents=True)
+
+
+# Remove expired layers and layers whose previous layer doesn't exist anymore, as those can never be used again
+def prune() -> None:
+    layers = {}
+    for file in os.listdir(f"{cache_dir}/layers"):
+        if not file.endswith(".json"):
+            continue
+        try:
+            with open(f"{cache_dir}/layers/{file}", "r") as metadata:
+                layers[file[:-5]] = json.load(metadata)
+        except json.JSONDecodeError:
+            layers[file[:-5]] = {"parent": "", "created": 0}
+    valid_layers = {key for key, metadata in layers.items() if time.time() - metadata["created"] < max_layer_age}
+    # remove layers with a missing parent until nothing changes anymore
+    while orphans := {key for key in valid_layers if layers[key]["parent"] and layers[key]["parent"] not in
+                      valid_layers}:
+        valid_layers -= orphans
+    for file in os.listdir(f"{cache_dir}/layers"):
+        if file.removesuffix(".json") not in valid_layers:
+            _remove_tree(f"{cache_dir}/layers/{file}")
+
+
+# The last layer has to be the first lower dir
+def _lower_dirs(layers: list) -> str:
+    return ":".join(list(reversed(layers)) + [f"{cache_dir}/work/empty"])
+
+
+def _metacopy_option() -> str:
+    return ",metacopy=on" if metacopy else ""
+
+
+# Any change to the builder itself invalidates the layers: the commit and a hash of uncommitted changes
+def _builder_version() -> str:
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+        changes = subprocess.check_output(["git", "diff", "HEAD"])
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return "unknown"
+    return f"{commit}-{hashlib.sha256(changes).hexdigest()}"
+
+
+# The layers contain whiteouts (device files) and files that aren't writable -> rm instead of pathlib
+def _remove_tree(path: str) -> None:
+    if os.path.lexists(path):
+        bash(f"rm -rf {path}")
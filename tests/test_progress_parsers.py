@@ -0,0 +1,104 @@
+# Replay captured package manager logs through the progress parsers
+# The logs are fed in small chunks, like follow_log reads them from a log that is still being written -> lines are
+# split across reads.
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import functions  # noqa: E402
+import progress  # noqa: E402
+
+logs_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs")
+
+
+# Collects (event, task name, done, total) for every progress event
+@pytest.fixture
+def events():
+    recorded = []
+    with progress._lock:
+        subscribers = list(progress._subscribers)
+        progress._subscribers.clear()
+    progress.subscribe(lambda event, task, active_tasks: recorded.append((event, task.name, task.done, task.total)))
+    yield recorded
+    with progress._lock:
+        progress._subscribers[:] = subscribers
+
+
+def replay(parser, log_name: str, chunk_size: int) -> None:
+    with open(os.path.join(logs_dir, log_name), "r") as file:
+        log = file.read()
+    log_lines = functions.LogLines()
+    for start in range(0, len(log), chunk_size):
+        for line in log_lines.split(log[start:start + chunk_size]):
+            parser.feed(line)
+    if log_lines.partial_line:
+        parser.feed(log_lines.partial_line)
+    parser.finish()
+
+
+# Returns {task name: (done, total)} of the finished tasks
+def finished_tasks(events: list) -> dict:
+    return {name: (done, total) for event, name, done, total in events if event == "finish"}
+
+
+def progress_updates(events: list, name: str) -> list:
+    return [(done, total) for event, task_name, done, total in events if event == "progress" and task_name == name]
+
+
+def test_log_lines_split_across_reads():
+    log_lines = functions.LogLines()
+    assert log_lines.split("instal") == []
+    assert log_lines.split("ling nano...\ninstalling") == ["installing nano..."]
+    assert log_lines.split(" sudo...\r 50%\r") == ["installing sudo...", " 50%"]
+    assert log_lines.partial_line == ""
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_pacman(events, chunk_size):
+    replay(functions.PacmanProgressParser(), "pacman.log", chunk_size)
+    assert finished_tasks(events) == {
+        "Downloading packages": (3, 3),
+        "Installing packages": (3, 3),
+        "Running post-transaction hooks": (2, 2)
+    }
+    assert progress_updates(events, "Downloading packages") == [(1, 3), (2, 3), (3, 3)]
+    assert progress_updates(events, "Installing packages") == [(1, 3), (2, 3), (3, 3)]
+    assert progress_updates(events, "Running post-transaction hooks") == [(1, 2), (2, 2)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_apt(events, chunk_size):
+    replay(functions.AptProgressParser(), "apt.log", chunk_size)
+    assert finished_tasks(events) == {
+        "Downloading packages": (100, 100),
+        "Installing packages": (100, 100)
+    }
+    assert progress_updates(events, "Downloading packages") == [(0, 100), (20, 100), (61, 100), (100, 100)]
+    assert progress_updates(events, "Installing packages") == [(0, 100), (0, 100), (16, 100), (33, 100), (50, 100),
+                                                               (66, 100), (83, 100), (100, 100)]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096])
+def test_dnf(events, chunk_size):
+    replay(functions.DnfProgressParser(), "dnf.log", chunk_size)
+    assert finished_tasks(events) == {
+        "Downloading packages": (3, 3),
+        "Installing packages": (3, 3),
+        "Verifying packages": (3, 3)
+    }
+    assert progress_updates(events, "Downloading packages") == [(1, 3), (2, 3), (3, 3)]
+    assert progress_updates(events, "Installing packages") == [(1, 3), (2, 3), (3, 3)]
+    assert progress_updates(events, "Verifying packages") == [(1, 3), (2, 3), (3, 3)]
+
+
+# follow_log reads a finished log to the end, including a last line without a newline
+def test_follow_log(tmp_path):
+    log = tmp_path / "package-manager.log"
+    log.write_text("(1/2) Reloading system manager configuration...\r(2/2) Arming ConditionNeedsUpdate...")
+    finished = functions.Event()
+    finished.set()
+    assert list(functions.follow_log(str(log), finished)) == ["(1/2) Reloading system manager configuration...",
+                                                             "(2/2) Arming ConditionNeedsUpdate..."]
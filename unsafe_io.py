@@ -0,0 +1,69 @@
+# Fast install mode: turn off the fsync calls of the package managers in the chroot
+# dpkg, rpm and pacman fsync every unpacked package, which is very slow on loop devices and usb sticks. The whole
+# image is synced once at the end of the build anyway, so the syncs only cost time. Everything is removed again after
+# each stage -> nothing ends up in the image or in the stage cache layers.
+#   dpkg: force-unsafe-io in a dpkg.cfg.d drop-in
+#   all: libeatmydata from the host in /etc/ld.so.preload, turns fsync & co into no-ops for every process in the chroot
+#        (pacman and rpm/dnf have no option of their own -> only the shim affects them, as well as package scripts)
+import os
+
+from functions import *
+
+config_files = {
+    "ubuntu": ("/etc/dpkg/dpkg.cfg.d/depthboot-unsafe-io", "force-unsafe-io\n"),
+    "pop-os": ("/etc/dpkg/dpkg.cfg.d/depthboot-unsafe-io", "force-unsafe-io\n")
+}
+shim_path = "/usr/lib/depthboot-eatmydata.so"  # inside the chroot
+
+
+def enable(distro_name: str) -> None:
+    print_status("Disabling fsync in the chroot")
+    if distro_name in config_files:
+        config_path, config = config_files[distro_name]
+        with open(root_path(config_path), "w") as file:
+            file.write(config)
+    _enable_shim()
+
+
+# Never fails if enable didn't finish, as it's called during cleanup
+def disable(distro_name: str) -> None:
+    if distro_name in config_files:
+        rmfile(root_path(config_files[distro_name][0]))
+    with contextlib.suppress(FileNotFoundError):
+        with open(root_path("/etc/ld.so.preload"), "r") as file:
+            preload = [line for line in file.readlines() if line.strip() != shim_path]
+        if preload:
+            with open(root_path("/etc/ld.so.preload"), "w") as file:
+                file.writelines(preload)
+        else:
+            rmfile(root_path("/etc/ld.so.preload"))
+    rmfile(root_path(shim_path))
+
+
+def _enable_shim() -> None:
+    host_shim = _find_host_shim()
+    if not host_shim:
+        print_warning("libeatmydata not found on the host, only the package manager options are used. Install "
+                      "eatmydata/libeatmydata to disable fsync for everything in the chroot")
+        return
+    cpfile(host_shim, root_path(shim_path), preserve_metadata=False)
+    # The host library might need a newer glibc than the chroot has. ld.so only complains and continues in that case,
+    # but it would complain for every single process in the chroot.
+    if chroot(f"LD_PRELOAD={shim_path} /bin/true 2>&1"):
+        print_warning("The host libeatmydata doesn't work in the chroot, only the package manager options are used")
+        rmfile(root_path(shim_path))
+        return
+    with open(root_path("/etc/ld.so.preload"), "a") as file:
+        file.write(f"{shim_path}\n")
+
+
+# Returns the path of the host libeatmydata or an empty string
+def _find_host_shim() -> str:
+    try:
+        libraries = bash("ldconfig -p")
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return ""
+    for line in libraries.split("\n"):
+        if line.strip().startswith("libeatmydata.so") and "x86-64" in line:
+            return line[line.find("=>") + 2:].strip()
+    return ""